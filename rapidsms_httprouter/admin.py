@@ -3,10 +3,66 @@ from django.contrib import admin
 from django.core.urlresolvers import reverse
 from django import forms
 from django.http import HttpResponseRedirect
-from .models import Message
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, MAX_SHOW_ALL_ALLOWED
+from django.core.paginator import InvalidPage
+from .models import Message, Suppression
 from .router import get_router
+from .pagination import EstimatedCountPaginator, KeysetPaginator, fast_count, get_int
+
+class MessageChangeList(ChangeList):
+    """
+    When sorted newest first, as it is by default, pages through messages by id rather than
+    with an OFFSET that gets slower the further back you go.  Counts are estimated once
+    they get large, see EstimatedCountPaginator.
+    """
+    def get_query_set(self):
+        # these aren't filters, so keep them away from the admin's lookups
+        self.before = get_int(self.params, 'before')
+        self.after = get_int(self.params, 'after')
+        self.params.pop('before', None)
+        self.params.pop('after', None)
+
+        return super(MessageChangeList, self).get_query_set()
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        result_count = paginator.count
+
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = fast_count(self.root_query_set)
+
+        can_show_all = result_count <= MAX_SHOW_ALL_ALLOWED
+        multi_page = result_count > self.list_per_page
+
+        self.keyset_page = None
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        elif self.order_field in ('id', 'pk') and self.order_type == 'desc':
+            self.keyset_page = KeysetPaginator(self.query_set, self.list_per_page).page(before=self.before, after=self.after)
+            result_list = self.keyset_page.object_list
+            self.older_url = self.keyset_page.has_next and self.get_query_string(dict(before=self.keyset_page.next_before))
+            self.newer_url = self.keyset_page.has_previous and self.get_query_string(dict(after=self.keyset_page.previous_after))
+        else:
+            try:
+                result_list = paginator.page(self.page_num+1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
 
 class MessageAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
 
     def get_urls(self):
         urls = super(MessageAdmin, self).get_urls()
@@ -51,6 +107,7 @@ class MessageAdmin(admin.ModelAdmin):
     list_display = ('sms_dir', 'backend', 'identity', 'text', 'date', 'status')
     list_filter = ('status',)
     list_display_links = ('text',)
+    list_select_related = True
 
     actions = None
     search_fields = ('connection__identity', 'text')
@@ -64,5 +121,9 @@ class MessageAdmin(admin.ModelAdmin):
 
 admin.site.register(Message, MessageAdmin)
 
+class SuppressionAdmin(admin.ModelAdmin):
+    list_display = ('identity', 'backend', 'created_on')
+    list_filter = ('backend',)
+    search_fields = ('identity',)
 
-
+admin.site.register(Suppression, SuppressionAdmin)
@@ -0,0 +1,254 @@
+"""
+Micro benchmarks for the router's hot paths.  Run them with the ``router_benchmark``
+management command, each returns a dict of timings which the command prints.
+"""
+import datetime
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request with a 202, like Kannel does, keeping the connection open.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    # write each response in one go, like Kannel, rather than a packet per header
+    wbufsize = -1
+
+    def do_GET(self):
+        body = "0: Accepted for delivery"
+        self.send_response(202)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_stub_server():
+    """
+    Starts a stub HTTP server on a free local port, returning it.
+    """
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def timed(func, count):
+    start = time.time()
+    for i in range(count):
+        func(i)
+    elapsed = time.time() - start
+    return dict(count=count, seconds=round(elapsed, 3), per_second=round(count / elapsed, 1))
+
+def benchmark_transport(count=1000):
+    """
+    Sends ``count`` requests to a local stub server, first opening a connection per request
+    with urlopen, then through our pooled transport.
+    """
+    from .transport import HttpTransport, urlopen_fetch_url
+
+    server = start_stub_server()
+    try:
+        url = "http://127.0.0.1:%d/cgi-bin/sendsms?to=%%d&text=hello" % server.server_address[1]
+        transport = HttpTransport()
+
+        results = dict(urlopen=timed(lambda i: urlopen_fetch_url(url % i, {}).read(), count),
+                       pooled=timed(lambda i: transport.request(url % i).read(), count))
+        results['pool'] = transport.stats()
+        transport.close()
+        return results
+    finally:
+        server.shutdown()
+
+def benchmark_inserts(count=1000):
+    """
+    Inserts ``count`` outgoing messages one at a time, as the router does, first with the
+    indexes we have now, then again with a btree on message text like we used to have.
+    The inserts go to a scratch copy of the messages table which is dropped afterwards, the
+    messages table itself is never written to or locked.
+    """
+    from django.db import connection, transaction
+    from .models import Message
+
+    text = "Dear member, your monthly report %d is due on Friday. Reply with REPORT followed by your figures."
+    qn = connection.ops.quote_name
+    table = 'rapidsms_httprouter_benchmark'
+
+    # the indexes on the messages table, see migration 0005
+    indexes = [['connection_id'], ['in_response_to_id'], ['batch_id'], ['direction'], ['status'], ['priority'],
+               ['direction', 'status', 'priority'], ['connection_id', 'direction', 'date']]
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE %s AS SELECT * FROM %s WHERE 1 = 0" % (qn(table), qn(Message._meta.db_table)))
+        for i, columns in enumerate(indexes):
+            cursor.execute("CREATE INDEX %s ON %s (%s)" % (qn("%s_%d" % (table, i)), qn(table),
+                                                           ", ".join([qn(column) for column in columns])))
+
+        columns = ('id', 'text', 'date', 'direction', 'status', 'connection_id', 'priority', 'retry_count')
+        sql = "INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, 'O', 'Q', 1, 10, 0)" % (qn(table), ", ".join([qn(c) for c in columns]))
+        date = connection.ops.value_to_db_datetime(datetime.datetime.now())
+        ids = iter(xrange(1, 2 * count + 1))
+
+        def insert(i):
+            cursor.execute(sql, [ids.next(), text % i, date])
+
+        results = dict(current_indexes=timed(insert, count))
+
+        cursor.execute("CREATE INDEX %s ON %s (%s)" % (qn("%s_text" % table), qn(table), qn('text')))
+        results['with_text_index'] = timed(insert, count)
+        return results
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+        # SQLite and MySQL commit before any DDL, so drop whatever the rollback missed
+        cursor = connection.cursor()
+        cursor.execute("DROP TABLE IF EXISTS %s" % qn(table))
+        transaction.commit_unless_managed()
+
+def benchmark_normalizer(count=1000):
+    """
+    Normalizes ``count`` numbers, a mix of formats for a few hundred subscribers, first with
+    the regular expression we used to use, then stripping them with our normalizer, then also
+    applying country code rules, with and without its memo.
+    """
+    import re
+    from .normalizer import NumberNormalizer
+
+    formats = ["+256 77%07d", "077%07d", "25677%07d", "(077) %07d", "Tel: 077-%07d"]
+    numbers = [formats[i % len(formats)] % (i % 300) for i in range(count)]
+    rules = {'default': {'country_code': '256', 'national_length': 9}}
+
+    stripped = NumberNormalizer(cache_size=0)
+    uncached = NumberNormalizer(rules=rules, cache_size=0)
+    memoized = NumberNormalizer(rules=rules)
+
+    return dict(regex=timed(lambda i: re.sub('[^0-9a-z]', '', numbers[i].lower()), count),
+                stripped=timed(lambda i: stripped.normalize(numbers[i]), count),
+                rules=timed(lambda i: uncached.normalize(numbers[i]), count),
+                memoized=timed(lambda i: memoized.normalize(numbers[i]), count))
+
+def benchmark_dispatch(count=1000):
+    """
+    Passes ``count`` messages through the incoming phases of a router with 15 apps, most of
+    which only take part in one phase, first with the loop we used to have, calling every app
+    in every phase and formatting every debug message up front, then through the router's
+    dispatch table.  Nothing is written to the database.
+    """
+    from rapidsms.apps.base import AppBase
+    from rapidsms.messages.incoming import IncomingMessage
+    from rapidsms.models import Backend, Connection
+    from .router import HttpRouter
+
+    class FilterApp(AppBase):
+        def filter(self, msg):
+            return False
+
+    class HandleApp(AppBase):
+        def handle(self, msg):
+            return False
+
+    class CleanupApp(AppBase):
+        def cleanup(self, msg):
+            pass
+
+    class BenchmarkMessage(object):
+        """
+        Stands in for a Message, so we only time the apps.
+        """
+        def __init__(self, connection):
+            self.id = 1
+            self.connection = connection
+            self.text = "report 12 34"
+            self.date = datetime.datetime.now()
+
+        def transition(self, from_statuses, to_status, **fields):
+            return True
+
+    def process_incoming_phases_before(self, db_message):
+        """
+        HttpRouter.process_incoming_phases as it was before the dispatch table.
+        """
+        msg = IncomingMessage(db_message.connection, db_message.text, db_message.date)
+        msg.db_message = db_message
+
+        self.info("SMS[%d] IN (%s) : %s" % (db_message.id, msg.connection, msg.text))
+        try:
+            for phase in self.incoming_phases:
+                self.debug("In %s phase" % phase)
+                if phase == "default":
+                    if msg.handled:
+                        self.debug("Skipping phase")
+                        break
+
+                for app in self.apps:
+                    self.debug("In %s app" % app)
+                    handled = False
+
+                    try:
+                        func = getattr(app, phase)
+                        handled = func(msg)
+
+                    except Exception, err:
+                        import traceback
+                        traceback.print_exc(err)
+                        app.exception()
+
+                    if phase == "filter":
+                        if handled is True:
+                            self.warning("Message filtered")
+                            raise(StopIteration)
+
+                    elif phase == "handle":
+                        if handled is True:
+                            self.debug("Short-circuited")
+                            msg.handled = True
+                            break
+
+                    elif phase == "default":
+                        if handled is True:
+                            self.debug("Short-circuited default")
+                            break
+
+        except StopIteration:
+            pass
+
+        db_message.transition(('R', 'P'), 'H')
+
+        while msg.responses:
+            response = msg.responses.pop(0)
+            self.handle_outgoing(response, db_message)
+
+        msg.processed = True
+        return db_message
+
+    router = HttpRouter()
+    router.apps = [FilterApp(router)] + [HandleApp(router) for i in range(12)] + [CleanupApp(router) for i in range(2)]
+    message = BenchmarkMessage(Connection(backend=Backend(name='benchmark'), identity='256700000000'))
+    results = dict(apps=len(router.apps))
+
+    results['before'] = timed(lambda i: process_incoming_phases_before(router, message), count)
+    results['dispatch_table'] = timed(lambda i: router.process_incoming_phases(message), count)
+    return results
+
+BENCHMARKS = {
+    'dispatch': benchmark_dispatch,
+    'inserts': benchmark_inserts,
+    'normalizer': benchmark_normalizer,
+    'transport': benchmark_transport,
+}
@@ -0,0 +1,233 @@
+"""
+In-process caches used by the router to avoid hitting the database for lookups
+that repeat on nearly every message, such as resolving a backend name or a sender's
+identity to its Connection.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from rapidsms.models import Backend, Connection
+
+class LRUCache(object):
+    """
+    A bounded, thread safe, least recently used cache.  Entries older than ``ttl``
+    seconds are treated as missing.  Keeps hit and miss counters so we can tell
+    whether the cache is earning its keep.
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    # reinsert so this is now our most recently used entry
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+
+            # evict our least recently used entries
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(size=len(self._entries), max_size=self.size, ttl=self.ttl,
+                    hits=self.hits, misses=self.misses)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class IdentityCache(object):
+    """
+    Caches backend name -> Backend and (backend id, normalized identity) -> Connection.
+
+    Rows we had to create are not cached until they are seen again, that way a rolled back
+    transaction can't leave us pointing at a connection which doesn't exist.
+
+    We never hand out the cached instances themselves, as apps are free to modify the
+    connection on a message, instead each lookup returns a fresh model instance built from
+    the cached column values.
+
+    Saves and deletes are seen through signals.  They drop our own entries and bump a
+    generation number in the Django cache so other processes drop all of theirs the next time
+    they check it, at most ROUTER_IDENTITY_CACHE_GENERATION_INTERVAL seconds later.  Commands
+    that rewrite connections in bulk, without signals, call clear() which does the same.
+    """
+    GENERATION_KEY = 'rapidsms_httprouter_identity_generation'
+
+    def __init__(self, size=None, ttl=None):
+        if size is None:
+            size = getattr(settings, 'ROUTER_IDENTITY_CACHE_SIZE', 10000)
+        if ttl is None:
+            ttl = getattr(settings, 'ROUTER_IDENTITY_CACHE_TTL', 300)
+
+        self.backends = LRUCache(size=size, ttl=ttl)
+        self.connections = LRUCache(size=size, ttl=ttl)
+
+        # connection id -> cache key, lets us invalidate a connection whose identity changed
+        self._connection_keys = {}
+
+        # how often we check whether another process cleared the cache
+        self.generation_interval = getattr(settings, 'ROUTER_IDENTITY_CACHE_GENERATION_INTERVAL', 5)
+        self._generation = None
+        self._generation_checked = 0
+
+    def get_backend(self, name):
+        """
+        Returns the Backend with the passed in name, creating it if necessary.
+        """
+        self._check_generation()
+        values = self.backends.get(name)
+        if values is None:
+            backend, created = Backend.objects.get_or_create(name=name)
+            if not created:
+                self.backends.set(name, self._values(backend))
+            return backend
+
+        return self._instance(Backend, values)
+
+    def get_connection(self, backend, identity):
+        """
+        Returns the Connection for the passed in backend and normalized identity, creating
+        it if necessary.
+        """
+        self._check_generation()
+        key = (backend.pk, identity)
+        values = self.connections.get(key)
+        if values is None:
+            connection = Connection.objects.filter(backend=backend, identity=identity)
+
+            # if not found, create it
+            if not connection:
+                connection = Connection.objects.create(backend=backend, identity=identity)
+            else:
+                connection = connection[0]
+                self.connections.set(key, self._values(connection))
+                self._connection_keys[connection.pk] = key
+
+                # our reverse index isn't told about evictions, prune it once it grows too big
+                if len(self._connection_keys) > 2 * self.connections.size:
+                    self._prune_connection_keys()
+        else:
+            connection = self._instance(Connection, values)
+
+        connection.backend = backend
+        return connection
+
+    def invalidate_backend(self, backend):
+        self.backends.delete(backend.name)
+
+        # connection keys contain the backend id, easiest to just start over
+        self.connections.clear()
+
+    def invalidate_connection(self, connection):
+        # the identity may have just been changed, so we can't build the key from this
+        # instance, use the key it was cached under instead
+        key = self._connection_keys.pop(connection.pk, None)
+        if key is not None:
+            self.connections.delete(key)
+
+    def clear(self, broadcast=True):
+        self.backends.clear()
+        self.connections.clear()
+        self._connection_keys = {}
+
+        if broadcast:
+            self.broadcast()
+
+    def broadcast(self):
+        """
+        Bumps our generation number so other processes drop their entries.
+        """
+        try:
+            generation = cache.incr(self.GENERATION_KEY)
+        except ValueError:
+            generation = 1
+            cache.set(self.GENERATION_KEY, generation, 60 * 60 * 24 * 30)
+
+        # if another process bumped it since we last looked we missed its change too
+        if self._generation is not None and generation != self._generation + 1:
+            self.clear(broadcast=False)
+        self._generation = generation
+
+    def stats(self):
+        return dict(backends=self.backends.stats(), connections=self.connections.stats())
+
+    def _check_generation(self):
+        now = time.time()
+        if now - self._generation_checked < self.generation_interval:
+            return
+
+        self._generation_checked = now
+        generation = cache.get(self.GENERATION_KEY)
+        if generation != self._generation:
+            if self._generation is not None:
+                self.clear(broadcast=False)
+            self._generation = generation
+
+    def _prune_connection_keys(self):
+        with self.connections._lock:
+            self._connection_keys = dict((values['id'], key) for key, (values, expires)
+                                         in self.connections._entries.items())
+
+    def _values(self, instance):
+        return dict((f.attname, getattr(instance, f.attname)) for f in instance._meta.fields)
+
+    def _instance(self, model, values):
+        instance = model(**values)
+        instance._state.adding = False
+        return instance
+
+
+identity_cache = IdentityCache()
+
+def get_identity_cache():
+    return identity_cache
+
+def invalidate_backend(sender, instance, created=False, **kwargs):
+    if not created:
+        identity_cache.invalidate_backend(instance)
+        identity_cache.broadcast()
+
+def invalidate_connection(sender, instance, created=False, **kwargs):
+    # a brand new connection can't be in anyone's cache yet
+    if not created:
+        identity_cache.invalidate_connection(instance)
+        identity_cache.broadcast()
+
+post_save.connect(invalidate_backend, sender=Backend)
+post_delete.connect(invalidate_backend, sender=Backend)
+post_save.connect(invalidate_connection, sender=Connection)
+post_delete.connect(invalidate_connection, sender=Connection)
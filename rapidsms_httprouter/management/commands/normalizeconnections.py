@@ -1,49 +1,190 @@
 from optparse import make_option
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.db import connections, router, transaction, DEFAULT_DB_ALIAS
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import get_model
 
-from rapidsms.models import Connection, Backend
-from rapidsms_httprouter.router import HttpRouter
-from datetime import datetime
-
-import traceback
+from rapidsms.models import Backend, Connection
+from rapidsms_httprouter.cache import get_identity_cache
+from rapidsms_httprouter.normalizer import get_normalizer
 
 class Command(BaseCommand):
-    help = 'Normalizes all connections in the database, removing everything except digits.'
+    help = """Normalizes all connections in the database, removing everything except digits.
+
+    Connections are worked through in chunks ordered by id, each committed on its own, so the
+    command can be stopped at any point and picked up again with --after, using the last id
+    it printed.  Connections whose normalized identity is already taken are left alone, unless
+    --merge is passed, in which case everything referencing them is moved over to the connection
+    with that identity and they are deleted.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+                    help='How many connections to look at in each chunk'),
+        make_option('--after', dest='after', type='int', default=0,
+                    help='Only normalize connections with ids above this, to resume an earlier run'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Report the remaps and collisions we find without changing anything'),
+        make_option('--merge', action='store_true', dest='merge', default=False,
+                    help='Merge connections that collide into the connection already using their identity'),
+    )
+
+    def candidates(self, after, chunk_size):
+        """
+        Returns the next chunk of (id, backend id, identity) tuples for connections which may
+        need normalizing.  Without any ROUTER_NUMBER_RULES those are only the connections with
+        anything but lower case letters and digits in them.
+        """
+        candidates = Connection.objects.filter(pk__gt=after).order_by('pk')
+        if not self.normalizer.rules:
+            candidates = candidates.filter(identity__regex=r'[^0-9a-z]')
+        return list(candidates.values_list('pk', 'backend', 'identity')[:chunk_size].iterator())
+
+    def find_remaps(self, rows):
+        """
+        Normalizes the passed in rows, returning a list of (id, identity, normalized) tuples
+        for those we can remap and a list of (id, identity, normalized, canonical id) tuples
+        for those that would collide with an existing connection, or with another connection
+        in the same chunk, where the canonical id is that of the connection to merge into.
+        """
+        changed = []
+        for pk, backend_id, identity in rows:
+            normalized = self.normalizer.normalize(identity, self.backend_names.get(backend_id))
+            if normalized != identity:
+                changed.append((pk, backend_id, identity, normalized))
+
+        if not changed:
+            return [], []
+
+        # one query for all the normalized identities which are already taken
+        taken = {}
+        existing = Connection.objects.filter(identity__in=set(c[3] for c in changed)).order_by('-pk')
+        for pk, backend_id, identity in existing.values_list('pk', 'backend', 'identity'):
+            taken[(backend_id, identity)] = pk
+
+        remaps, collisions = [], []
+        for pk, backend_id, identity, normalized in changed:
+            if (backend_id, normalized) in taken:
+                collisions.append((pk, identity, normalized, taken[(backend_id, normalized)]))
+            else:
+                taken[(backend_id, normalized)] = pk
+                remaps.append((pk, identity, normalized))
+
+        return remaps, collisions
+
+    def apply_remaps(self, remaps):
+        """
+        Sets the identities of all the passed in connections in a single UPDATE.
+        """
+        db_connection = connections[Connection.objects.db]
+        qn = db_connection.ops.quote_name
+
+        cases, params, ids = [], [], []
+        for pk, identity, normalized in remaps:
+            cases.append("WHEN %s THEN %s")
+            params += [pk, normalized]
+            ids.append(pk)
+
+        sql = "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % \
+              (qn(Connection._meta.db_table), qn('identity'), qn('id'), " ".join(cases),
+               qn('id'), ", ".join(["%s"] * len(ids)))
+
+        db_connection.cursor().execute(sql, params + ids)
+
+    def connection_references(self):
+        """
+        Returns a list of (model, field) tuples for the foreign keys to Connection we move
+        over when merging.  These are named in ROUTER_CONNECTION_REFERENCES, as
+        'app_label.Model.field' strings, by default every foreign key to Connection.
+        """
+        names = getattr(settings, 'ROUTER_CONNECTION_REFERENCES', None)
+        if names is None:
+            return [(related.model, related.field) for related in Connection._meta.get_all_related_objects()]
+
+        references = []
+        for name in names:
+            try:
+                app_label, model_name, field_name = name.split('.')
+                model = get_model(app_label, model_name)
+                references.append((model, model._meta.get_field(field_name)))
+            except Exception:
+                raise CommandError("Invalid ROUTER_CONNECTION_REFERENCES entry '%s', should be 'app_label.Model.field'" % name)
+        return references
+
+    def merge_collisions(self, collisions):
+        """
+        Points everything referencing the passed in connections at their canonical connections,
+        one UPDATE for each reference, then deletes them.
+        """
+        db_connection = connections[Connection.objects.db]
+        qn = db_connection.ops.quote_name
+
+        cases, params, ids = [], [], []
+        for pk, identity, normalized, canonical in collisions:
+            cases.append("WHEN %s THEN %s")
+            params += [pk, canonical]
+            ids.append(pk)
+        placeholders = ", ".join(["%s"] * len(ids))
+
+        cursor = db_connection.cursor()
+        for model, field in self.references:
+            column = qn(field.column)
+            cursor.execute("UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" %
+                           (qn(model._meta.db_table), column, column, " ".join(cases), column, placeholders),
+                           params + ids)
+
+        # deleted directly rather than through the ORM, which would cascade to anything we didn't move
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (qn(Connection._meta.db_table), qn('id'), placeholders), ids)
 
-    def handle(self, *files, **options):
-        connection = connections[DEFAULT_DB_ALIAS]
+    def normalize_chunk(self, rows, dry_run, merge):
+        remaps, collisions = self.find_remaps(rows)
+        if not dry_run:
+            if remaps:
+                self.apply_remaps(remaps)
+            if collisions and merge:
+                self.merge_collisions(collisions)
+        return remaps, collisions
 
-        # Start transaction management. All fixtures are installed in a
-        # single transaction to ensure that all references are resolved.
-        transaction.commit_unless_managed()
-        transaction.enter_transaction_management()
-        transaction.managed(True)
+    def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options['dry_run']
+        after = options['after']
+        merge = options['merge']
 
-        # for every connection
-        for connection in Connection.objects.all():
-            # try normalizing the number
-            normalized = HttpRouter.normalize_number(connection.identity)
+        self.normalizer = get_normalizer()
+        self.backend_names = dict(Backend.objects.values_list('pk', 'name'))
+        if merge:
+            self.references = self.connection_references()
 
-            # if it is different, then we changed it, first check to see
-            # if there is a connection that is identical.  In that case we don't
-            # change anything, it is too difficult to know who might have a reference
-            # to this connection in the system to remap.
-            if normalized != connection.identity:
-                collision = Connection.objects.filter(identity=normalized, backend=connection.backend)
+        remapped = skipped = seen = 0
+        while True:
+            rows = self.candidates(after, options['chunk_size'])
+            if not rows:
+                break
 
-                # no collision!  Ok, we can just save our new identity
-                if not collision:
-                    print "remapping %s to %s" % (connection.identity, normalized)
-                    
-                    connection.identity = normalized
-                    connection.save()
+            # each chunk is committed on its own, so we never hold locks for long
+            remaps, collisions = transaction.commit_on_success(self.normalize_chunk)(rows, dry_run, merge)
 
-                else:
-                    print "skipping %s, collision" % (connection.identity)
+            seen += len(rows)
+            remapped += len(remaps)
+            skipped += len(collisions)
+            after = rows[-1][0]
 
-        transaction.commit()
+            if verbosity > 1:
+                for pk, identity, normalized in remaps:
+                    print "remapping %s to %s" % (identity, normalized)
+            if verbosity > 0:
+                for pk, identity, normalized, canonical in collisions:
+                    print "%s %s, collision with %s" % ("merging" if merge else "skipping", identity, normalized)
+                print "normalized up to id %d: %d looked at, %d remapped, %d %s" % \
+                      (after, seen, remapped, skipped, "merged" if merge else "skipped")
 
+        if verbosity > 0:
+            print "%s %d connections, %s %d collisions" % ("Would remap" if dry_run else "Remapped", remapped,
+                                                          "merged" if merge else "skipped", skipped)
 
+        # identities have been remapped under the router's feet, make sure no process keeps
+        # handing out connections from its cache
+        if (remapped or (merge and skipped)) and not dry_run:
+            get_identity_cache().clear()
@@ -0,0 +1,24 @@
+import pprint
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from rapidsms_httprouter.benchmarks import BENCHMARKS
+
+class Command(BaseCommand):
+    help = """Runs the named router benchmarks, or all of them if none are given.
+    """
+    args = "[%s]" % " ".join(sorted(BENCHMARKS.keys()))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', dest='count', default=1000,
+                    help='How many iterations to time for each benchmark'),
+    )
+
+    def handle(self, *names, **options):
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark '%s', choose from: %s" % (name, ", ".join(sorted(BENCHMARKS.keys()))))
+
+        for name in names or sorted(BENCHMARKS.keys()):
+            print "%s:" % name
+            pprint.pprint(BENCHMARKS[name](count=options['count']))
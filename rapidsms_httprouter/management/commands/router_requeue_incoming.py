@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from rapidsms_httprouter.router import get_router
+
+class Command(BaseCommand):
+    help = """Handles incoming messages left behind by a web process that died, those received
+    more than ROUTER_INCOMING_STALE_AGE seconds ago and never picked up, and those whose
+    processing lease expired.  Messages are handled right here rather than handed off, so this
+    needs neither Celery nor a web process, run it from cron when ROUTER_INCOMING_MODE is 'thread'.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', dest='limit', type='int', default=100,
+                    help='How many messages to handle in each pass'),
+    )
+
+    def handle(self, **options):
+        router = get_router()
+
+        total = 0
+        while True:
+            handled = router.requeue_stale_incoming(limit=options['limit'], dispatch=router.process_incoming_message)
+            total += len(handled)
+            if len(handled) < options['limit']:
+                break
+
+        print "Handled %d stale incoming messages" % total
@@ -0,0 +1,41 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from rapidsms_httprouter.models import Message
+from rapidsms_httprouter.rollups import rollup_days, compact_rollups
+
+class Command(BaseCommand):
+    help = """Recounts the daily message rollups behind the summary report.  With --since, every
+    day from then on is recounted, use this to backfill history.  Otherwise only recent days are.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+                    help='Recount every day since this date, YYYY-MM-DD, or "start" for all of history'),
+        make_option('--until', dest='until', default=None,
+                    help='The last day to recount when using --since, YYYY-MM-DD, defaults to today'),
+    )
+
+    def parse_date(self, value):
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError("Invalid date '%s', use YYYY-MM-DD" % value)
+
+    def handle(self, **options):
+        if not options['since']:
+            compact_rollups()
+            return
+
+        if options['since'] == 'start':
+            first = Message.objects.order_by('pk').values_list('date', flat=True)[:1]
+            if not first:
+                return
+            day = first[0].date()
+        else:
+            day = self.parse_date(options['since'])
+
+        until = self.parse_date(options['until']) if options['until'] else datetime.date.today()
+        count = rollup_days(day, until)
+        print "Counted %d messages from %s to %s" % (count, day.isoformat(), until.isoformat())
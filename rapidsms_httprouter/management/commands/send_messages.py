@@ -3,13 +3,15 @@ import time
 from django.core.management.base import BaseCommand
 from rapidsms.models import Backend, Connection, Contact
 from rapidsms_httprouter.models import Message, MessageBatch
-from rapidsms_httprouter.router import get_router
+from rapidsms_httprouter.router import get_router, fetch_url
 from django.conf import settings
 from django.core.mail import send_mail
 from django.db import transaction, close_connection
 from urllib import quote_plus
-from urllib2 import urlopen
 from rapidsms.log.mixin import LoggerMixin
+from rapidsms_httprouter.workers import WorkerPool
+from rapidsms_httprouter.ratelimit import get_rate_limiter
+from threading import Lock
 
 class Command(BaseCommand, LoggerMixin):
 
@@ -18,9 +20,9 @@ class Command(BaseCommand, LoggerMixin):
 
     def fetch_url(self, url):
         """
-        Wrapper around url open, mostly here so we can monkey patch over it in unit tests.
+        Wrapper around our router's fetch_url, mostly here so we can monkey patch over it in unit tests.
         """
-        response = urlopen(url, timeout=15)
+        response = fetch_url(url, {})
         return response.getcode()
 
 
@@ -67,10 +69,14 @@ class Command(BaseCommand, LoggerMixin):
         return full_url
 
 
-    def send_backend_chunk(self, router_url, pks, backend_name):
-        msgs = Message.objects.using(self.db).filter(pk__in=pks).exclude(connection__identity__iregex="[a-z]")
+    def send_backend_chunk(self, router_url, pks, backend_name, db=None):
+        msgs = Message.objects.using(db or self.db).filter(pk__in=pks).exclude(connection__identity__iregex="[a-z]")
         try:
-            url = self.build_send_url(router_url, backend_name, ' '.join(msgs.values_list('connection__identity', flat=True)), msgs[0].text)
+            recipients = msgs.values_list('connection__identity', flat=True)
+            url = self.build_send_url(router_url, backend_name, ' '.join(recipients), msgs[0].text)
+
+            # each recipient counts against our backend's rate limit
+            get_rate_limiter().acquire(backend_name, len(recipients))
             status_code = self.fetch_url(url)
 
             # kannel likes to send 202 responses, really any
@@ -86,32 +92,137 @@ class Command(BaseCommand, LoggerMixin):
             self.error("SMS%s Message not sent: %s .. queued for later delivery." % (pks, str(e)))
             msgs.update(status='Q')
 
-
-    def send_all(self, router_url, to_send):
+    def backend_chunks(self, to_send):
+        """
+        Splits the passed in messages into runs of the same backend, yielding a
+        (backend_name, pks) tuple for each.
+        """
         pks = []
         if len(to_send):
             backend_name = to_send[0].connection.backend.name
             for msg in to_send:
                 if backend_name != msg.connection.backend.name:
                     # send all of the same backend
-                    self.send_backend_chunk(router_url, pks, backend_name)
+                    yield backend_name, pks
                     # reset the loop status variables to build the next chunk of messages with the same backend
                     backend_name = msg.connection.backend.name
                     pks = [msg.pk]
                 else:
                     pks.append(msg.pk)
-            self.send_backend_chunk(router_url, pks, backend_name)
+            yield backend_name, pks
+
+    def send_all(self, router_url, to_send):
+        for backend_name, pks in self.backend_chunks(to_send):
+            self.dispatch_chunk(router_url, pks, backend_name)
 
     def send_individual(self, router_url):
-        to_process = Message.objects.using(self.db).filter(direction='O',
-                          status__in=['Q']).order_by('priority', 'status', 'connection__backend__name')
+        to_process = self.queued(Message.objects.using(self.db).filter(direction='O', status__in=['Q']))
         if len(to_process):
             self.send_all(router_url, [to_process[0]])
 
+    def queued(self, messages):
+        """
+        Orders the passed in queued messages for sending, leaving out those for backends
+        which can't take any more work right now.
+        """
+        busy = self.busy_backends()
+        if busy:
+            messages = messages.exclude(connection__backend__name__in=busy)
+        return messages.select_related('connection__backend').order_by('priority', 'status', 'connection__backend__name')
 
-    def handle(self, **options):
+    def busy_backends(self):
+        with self.inflight_lock:
+            return [backend_name for backend_name, count in self.inflight_backends.items()
+                    if count >= self.backend_limit(backend_name)]
+
+    def backend_limit(self, backend_name):
+        limits = getattr(settings, 'ROUTER_SEND_BACKEND_CONCURRENCY', {})
+        return limits.get(backend_name, limits.get('default', 2))
+
+    def acquire_slot(self, db, backend_name):
+        """
+        Takes a slot for sending a chunk from the passed in database to the passed in backend,
+        if there is room under all of our overall, per database and per backend limits.  The
+        check and the taking are one step, so chunks dispatched in the same pass can't go over.
+        Returns whether we got one, it is given back by ``release_slot``.
+        """
+        with self.inflight_lock:
+            # without workers we send in our main loop, one chunk at a time
+            if self.pools[db].workers:
+                if self.inflight_dbs.get(db, 0) >= self.pools[db].workers or \
+                   sum(self.inflight_dbs.values()) >= self.max_workers:
+                    return False
+
+            if self.inflight_backends.get(backend_name, 0) >= self.backend_limit(backend_name):
+                return False
+
+            self.inflight_dbs[db] = self.inflight_dbs.get(db, 0) + 1
+            self.inflight_backends[backend_name] = self.inflight_backends.get(backend_name, 0) + 1
+            return True
+
+    def release_slot(self, db, backend_name):
+        with self.inflight_lock:
+            self.inflight_dbs[db] -= 1
+            self.inflight_backends[backend_name] -= 1
+
+    def dispatch_chunk(self, router_url, pks, backend_name):
+        """
+        Hands the chunk to our database's worker pool, if there's a slot for it, otherwise it
+        is left queued for a later pass.  The messages are claimed first, moving them to 'L'
+        (Locked), so neither the next pass over the database nor another sender picks them up
+        again.
         """
+        db = self.db
+        if not self.acquire_slot(db, backend_name):
+            return
 
+        # from here on the slot is given back by send_chunk_job
+        submitted = False
+        try:
+            pks = Message.objects.using(db).filter(pk__in=pks).claim(from_statuses=('Q',))
+            transaction.commit(using=db)
+            if pks:
+                self.pools[db].submit(self.send_chunk_job, db, router_url, pks, backend_name)
+                submitted = True
+        finally:
+            if not submitted:
+                self.release_slot(db, backend_name)
+
+    def send_chunk_job(self, db, router_url, pks, backend_name):
+        try:
+            self.send_backend_chunk(router_url, pks, backend_name, db=db)
+        finally:
+            try:
+                # anything send_backend_chunk left alone goes back in the queue, as before
+                Message.objects.using(db).filter(pk__in=pks, status='L').update(status='Q', lease_expires=None)
+                transaction.commit_unless_managed(using=db)
+            finally:
+                self.release_slot(db, backend_name)
+
+    def db_is_full(self, db):
+        # without workers we send in our main loop, so never have anything in flight
+        if not self.pools[db].workers:
+            return False
+
+        with self.inflight_lock:
+            return self.inflight_dbs.get(db, 0) >= self.pools[db].workers or \
+                   sum(self.inflight_dbs.values()) >= self.max_workers
+
+    def start_dispatcher(self, dbs):
+        self.max_workers = getattr(settings, 'ROUTER_SEND_WORKERS', 8)
+        db_workers = getattr(settings, 'ROUTER_SEND_DB_WORKERS', 4)
+        self.pools = dict((db, WorkerPool('send-%s' % db, workers=db_workers)) for db in dbs)
+        self.inflight_lock = Lock()
+        self.inflight_dbs = {}
+        self.inflight_backends = {}
+
+    def handle(self, **options):
+        """
+        Loops over our databases in turn, handing chunks of queued messages off to a pool of
+        workers for each database.  ROUTER_SEND_WORKERS caps how many chunks are sent at once
+        overall, ROUTER_SEND_DB_WORKERS per database and ROUTER_SEND_BACKEND_CONCURRENCY per
+        backend name.  With ROUTER_SEND_DB_WORKERS set to 0 chunks are sent one at a time
+        in the main loop.
         """
         DBS = settings.DATABASES.keys()
         #DBS.remove('default') # skip the dummy -we now check default DB as well
@@ -120,21 +231,32 @@ class Command(BaseCommand, LoggerMixin):
         recipients = getattr(settings, 'ADMINS', None)
         if recipients:
             recipients = [email for name, email in recipients]
+
+        self.start_dispatcher(DBS)
+
         while (True):
             self.debug("entering main loop")
             for db in DBS:
+                # leave databases that already have their share of work in flight
+                if self.db_is_full(db):
+                    continue
+
+                transaction.enter_transaction_management(using=db)
                 try:
                     self.debug("servicing db '%s'" % db)
                     router_url = settings.DATABASES[db]['ROUTER_URL']
-                    transaction.enter_transaction_management(using=db)
                     self.db = db
+
+                    # requeue anything claimed by a sender that has since died
+                    Message.objects.using(db).reclaim_expired()
+
                     to_process = MessageBatch.objects.using(db).filter(status='Q')
                     self.debug("looking for batch messages to process")
                     if to_process.count():
                         self.info("found %d batches in %s to process" % (to_process.count(), db))
                         batch = to_process[0]
-                        to_process = batch.messages.using(db).filter(direction='O',
-                                      status__in=['Q']).order_by('priority', 'status', 'connection__backend__name')[:CHUNK_SIZE]
+                        to_process = self.queued(batch.messages.using(db).filter(direction='O',
+                                      status__in=['Q']))[:CHUNK_SIZE]
                         self.info("%d chunk of messages found in %s" % (to_process.count(), db))
                         if to_process.count():
                             self.debug("found batch message %d with Queued messages to send" % batch.pk)
@@ -156,11 +278,10 @@ class Command(BaseCommand, LoggerMixin):
                     if recipients:
                         send_mail('[Django] Error: messenger command', str(traceback.format_exc(exc)), 'root@uganda.rapidsms.org', recipients, fail_silently=True)
                     continue
+                finally:
+                    transaction.leave_transaction_management(using=db)
 
             # yield from the messages table, messenger can cause
             # deadlocks if it's contanstly polling the messages table
             close_connection()
             time.sleep(0.5)
-
-
-
@@ -3,7 +3,7 @@ import os, sys
 import datetime
 from tempfile import mkstemp
 from django.conf import settings
-from django.db import models, connection, connections
+from django.db import models, connection, connections, transaction
 from django.db.models import signals
 from django.db.models.fields import AutoField, DateTimeField, DateField, TimeField, FieldDoesNotExist
 from django.db.models.fields.related import ForeignKey, OneToOneField, ManyToManyField
@@ -17,10 +17,61 @@ class ForUpdateQuerySet(QuerySet):
         sql, params = self.query.get_compiler(self.db).as_sql()
         return self.model._default_manager.raw(sql.rstrip() + ' LIMIT 1 FOR UPDATE', params)
 
+    def claim(self, limit=None, lease=None, from_statuses=('Q', 'E')):
+        """
+        Atomically moves up to ``limit`` rows of this queryset which are in one of
+        ``from_statuses`` to 'L' (Locked), with a lease expiring in ``lease`` seconds.
+        Rows another worker already claimed are skipped.  Returns the claimed ids.
+        """
+        if lease is None:
+            lease = getattr(settings, 'ROUTER_CLAIM_LEASE', 300)
+
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=lease)
+        candidates = self.filter(status__in=from_statuses)
+        if limit is not None:
+            candidates = candidates[:limit]
+
+        db_connection = connections[self.db]
+        if db_connection.vendor == 'postgresql':
+            # one statement, skipping rows locked by another claim rather than waiting on them
+            table = db_connection.ops.quote_name(self.model._meta.db_table)
+            pk = db_connection.ops.quote_name(self.model._meta.pk.column)
+            sql, params = candidates.values('pk').query.get_compiler(self.db).as_sql()
+            if getattr(settings, 'ROUTER_CLAIM_SKIP_LOCKED', True):
+                sql = "%s FOR UPDATE OF %s SKIP LOCKED" % (sql, table)
+
+            cursor = db_connection.cursor()
+            cursor.execute("UPDATE %s SET status = 'L', lease_expires = %%s WHERE %s IN (%s) AND status IN (%s) RETURNING %s" %
+                           (table, pk, sql, ", ".join(["%s"] * len(from_statuses)), pk),
+                           [expires] + list(params) + list(from_statuses))
+            ids = [row[0] for row in cursor.fetchall()]
+            transaction.commit_unless_managed(using=self.db)
+            return ids
+
+        # elsewhere claim each row with its own conditional update, a row is ours only if our
+        # update is the one that moved it.  Expiries can't tell claims apart, MySQL for one
+        # drops their microseconds.
+        rows = self.model._default_manager.using(self.db)
+        return [pk for pk in list(candidates.values_list('pk', flat=True))
+                if rows.filter(pk=pk, status__in=from_statuses).update(status='L', lease_expires=expires)]
+
+    def reclaim_expired(self):
+        """
+        Puts rows whose lease expired, because their worker died, back in the 'Q' state.
+        Returns how many were requeued.
+        """
+        return self.filter(status='L', lease_expires__lt=datetime.datetime.now()).update(status='Q', lease_expires=None)
+
 class ForUpdateManager(models.Manager):
     def get_query_set(self):
         return ForUpdateQuerySet(self.model, using=self._db)
 
+    def claim(self, *args, **kwargs):
+        return self.get_query_set().claim(*args, **kwargs)
+
+    def reclaim_expired(self):
+        return self.get_query_set().reclaim_expired()
+
 def hash_dict(dictionary):
     return hash(frozenset(dictionary.items()))
 
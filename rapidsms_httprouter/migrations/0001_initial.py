@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'MessageBatch'
+        db.create_table('rapidsms_httprouter_messagebatch', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('status', self.gf('django.db.models.fields.CharField')(max_length=1)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=15, null=True, blank=True)),
+        ))
+        db.send_create_signal('rapidsms_httprouter', ['MessageBatch'])
+
+        # Adding model 'Message'
+        db.create_table('rapidsms_httprouter_message', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('connection', self.gf('django.db.models.fields.related.ForeignKey')(related_name='messages', to=orm['rapidsms.Connection'])),
+            ('text', self.gf('django.db.models.fields.TextField')(db_index=True)),
+            ('direction', self.gf('django.db.models.fields.CharField')(max_length=1, db_index=True)),
+            ('status', self.gf('django.db.models.fields.CharField')(max_length=1, db_index=True)),
+            ('date', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('priority', self.gf('django.db.models.fields.IntegerField')(default=10, db_index=True)),
+            ('in_response_to', self.gf('django.db.models.fields.related.ForeignKey')(related_name='responses', null=True, to=orm['rapidsms_httprouter.Message'])),
+            ('application', self.gf('django.db.models.fields.CharField')(max_length=100, null=True)),
+            ('batch', self.gf('django.db.models.fields.related.ForeignKey')(related_name='messages', null=True, to=orm['rapidsms_httprouter.MessageBatch'])),
+        ))
+        db.send_create_signal('rapidsms_httprouter', ['Message'])
+
+        # Adding model 'DeliveryError'
+        db.create_table('rapidsms_httprouter_deliveryerror', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('message', self.gf('django.db.models.fields.related.ForeignKey')(related_name='errors', to=orm['rapidsms_httprouter.Message'])),
+            ('log', self.gf('django.db.models.fields.TextField')()),
+            ('created_on', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+        ))
+        db.send_create_signal('rapidsms_httprouter', ['DeliveryError'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'MessageBatch'
+        db.delete_table('rapidsms_httprouter_messagebatch')
+
+        # Deleting model 'Message'
+        db.delete_table('rapidsms_httprouter_message')
+
+        # Deleting model 'DeliveryError'
+        db.delete_table('rapidsms_httprouter_deliveryerror')
+
+
+    models = {
+        'rapidsms.backend': {
+            'Meta': {'object_name': 'Backend'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '20'})
+        },
+        'rapidsms.connection': {
+            'Meta': {'object_name': 'Connection'},
+            'backend': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['rapidsms.Backend']"}),
+            'contact': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['rapidsms.Contact']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'identity': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'rapidsms.contact': {
+            'Meta': {'object_name': 'Contact'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.CharField', [], {'max_length': '6', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'})
+        },
+        'rapidsms_httprouter.deliveryerror': {
+            'Meta': {'object_name': 'DeliveryError'},
+            'created_on': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log': ('django.db.models.fields.TextField', [], {}),
+            'message': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'errors'", 'to': "orm['rapidsms_httprouter.Message']"})
+        },
+        'rapidsms_httprouter.message': {
+            'Meta': {'object_name': 'Message'},
+            'application': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True'}),
+            'batch': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'messages'", 'null': 'True', 'to': "orm['rapidsms_httprouter.MessageBatch']"}),
+            'connection': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'messages'", 'to': "orm['rapidsms.Connection']"}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'direction': ('django.db.models.fields.CharField', [], {'max_length': '1', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'in_response_to': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'responses'", 'null': 'True', 'to': "orm['rapidsms_httprouter.Message']"}),
+            'priority': ('django.db.models.fields.IntegerField', [], {'default': '10', 'db_index': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '1', 'db_index': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {'db_index': 'True'})
+        },
+        'rapidsms_httprouter.messagebatch': {
+            'Meta': {'object_name': 'MessageBatch'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '15', 'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '1'})
+        }
+    }
+
+    complete_apps = ['rapidsms_httprouter']
\ No newline at end of file
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.conf import settings
+from django.db import models
+
+
+class Migration(SchemaMigration):
+    """
+    Replaces the btree on message text, which only slowed down inserts, with indexes
+    matching the queries we actually run.  Set ROUTER_TRIGRAM_INDEX to also index text
+    for the console's icontains searches, this needs the pg_trgm extension.
+    """
+
+    def forwards(self, orm):
+        # Removing index on 'Message', fields ['text']
+        if db.backend_name == 'sqlite3':
+            # South rebuilds SQLite tables to add columns, losing their indexes along the way
+            db.execute('DROP INDEX IF EXISTS "%s"' % db.create_index_name('rapidsms_httprouter_message', ['text']))
+        else:
+            db.delete_index('rapidsms_httprouter_message', ['text'])
+
+        if db.backend_name == 'postgres':
+            # Django also gave text a text_pattern_ops index on Postgres
+            db.execute('DROP INDEX IF EXISTS "rapidsms_httprouter_message_text_like"')
+
+        # finding queued messages to send, in priority order
+        db.create_index('rapidsms_httprouter_message', ['direction', 'status', 'priority'])
+
+        # QoS checks for recent messages on a connection
+        db.create_index('rapidsms_httprouter_message', ['connection_id', 'direction', 'date'])
+
+        if db.backend_name == 'postgres' and getattr(settings, 'ROUTER_TRIGRAM_INDEX', False):
+            # icontains lookups are UPPER(text::text) LIKE UPPER(%s) on Postgres
+            db.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            db.execute('CREATE INDEX "rapidsms_httprouter_message_text_trgm" ON "rapidsms_httprouter_message" '
+                       'USING gin (UPPER("text"::text) gin_trgm_ops)')
+
+
+    def backwards(self, orm):
+        if db.backend_name == 'postgres':
+            db.execute('DROP INDEX IF EXISTS "rapidsms_httprouter_message_text_trgm"')
+
+        db.delete_index('rapidsms_httprouter_message', ['connection_id', 'direction', 'date'])
+        db.delete_index('rapidsms_httprouter_message', ['direction', 'status', 'priority'])
+
+        # Adding index on 'Message', fields ['text']
+        db.create_index('rapidsms_httprouter_message', ['text'])
+
+
+    models = {
+        'rapidsms.backend': {
+            'Meta': {'object_name': 'Backend'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '20'})
+        },
+        'rapidsms.connection': {
+            'Meta': {'object_name': 'Connection'},
+            'backend': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['rapidsms.Backend']"}),
+            'contact': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['rapidsms.Contact']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'identity': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'rapidsms.contact': {
+            'Meta': {'object_name': 'Contact'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.CharField', [], {'max_length': '6', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'})
+        },
+        'rapidsms_httprouter.deliveryerror': {
+            'Meta': {'object_name': 'DeliveryError'},
+            'created_on': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log': ('django.db.models.fields.TextField', [], {}),
+            'message': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'errors'", 'to': "orm['rapidsms_httprouter.Message']"})
+        },
+        'rapidsms_httprouter.message': {
+            'Meta': {'object_name': 'Message'},
+            'application': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True'}),
+            'batch': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'messages'", 'null': 'True', 'to': "orm['rapidsms_httprouter.MessageBatch']"}),
+            'connection': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'messages'", 'to': "orm['rapidsms.Connection']"}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'delivered': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'direction': ('django.db.models.fields.CharField', [], {'max_length': '1', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'in_response_to': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'responses'", 'null': 'True', 'to': "orm['rapidsms_httprouter.Message']"}),
+            'lease_expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'priority': ('django.db.models.fields.IntegerField', [], {'default': '10', 'db_index': 'True'}),
+            'retry_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '1', 'db_index': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {})
+        },
+        'rapidsms_httprouter.messagebatch': {
+            'Meta': {'object_name': 'MessageBatch'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '15', 'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '1'})
+        }
+    }
+
+    complete_apps = ['rapidsms_httprouter']
\ No newline at end of file
@@ -1,11 +1,16 @@
 import datetime
 from django.db import models, transaction
+from django.db.models import Min
+from django.db.models.expressions import ExpressionNode
+from django.db.models.query import QuerySet, ValuesQuerySet
 #import django
 import django.dispatch
 from django.db import connection as db_connection
-from rapidsms.models import Contact, Connection
+from rapidsms.models import Backend, Contact, Connection
 
 from .managers import ForUpdateManager
+from .pgcopy import CopyFile, copy_escape
+from .templating import TextTemplate
 from django.conf import settings
 
 mass_text_sent = django.dispatch.Signal(providing_args=["messages", "status"])
@@ -26,9 +31,20 @@ STATUS_CHOICES = (
     ('D', "Delivered"),
 
     ('C', "Cancelled"),
-    ('E', "Errored")
+    ('E', "Errored"),
+    ('F', "Failed")
 )
 
+# what each Kannel delivery report type means for a message's status, buffered
+# (4) reports leave the status as it is
+DLR_STATUSES = {
+    1: 'D',     # delivered to the phone
+    2: 'F',     # failed to deliver
+    4: None,    # buffered by the smsc
+    8: 'S',     # accepted by the smsc
+    16: 'F',    # rejected by the smsc
+}
+
 # <<<<<<< HEAD
 # class Message(models.Model):
 #     connection = models.ForeignKey(Connection, related_name='messages')
@@ -55,9 +71,39 @@ class MessageBatch(models.Model):
     status = models.CharField(max_length=1, choices=STATUS_CHOICES)
     name = models.CharField(max_length=15,null=True,blank=True)
 
+    # how many messages mass_text created in this batch, and how many recipients it left out
+    # as they repeated an earlier recipient or were on our suppression list
+    message_count = models.IntegerField(null=True, blank=True)
+    duplicate_count = models.IntegerField(null=True, blank=True)
+    suppressed_count = models.IntegerField(null=True, blank=True)
+
+class Suppression(models.Model):
+    """
+    A number which has opted out of mass texts, see suppression.py.  Identities are stored
+    normalized, like those of connections, using the number rules of their backend.  Numbers
+    without a backend are suppressed on every backend and normalized with the default rules.
+    """
+    identity = models.CharField(max_length=100)
+    backend = models.ForeignKey(Backend, null=True, blank=True,
+                                help_text="The backend this number opted out on, leave blank for all backends")
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('identity', 'backend')
+
+    def __unicode__(self):
+        return self.identity
+
+    def save(self, *args, **kwargs):
+        from .normalizer import get_normalizer
+        self.identity = get_normalizer().normalize(self.identity, self.backend.name if self.backend_id else None)
+        super(Suppression, self).save(*args, **kwargs)
+
 class Message(models.Model):
+    # besides the indexes declared here, migration 0005 adds composite indexes on
+    # (direction, status, priority) and (connection, direction, date)
     connection = models.ForeignKey(Connection, related_name='messages')
-    text = models.TextField(db_index=True)
+    text = models.TextField()
     direction = models.CharField(max_length=1, choices=DIRECTION_CHOICES, db_index=True)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, db_index=True)
     date = models.DateTimeField(auto_now_add=True)
@@ -67,6 +113,16 @@ class Message(models.Model):
     application = models.CharField(max_length=100, null=True)
 
     batch = models.ForeignKey(MessageBatch, related_name='messages', null=True)
+
+    # when a worker's claim on this message runs out, see ForUpdateQuerySet.claim
+    lease_expires = models.DateTimeField(null=True, blank=True)
+
+    # when the backend reported this message as delivered
+    delivered = models.DateTimeField(null=True, blank=True)
+
+    # how many times sending this message has failed, each failure also logs a DeliveryError
+    retry_count = models.IntegerField(default=0)
+
     # set our manager to our update manager
     objects = ForUpdateManager()
 
@@ -78,12 +134,353 @@ class Message(models.Model):
         to_from = (self.direction == "I") and "to" or "from"
         return "%s (%s %s)" % (str, to_from, self.connection.identity)
 
+    def transition(self, from_statuses, to_status, **fields):
+        """
+        Moves this message to ``to_status`` if it is still in one of ``from_statuses``, along
+        with any other fields passed in, such as timestamps.  This is a single conditional
+        UPDATE of just those columns, so concurrent transitions can't both succeed.  Returns
+        whether the message was moved, in which case this instance is updated to match.
+        """
+        fields['status'] = to_status
+        updated = Message.objects.filter(pk=self.pk, status__in=list(from_statuses)).update(**fields)
+
+        if updated:
+            for name, value in fields.items():
+                # expressions like F('retry_count') + 1 are left for the caller to reload
+                if not isinstance(value, ExpressionNode):
+                    setattr(self, name, value)
+
+        return bool(updated)
+
     def as_json(self):
         return dict(id=self.pk,
                     contact=self.connection.identity, backend=self.connection.backend.name,
                     direction=self.direction, status=self.status, text=self.text,
                     date=self.date.isoformat())
 
+    @classmethod
+    def insert_batch(cls, rows):
+        """
+        Inserts the passed in rows, each a dict of column values, returning the ids of the new
+        messages in the same order.  On Postgres this is a single multi-row insert, other
+        databases fall back to one insert per row.
+        """
+        if not rows:
+            return []
+
+        now = datetime.datetime.now()
+        for row in rows:
+            row.setdefault('date', now)
+            row.setdefault('priority', 10)
+            row.setdefault('retry_count', 0)
+
+        if db_connection.vendor != 'postgresql':
+            return [cls.objects.create(**row).pk for row in rows]
+
+        columns = sorted(rows[0].keys())
+        placeholders = "(%s)" % ", ".join(["%s"] * len(columns))
+        params = []
+        for row in rows:
+            params += [row[column] for column in columns]
+
+        sql = 'insert into rapidsms_httprouter_message (%s) values %s returning id' % \
+              (", ".join(columns), ",".join([placeholders] * len(rows)))
+
+        c = db_connection.cursor()
+        c.execute(sql, params)
+        pks = [row[0] for row in c.fetchall()]
+        transaction.commit_unless_managed()
+        return pks
+
+    @classmethod
+    def mass_text(cls, text, connections, status='P', batch_status='Q'):
+        """
+        Creates a message with the passed in text to each of the passed in connections in a new
+        MessageBatch, returning a queryset of the new messages.  See ``mass_text_batch``.
+        """
+        return cls.mass_text_batch(text, connections, status=status, batch_status=batch_status)[1]
+
+    @classmethod
+    def mass_text_batch(cls, text, connections, status='P', batch_status='Q', chunk_size=None):
+        """
+        Creates a message with the passed in text to each of the passed in connections, which
+        can be a queryset of connections or any iterable of connections or their ids.  Each
+        number is only sent one message, however many times it appears, and numbers on our
+        suppression list aren't sent any.
+
+        Querysets of connections are never loaded, instead their messages are created by the
+        database with a single INSERT ... SELECT.  Other connections, and sliced querysets, are
+        inserted ``chunk_size`` at a time, ROUTER_MASS_TEXT_CHUNK_SIZE by default, or on
+        Postgres with a single COPY when ROUTER_MASS_TEXT_COPY is set.  The new messages are then passed through our apps'
+        outgoing phase in bulk, as for ``mass_text_template``.
+
+        Returns the new MessageBatch, whose ``message_count`` is the number of messages we
+        created, ``duplicate_count`` and ``suppressed_count`` the number of recipients we left
+        out, and a queryset of its messages.
+        """
+        batch = cls._insert_mass_text(text, connections, status, batch_status, chunk_size)
+        messages = cls.objects.filter(batch=batch)
+
+        # queued messages are sent right away if we have somewhere to send them, now that
+        # they are committed and our tasks can see them
+        if status == 'Q' and getattr(settings, 'ROUTER_URL', None):
+            cls.send_all(messages.filter(status='Q').values_list('pk', flat=True).iterator())
+
+        return batch, messages
+
+    @classmethod
+    def connection_rows(cls, recipients, chunk_size):
+        """
+        Yields (id, backend id, identity, variables) for each of the passed in (connection,
+        variables) pairs, where the connection can be a Connection or its id.  Ids are looked
+        up ``chunk_size`` at a time.
+        """
+        pending = []
+        for connection, variables in recipients:
+            if isinstance(connection, Connection):
+                yield connection.pk, connection.backend_id, connection.identity, variables
+            else:
+                pending.append((connection, variables))
+
+            if len(pending) >= chunk_size:
+                for row in cls.lookup_connections(pending):
+                    yield row
+                pending = []
+
+        for row in cls.lookup_connections(pending):
+            yield row
+
+    @classmethod
+    def lookup_connections(cls, pending):
+        if not pending:
+            return []
+
+        found = dict((pk, (backend_id, identity)) for pk, backend_id, identity in
+                     Connection.objects.filter(pk__in=[pk for pk, variables in pending]).values_list('pk', 'backend', 'identity'))
+        return [(pk,) + found[pk] + (variables,) for pk, variables in pending if pk in found]
+
+    @classmethod
+    def recipient_ids(cls, connections, batch, chunk_size):
+        """
+        Yields the ids of the passed in connections we should send to, reading querysets of
+        connections from the database as we go rather than loading them all.  See
+        ``recipient_rows``.
+        """
+        # sliced querysets can't be reordered, so they are read as they are below
+        if cls.is_connection_queryset(connections) and connections.query.can_filter():
+            rows = ((pk, backend_id, identity, None) for pk, backend_id, identity in
+                    connections.order_by().values_list('pk', 'backend', 'identity').iterator())
+        else:
+            if isinstance(connections, QuerySet):
+                connections = connections.iterator()
+            rows = cls.connection_rows(((connection, None) for connection in connections), chunk_size)
+
+        for pk, variables in cls.recipient_rows(rows, batch):
+            yield pk
+
+    @classmethod
+    def recipient_rows(cls, rows, batch):
+        """
+        Yields (id, variables) for each of the passed in (id, backend id, identity, variables)
+        rows we should send to.
+
+        Connections with the same normalized identity and backend as one before them, including
+        repeats of the same connection, are counted as duplicates on the batch and skipped, as
+        are those on our suppression list.
+        """
+        from .suppression import get_suppression_list
+        from .normalizer import get_normalizer
+
+        suppressions = get_suppression_list()
+        normalizer = get_normalizer()
+        backend_names = dict(Backend.objects.values_list('pk', 'name'))
+
+        seen = set()
+        for pk, backend_id, identity, variables in rows:
+            normalized = normalizer.normalize(identity, backend_names.get(backend_id))
+            if (backend_id, normalized) in seen:
+                batch.duplicate_count += 1
+                continue
+            seen.add((backend_id, normalized))
+
+            if suppressions.contains(normalized, backend_id):
+                batch.suppressed_count += 1
+                continue
+
+            yield pk, variables
+
+    @classmethod
+    def suppressed_sql(cls):
+        """
+        Returns a condition on the connections table matching connections whose identity is
+        suppressed, either on every backend or on their own.
+        """
+        qn = db_connection.ops.quote_name
+        suppression, connection = qn(Suppression._meta.db_table), qn(Connection._meta.db_table)
+        return "EXISTS (SELECT 1 FROM %(suppression)s WHERE %(suppression)s.%(identity)s = %(connection)s.%(identity)s " \
+               "AND (%(suppression)s.%(backend)s IS NULL OR %(suppression)s.%(backend)s = %(connection)s.%(backend)s))" % \
+               dict(suppression=suppression, connection=connection, identity=qn('identity'), backend=qn('backend_id'))
+
+    @classmethod
+    def is_connection_queryset(cls, connections):
+        return isinstance(connections, QuerySet) and connections.model is Connection and \
+               not isinstance(connections, ValuesQuerySet)
+
+    @classmethod
+    @transaction.commit_on_success
+    def _insert_mass_text(cls, text, connections, status, batch_status, chunk_size):
+        batch = MessageBatch.objects.create(status=batch_status, message_count=0, duplicate_count=0, suppressed_count=0)
+        date = db_connection.ops.value_to_db_datetime(datetime.datetime.now())
+        columns = ('text', 'date', 'direction', 'status', 'batch_id', 'connection_id', 'priority', 'retry_count')
+        cursor = db_connection.cursor()
+
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'ROUTER_MASS_TEXT_CHUNK_SIZE', 1000)
+
+        # sliced querysets can't be reordered or grouped, they are streamed in like lists
+        if cls.is_connection_queryset(connections) and connections.db == cls.objects.db and connections.query.can_filter():
+            from .suppression import get_suppression_list
+
+            # the database picks the first connection for each identity on each backend, leaves
+            # out suppressed identities and inserts their messages, all in one statement
+            candidates = connections.order_by()
+            suppressed = cls.suppressed_sql()
+            recipients = candidates.extra(where=["NOT %s" % suppressed]).values('backend', 'identity').annotate(first_id=Min('pk'))
+
+            select, params = recipients.query.get_compiler(connections.db).as_sql()
+            cursor.execute("INSERT INTO %s (%s) SELECT %%s, %%s, 'O', %%s, %%s, recipients.first_id, 10, 0 FROM (%s) AS recipients" %
+                           (cls._meta.db_table, ", ".join(columns), select), [text, date, status, batch.pk] + list(params))
+            batch.message_count = cursor.rowcount
+
+            # only count suppressions if there can be any
+            if len(get_suppression_list()):
+                batch.suppressed_count = candidates.extra(where=[suppressed]).values('backend', 'identity').distinct().count()
+            batch.duplicate_count = candidates.count() - batch.suppressed_count - batch.message_count
+
+        elif db_connection.vendor == 'postgresql' and getattr(settings, 'ROUTER_MASS_TEXT_COPY', False):
+            # every row is the same but for its connection id
+            before = u"\t".join([copy_escape(text), date, u'O', copy_escape(status), unicode(batch.pk), u'']).encode('utf-8')
+            after = "\t10\t0\n"
+            rows = CopyFile("%s%d%s" % (before, pk, after) for pk in cls.recipient_ids(connections, batch, chunk_size))
+            cursor.copy_from(rows, cls._meta.db_table, columns=columns)
+            batch.message_count = rows.lines_read
+
+        else:
+            if db_connection.vendor == 'postgresql':
+                # the text is only sent once per chunk, the database repeats it for each connection
+                sql = "INSERT INTO %s (%s) SELECT %%s, %%s, 'O', %%s, %%s, connection_id, 10, 0 FROM unnest(%%s) AS connection_id" % \
+                      (cls._meta.db_table, ", ".join(columns))
+                insert = lambda ids: cursor.execute(sql, [text, date, status, batch.pk, ids])
+            else:
+                sql = "INSERT INTO %s (%s) VALUES (%%s, %%s, 'O', %%s, %%s, %%s, 10, 0)" % (cls._meta.db_table, ", ".join(columns))
+                insert = lambda ids: cursor.executemany(sql, [(text, date, status, batch.pk, pk) for pk in ids])
+
+            ids = []
+            for pk in cls.recipient_ids(connections, batch, chunk_size):
+                ids.append(pk)
+                if len(ids) >= chunk_size:
+                    insert(ids)
+                    batch.message_count += len(ids)
+                    ids = []
+            if ids:
+                insert(ids)
+                batch.message_count += len(ids)
+
+        cls.release_batch(batch, status)
+        return batch
+
+    @classmethod
+    def release_batch(cls, batch, status):
+        """
+        Records the counts on the passed in batch, whose messages have just been inserted with
+        the passed in status, then passes its messages through our apps' outgoing phase in
+        bulk, see ``HttpRouter.process_outgoing_batch``.  Only the messages apps cancel are
+        updated, and only if some app has an outgoing phase.
+        """
+        from .router import get_router
+
+        MessageBatch.objects.filter(pk=batch.pk).update(message_count=batch.message_count,
+                                                        duplicate_count=batch.duplicate_count,
+                                                        suppressed_count=batch.suppressed_count)
+
+        get_router().process_outgoing_batches(cls.objects.filter(batch=batch))
+
+        mass_text_sent.send(sender=batch, messages=cls.objects.filter(batch=batch), status=status)
+
+    @classmethod
+    def mass_text_template(cls, template, recipients, status='P', batch_status='Q', chunk_size=None):
+        """
+        Creates a personalised message to each of the passed in recipients in a new
+        MessageBatch, rendering the passed in template, a TextTemplate or its text, with the
+        variables for each recipient.
+
+        Recipients are (connection, variables) pairs, the connection either a Connection or
+        its id, or dicts of variables with the connection id under 'connection', such as a
+        values queryset.  For a values queryset of connections the id is taken from 'id'.
+        As with ``mass_text_batch`` each number is only sent one message and suppressed
+        numbers none.
+
+        Messages are inserted ``chunk_size`` at a time, ROUTER_MASS_TEXT_CHUNK_SIZE by default,
+        with the passed in status, then passed through our apps' outgoing phase in bulk, see
+        ``HttpRouter.process_outgoing_batch``.
+
+        Returns the new MessageBatch and a queryset of its messages.
+        """
+        if not isinstance(template, TextTemplate):
+            template = TextTemplate(template)
+
+        batch = cls._insert_mass_text_template(template, recipients, status, batch_status, chunk_size)
+        messages = cls.objects.filter(batch=batch)
+
+        if status == 'Q' and getattr(settings, 'ROUTER_URL', None):
+            cls.send_all(messages.filter(status='Q').values_list('pk', flat=True).iterator())
+
+        return batch, messages
+
+    @classmethod
+    @transaction.commit_on_success
+    def _insert_mass_text_template(cls, template, recipients, status, batch_status, chunk_size):
+        batch = MessageBatch.objects.create(status=batch_status, message_count=0, duplicate_count=0, suppressed_count=0)
+        date = db_connection.ops.value_to_db_datetime(datetime.datetime.now())
+        columns = ('text', 'date', 'direction', 'status', 'batch_id', 'connection_id', 'priority', 'retry_count')
+        placeholders = "(%s, %s, 'O', %s, %s, %s, 10, 0)"
+        cursor = db_connection.cursor()
+
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'ROUTER_MASS_TEXT_CHUNK_SIZE', 1000)
+
+        if isinstance(recipients, ValuesQuerySet):
+            key = 'id' if recipients.model is Connection else 'connection'
+            recipients = ((row[key], row) for row in recipients.iterator())
+        else:
+            recipients = ((recipient['connection'], recipient) if isinstance(recipient, dict) else recipient
+                          for recipient in recipients)
+
+        def insert(rows):
+            if db_connection.vendor == 'postgresql':
+                params = []
+                for row in rows:
+                    params += row
+                cursor.execute("INSERT INTO %s (%s) VALUES %s" % (cls._meta.db_table, ", ".join(columns),
+                                                                  ", ".join([placeholders] * len(rows))), params)
+            else:
+                cursor.executemany("INSERT INTO %s (%s) VALUES %s" % (cls._meta.db_table, ", ".join(columns), placeholders), rows)
+            batch.message_count += len(rows)
+
+        # rendering is the only per recipient work done in Python
+        render = template.render
+        rows = []
+        for pk, variables in cls.recipient_rows(cls.connection_rows(recipients, chunk_size), batch):
+            rows.append((render(variables), date, status, batch.pk, pk))
+            if len(rows) >= chunk_size:
+                insert(rows)
+                rows = []
+        if rows:
+            insert(rows)
+
+        cls.release_batch(batch, status)
+        return batch
+
     def send(self):
         """
         Triggers our celery task to send this message off.  Note that our dependency to Celery
@@ -95,6 +492,19 @@ class Message(models.Model):
         # send this message off in celery
         send_message_task.delay(self.pk)
 
+    @classmethod
+    def send_all(cls, message_ids):
+        """
+        Triggers celery tasks to send the passed in messages, ROUTER_SEND_TASK_SIZE
+        messages to a task, rather than a task per message.
+        """
+        from tasks import send_message_batch_task
+
+        size = getattr(settings, 'ROUTER_SEND_TASK_SIZE', 100)
+        message_ids = list(message_ids)
+        for i in range(0, len(message_ids), size):
+            send_message_batch_task.delay(message_ids[i:i + size])
+
 class DeliveryError(models.Model):
     """
     Simple class to keep track of delivery errors for messages.  We retry up to three times before
@@ -107,25 +517,24 @@ class DeliveryError(models.Model):
                                       help_text="When this delivery error occurred")
                                       
     @classmethod
-    @transaction.commit_on_success
     def mass_text(cls, text, connections, status='P', batch_status='Q'):
-        batch = MessageBatch.objects.create(status=batch_status)
-        sql = 'insert into rapidsms_httprouter_message (text, date, direction, status, batch_id, connection_id, priority) values '
-        insert_list = []
-        params_list = []
-        d = datetime.datetime.now()
-        c = db_connection.cursor()
-
-        for connection in connections:
-            insert_list.append("(%s, %s, 'O', %s, %s, %s, %s)")
-            params_list += [text, d, status, batch.pk, connection.pk, 10]
-
-        sql = "%s %s returning id" % (sql, ",".join(insert_list))
-        c.execute(sql, params_list)
+        """
+        Deprecated, use Message.mass_text instead.
+        """
+        return Message.mass_text(text, connections, status=status, batch_status=batch_status)
 
-        pks = c.fetchall()
-        toret = Message.objects.filter(pk__in=[pk[0] for pk in pks])
-        mass_text_sent.send(sender=batch, messages=toret, status=status)
-        return toret
 
+class MessageRollup(models.Model):
+    """
+    The number of messages sent or received each day by backend, direction and status,
+    so reports don't have to scan the messages table.  See rollups.py for how these are
+    kept up to date.
+    """
+    day = models.DateField()
+    backend = models.CharField(max_length=20)
+    direction = models.CharField(max_length=1, choices=DIRECTION_CHOICES)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES)
+    count = models.IntegerField(default=0)
 
+    class Meta:
+        unique_together = ('day', 'backend', 'direction', 'status')
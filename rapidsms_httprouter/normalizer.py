@@ -0,0 +1,131 @@
+"""
+Normalizes the identities of senders and recipients, so the same subscriber always maps to
+the same Connection however their number was written.
+
+Everything but digits and lower case letters is stripped, then numbers can be put in their
+international form using rules configured per backend name::
+
+    ROUTER_NUMBER_RULES = {
+        'default': {'country_code': '256', 'national_length': 9},
+        'safaricom': {'country_code': '254', 'trunk_prefix': '0'},
+    }
+
+With the rules above ``0772000001``, ``256772000001`` and ``+256 772 000001`` all become
+``256772000001`` on the default backends.  A 'default' entry applies to any backend not
+listed, backends without rules are only stripped.
+"""
+import re
+import string
+from threading import Lock
+
+from django.conf import settings
+
+class StripMap(dict):
+    """
+    A translation table for unicode.translate which lower cases letters and drops everything
+    but digits and letters, filling itself in as new characters are seen.
+    """
+    def __missing__(self, key):
+        value = re.sub(u'[^0-9a-z]', u'', unichr(key).lower()) or None
+        self[key] = value
+        return value
+
+class NumberNormalizer(object):
+    """
+    Strips and applies our rules to identities, remembering up to ``cache_size`` recent
+    results.  The memo is a plain dict, emptied once full, as looking up a number in it has
+    to cost less than normalizing it again.
+    """
+    # str.translate lower cases with the first, then drops the characters in the second
+    BYTES_TABLE = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+    BYTES_DELETE = "".join([chr(i) for i in range(256) if chr(i) not in string.digits + string.ascii_letters])
+
+    def __init__(self, rules=None, cache_size=10000):
+        self.rules = rules or {}
+        self.cache_size = cache_size
+        self._memo = {}
+        self._unicode_table = StripMap()
+
+    def strip(self, number):
+        """
+        Lower cases the passed in number, dropping everything but digits and letters.
+        """
+        if isinstance(number, unicode):
+            return number.translate(self._unicode_table)
+        return number.translate(self.BYTES_TABLE, self.BYTES_DELETE)
+
+    def apply_rules(self, number, rules, international=False):
+        """
+        Puts the passed in stripped number in its international form according to our rules,
+        numbers with letters in them are left alone.
+        """
+        if not number.isdigit():
+            return number
+
+        country_code = rules.get('country_code')
+        if not country_code:
+            return number
+
+        international_prefix = rules.get('international_prefix', '00')
+        if international_prefix and number.startswith(international_prefix):
+            return number[len(international_prefix):]
+
+        national_length = rules.get('national_length')
+        if international:
+            return number
+        if number.startswith(country_code) and \
+           (national_length is None or len(number) == len(country_code) + national_length):
+            return number
+
+        trunk_prefix = rules.get('trunk_prefix', '0')
+        if trunk_prefix and number.startswith(trunk_prefix):
+            national = number[len(trunk_prefix):]
+            if national_length is None or len(national) == national_length:
+                return country_code + national
+        elif national_length is not None and len(number) == national_length:
+            return country_code + number
+
+        return number
+
+    def normalize(self, number, backend=None):
+        """
+        Returns the normalized form of the passed in number as sent or received on the
+        named backend.
+        """
+        key = (backend, number)
+        normalized = self._memo.get(key)
+        if normalized is not None:
+            return normalized
+
+        normalized = self.strip(number)
+        rules = self.rules.get(backend, self.rules.get('default'))
+        if rules:
+            normalized = self.apply_rules(normalized, rules, international=number.lstrip().startswith('+'))
+
+        if self.cache_size > 0:
+            if len(self._memo) >= self.cache_size:
+                self._memo.clear()
+            self._memo[key] = normalized
+
+        return normalized
+
+    def clear(self):
+        self._memo.clear()
+
+
+_normalizer = None
+_normalizer_lock = Lock()
+
+def get_normalizer():
+    """
+    Returns the number normalizer for this process, configured by ROUTER_NUMBER_RULES.
+    """
+    global _normalizer
+
+    # we're called for every message, so only take the lock the first time through
+    if _normalizer is None:
+        with _normalizer_lock:
+            if _normalizer is None:
+                _normalizer = NumberNormalizer(rules=getattr(settings, 'ROUTER_NUMBER_RULES', None),
+                                               cache_size=getattr(settings, 'ROUTER_NORMALIZER_CACHE_SIZE', 10000))
+    return _normalizer
@@ -0,0 +1,142 @@
+"""
+Paginators for the message tables, where an exact COUNT(*) can take longer than
+fetching the page itself.
+"""
+import re
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+
+def estimate_count(queryset):
+    """
+    Returns the planner's estimate of how many rows the passed in queryset matches on
+    Postgres, or None when we can't estimate, in which case callers should count.
+    """
+    db_connection = connections[queryset.db]
+    if db_connection.vendor != 'postgresql':
+        return None
+
+    cursor = db_connection.cursor()
+    if not queryset.query.where and not queryset.query.extra:
+        # the whole table, as of the last vacuum or analyze
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[0] > 0:
+            return int(row[0])
+        return None
+
+    sql, params = queryset.values('pk').query.get_compiler(queryset.db).as_sql()
+    cursor.execute("EXPLAIN %s" % sql, params)
+    match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+    if match:
+        return int(match.group(1))
+    return None
+
+def count_up_to(queryset, limit):
+    """
+    Counts the rows the passed in queryset matches, stopping once there are more than
+    ``limit``.  Counting a sliced queryset counts all of its rows, so the limit is applied
+    to a subquery instead.
+    """
+    sql, params = queryset.order_by().values('pk')[:limit + 1].query.get_compiler(queryset.db).as_sql()
+    cursor = connections[queryset.db].cursor()
+    cursor.execute("SELECT COUNT(*) FROM (%s) AS limited" % sql, params)
+    return cursor.fetchone()[0]
+
+def fast_count(queryset):
+    """
+    Counts the passed in queryset exactly up to ROUTER_EXACT_COUNT_LIMIT rows, beyond that
+    we return the database's estimate where it can give us one.
+    """
+    # sliced querysets can't be reordered, but are never larger than their slice anyway
+    if not queryset.query.can_filter():
+        return queryset.count()
+
+    # counting up to our limit is cheap, only estimate beyond it
+    limit = getattr(settings, 'ROUTER_EXACT_COUNT_LIMIT', 1000)
+    count = count_up_to(queryset, limit)
+    if count <= limit:
+        return count
+
+    estimate = estimate_count(queryset)
+    if estimate is None:
+        return queryset.count()
+    return max(count, estimate)
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A Paginator whose count is the database's estimate once there are more than
+    ROUTER_EXACT_COUNT_LIMIT results, so smaller result sets still page exactly.
+    """
+    def _get_count(self):
+        if self._count is None:
+            if hasattr(self.object_list, 'query'):
+                self._count = fast_count(self.object_list)
+            else:
+                self._count = super(EstimatedCountPaginator, self)._get_count()
+        return self._count
+    count = property(_get_count)
+
+def get_int(params, key):
+    """
+    Returns the passed in parameter as an int, or None if it is missing or invalid.
+    """
+    try:
+        return int(params.get(key, None))
+    except (TypeError, ValueError):
+        return None
+
+class KeysetPage(object):
+    """
+    A page of results, newest first.  ``next_before`` and ``previous_after`` are the ids
+    to pass back in to get the next (older) and previous (newer) pages.
+    """
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+        self.next_before = object_list[-1].pk if object_list else None
+        self.previous_after = object_list[0].pk if object_list else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+class KeysetPaginator(object):
+    """
+    Pages through a queryset by id, newest first.  Rather than an OFFSET, which has to
+    walk past every earlier row, each page picks up from an id of the page before it.
+    """
+    def __init__(self, object_list, per_page):
+        self.object_list = object_list
+        self.per_page = per_page
+        self._count = None
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = fast_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+    def page(self, before=None, after=None):
+        """
+        Returns the page of results older than ``before``, or newer than ``after``, or the
+        newest results if neither is given.
+        """
+        if after is not None:
+            results = list(self.object_list.filter(pk__gt=after).order_by('pk')[:self.per_page + 1])
+            has_previous = len(results) > self.per_page
+            results = results[:self.per_page]
+            results.reverse()
+            return KeysetPage(results, True, has_previous)
+
+        results = self.object_list.order_by('-pk')
+        if before is not None:
+            results = results.filter(pk__lt=before)
+
+        results = list(results[:self.per_page + 1])
+        return KeysetPage(results[:self.per_page], len(results) > self.per_page, before is not None)
@@ -0,0 +1,46 @@
+"""
+Helpers for streaming rows into Postgres with COPY, used by mass_text to insert the
+messages of large batches.
+"""
+
+def copy_escape(value):
+    """
+    Escapes the passed in value for Postgres' COPY text format.
+    """
+    return value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+class CopyFile(object):
+    """
+    A file-like object reading from an iterator of lines, so COPY can stream rows as they
+    are generated.
+    """
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ''
+        self.lines_read = 0
+
+    def next_line(self):
+        line = self.lines.next()
+        self.lines_read += 1
+        return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += self.next_line()
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if not self.buffer:
+            try:
+                self.buffer = self.next_line()
+            except StopIteration:
+                return ''
+        line, self.buffer = self.buffer, ''
+        return line
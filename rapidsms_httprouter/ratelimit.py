@@ -0,0 +1,171 @@
+"""
+Token bucket rate limiting for outgoing messages, so we stay under the limits our
+aggregators enforce rather than hitting them and cycling messages through errors.
+
+Limits are configured per backend name, the same names used as keys in ROUTER_URL::
+
+    ROUTER_RATE_LIMITS = {
+        'mtn': (30, 1),           # 30 messages a second
+        'shortcode': (100, 60),   # 100 messages a minute
+    }
+
+A 'default' entry applies to any backend not listed, backends without a limit are never
+held up.  When REDIS_HOST is set buckets are kept in Redis, so they are shared by every
+process sending messages, otherwise each process keeps its own in memory.
+"""
+import time
+from threading import Lock
+
+from django.conf import settings
+
+class TokenBucket(object):
+    """
+    An in-memory bucket holding up to ``capacity`` tokens, refilled at ``rate`` tokens a second.
+    """
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = Lock()
+
+    def take(self, tokens):
+        """
+        Takes the passed in number of tokens if they are available, returning 0.  Otherwise
+        nothing is taken and we return how many seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+
+            return (tokens - self.tokens) / self.rate
+
+
+class RedisTokenBucket(object):
+    """
+    A bucket whose state lives in a Redis hash, updated in a WATCH / MULTI transaction so
+    processes sharing it never hand out the same token twice.
+    """
+    def __init__(self, redis, key, capacity, rate):
+        self.redis = redis
+        self.key = key
+        self.capacity = capacity
+        self.rate = rate
+
+    def take(self, tokens):
+        from redis.exceptions import WatchError
+
+        while True:
+            pipe = self.redis.pipeline()
+            try:
+                pipe.watch(self.key)
+                current, updated = pipe.hmget(self.key, ['tokens', 'updated'])
+
+                now = time.time()
+                if current is None:
+                    current = float(self.capacity)
+                else:
+                    current = min(self.capacity, float(current) + (now - float(updated)) * self.rate)
+
+                wait = 0
+                if current >= tokens:
+                    current -= tokens
+                else:
+                    wait = (tokens - current) / self.rate
+
+                pipe.multi()
+                pipe.hmset(self.key, dict(tokens=current, updated=now))
+
+                # an idle bucket is full, no need to keep it around
+                pipe.expire(self.key, int(self.capacity / self.rate) + 1)
+                pipe.execute()
+                return wait
+
+            except WatchError:
+                # someone else took tokens while we were looking, try again
+                continue
+            finally:
+                pipe.reset()
+
+
+class RateLimiter(object):
+    """
+    Hands out tokens for each backend, blocking until they are available.
+    """
+    def __init__(self, limits=None, redis=None):
+        if limits is None:
+            limits = getattr(settings, 'ROUTER_RATE_LIMITS', {})
+
+        self.limits = limits
+        self.redis = redis
+        self.waited = 0.0
+        self._buckets = {}
+        self._lock = Lock()
+
+    def bucket(self, backend_name):
+        """
+        Returns the bucket for the passed in backend, or None if it isn't limited.
+        """
+        with self._lock:
+            if backend_name not in self._buckets:
+                limit = self.limits.get(backend_name, self.limits.get('default', None))
+                if limit is None:
+                    bucket = None
+                else:
+                    count, seconds = limit
+                    rate = float(count) / seconds
+                    if self.redis is not None:
+                        bucket = RedisTokenBucket(self.redis, 'rapidsms_httprouter_rate_%s' % backend_name, count, rate)
+                    else:
+                        bucket = TokenBucket(count, rate)
+                self._buckets[backend_name] = bucket
+
+            return self._buckets[backend_name]
+
+    def acquire(self, backend_name, tokens=1):
+        """
+        Blocks until ``tokens`` messages can be sent on the passed in backend.  Requests for
+        more tokens than a bucket holds are taken a bucketful at a time.  Returns the number
+        of seconds we waited.
+        """
+        bucket = self.bucket(backend_name)
+        if bucket is None:
+            return 0
+
+        waited = 0
+        while tokens > 0:
+            needed = min(tokens, bucket.capacity)
+            wait = bucket.take(needed)
+            if wait:
+                time.sleep(wait)
+                waited += wait
+            else:
+                tokens -= needed
+
+        with self._lock:
+            self.waited += waited
+        return waited
+
+
+_limiter = None
+_limiter_lock = Lock()
+
+def get_rate_limiter():
+    """
+    Returns the rate limiter for this process, backed by Redis if REDIS_HOST is set.
+    """
+    global _limiter
+
+    with _limiter_lock:
+        if _limiter is None:
+            redis = None
+            if getattr(settings, 'REDIS_HOST', None) and getattr(settings, 'ROUTER_RATE_LIMITS', None):
+                import redis as redis_module
+                redis = redis_module.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+            _limiter = RateLimiter(redis=redis)
+        return _limiter
@@ -0,0 +1,145 @@
+"""
+Keeps MessageRollup, our daily message counts, up to date.  Rather than counting as
+messages come in, which would add writes to every message, each day is recounted as a
+whole.  Recent days are recounted regularly by compact_rollups, as their messages
+still change status, older days only when backfilling with the router_rollup command.
+
+Message ids grow with their dates, so we find where a day starts with a binary search
+over ids, then count the day's messages by id range.  Neither needs an index on date.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min
+
+from .models import Message, MessageRollup
+
+def first_id_on_or_after(when, low=None, high=None):
+    """
+    Returns the id of the first message sent or received on or after the passed in
+    datetime, or None if there are none.  Pass ``low`` and ``high`` to only look at
+    messages within those ids.
+    """
+    if low is None or high is None:
+        bounds = Message.objects.aggregate(low=Min('pk'), high=Max('pk'))
+        low, high = low or bounds['low'], high or bounds['high']
+        if low is None:
+            return None
+
+    # narrow in on the first id at or after when, looking at the first message with an id
+    # at or above the middle of our range as ids may have gaps
+    first = None
+    while low <= high:
+        middle = (low + high) // 2
+        found = Message.objects.filter(pk__gte=middle).order_by('pk').values_list('pk', 'date')[:1]
+        if not found:
+            high = middle - 1
+            continue
+
+        pk, date = found[0]
+        if date >= when:
+            first = pk
+            high = middle - 1
+        else:
+            low = pk + 1
+
+    return first
+
+@transaction.commit_on_success
+def rollup_day(day):
+    """
+    Recounts the messages of the passed in day, replacing any rollups we had for it.
+    Returns the number of messages counted.
+    """
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+
+    MessageRollup.objects.filter(day=day).delete()
+
+    first = first_id_on_or_after(start)
+    if first is None:
+        return 0
+
+    messages = Message.objects.filter(pk__gte=first)
+    last = first_id_on_or_after(end, low=first)
+    if last is not None:
+        messages = messages.filter(pk__lt=last)
+
+    total = 0
+    for row in messages.values('connection__backend__name', 'direction', 'status').annotate(count=Count('id')):
+        MessageRollup.objects.create(day=day, backend=row['connection__backend__name'], direction=row['direction'],
+                                     status=row['status'], count=row['count'])
+        total += row['count']
+
+    return total
+
+def rollup_days(start, end):
+    """
+    Recounts every day from start to end, inclusive, skipping over days without any
+    messages.  Returns the number of messages counted.
+    """
+    total = 0
+    day = start
+    while day <= end:
+        total += rollup_day(day)
+
+        # jump straight to the day of the next message, clearing any rollups in between
+        next_day = day + datetime.timedelta(days=1)
+        next_id = first_id_on_or_after(datetime.datetime.combine(next_day, datetime.time()))
+        if next_id is None:
+            skip_to = end + datetime.timedelta(days=1)
+        else:
+            skip_to = max(next_day, Message.objects.get(pk=next_id).date.date())
+
+        if skip_to > next_day:
+            MessageRollup.objects.filter(day__gte=next_day, day__lt=min(skip_to, end + datetime.timedelta(days=1))).delete()
+            transaction.commit_unless_managed()
+        day = skip_to
+
+    return total
+
+def compact_rollups(days=None):
+    """
+    Brings our rollups up to date, recounting the last ROUTER_ROLLUP_DAYS days we counted
+    along with any days since.  With no rollups yet, all of history is counted.
+    """
+    if days is None:
+        days = getattr(settings, 'ROUTER_ROLLUP_DAYS', 2)
+
+    today = datetime.date.today()
+    latest = MessageRollup.objects.aggregate(latest=Max('day'))['latest']
+    if latest is not None:
+        start = min(latest, today - datetime.timedelta(days=days - 1))
+    else:
+        first = Message.objects.order_by('pk').values_list('date', flat=True)[:1]
+        if not first:
+            return
+        start = first[0].date()
+
+    rollup_days(start, today)
+
+def period_start(day, granularity):
+    if granularity == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    elif granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def summarize(granularity='month', start=None, end=None):
+    """
+    Returns our rollups totalled by period, backend and direction, as a list of
+    (period start, backend, direction, total) tuples in that order.
+    """
+    rollups = MessageRollup.objects.all()
+    if start:
+        rollups = rollups.filter(day__gte=start)
+    if end:
+        rollups = rollups.filter(day__lte=end)
+
+    totals = {}
+    for day, backend, direction, count in rollups.values_list('day', 'backend', 'direction', 'count'):
+        key = (period_start(day, granularity), backend, direction)
+        totals[key] = totals.get(key, 0) + count
+
+    return [key + (total,) for key, total in sorted(totals.items())]
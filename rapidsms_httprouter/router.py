@@ -1,6 +1,10 @@
 from django.conf import settings
-from django.db import transaction
-from .models import Message
+from django.db import transaction, connection as db_connection
+from .models import Message, DLR_STATUSES
+from .cache import get_identity_cache
+from .normalizer import get_normalizer
+from .workers import get_pool
+from . import transport
 from rapidsms.models import Backend, Connection
 from rapidsms.apps.base import AppBase
 from rapidsms.messages.incoming import IncomingMessage
@@ -9,10 +13,10 @@ from rapidsms.log.mixin import LoggerMixin
 from threading import Lock, Thread
 
 from urllib import quote_plus
-from urllib2 import urlopen
 import time
 import re
 import datetime
+import logging
 import traceback
 
 def start_sending_mass_messages():
@@ -36,49 +40,44 @@ class HttpRouter(object, LoggerMixin):
         # the apps we'll run through
         self.apps = []
 
+        # the apps our dispatch table was built for, and the table itself
+        self._dispatch = (None, None)
+
         # we need to be started
         self.started = False
 
     @classmethod
     def fetch_url(cls, url, params):
         """
-        Wrapper around url open, mostly here so we can monkey patch over it in unit tests, though
-        in some cases apps may monkey patch this to deal with secondary urls.
+        Fetches the url using our pooled transport, mostly here so we can monkey patch over it
+        in unit tests, though in some cases apps may monkey patch this to deal with secondary urls.
         """
-        if getattr(settings, 'ROUTER_HTTP_METHOD', 'GET') == 'GET':
-            response = urlopen(url, timeout=15)
-        else:
-            response = urlopen(url, " ", timeout=15)
-        
-        return response
+        return transport.fetch_url(url, params)
 
     @classmethod
-    def normalize_number(cls, number):
+    def normalize_number(cls, number, backend=None):
         """
         Normalizes the passed in number, they should be only digits, some backends prepend + and
-        maybe crazy users put in dashes or parentheses in the console.
+        maybe crazy users put in dashes or parentheses in the console.  Pass the name of the
+        backend the number was seen on to apply its ROUTER_NUMBER_RULES.
         """
-        return re.sub('[^0-9a-z]', '', number.lower())
+        return get_normalizer().normalize(number, backend)
 
     def add_message(self, backend, contact, text, direction, status):
         """
         Adds this message to the db.  This is both for logging, and we also keep state
         tied to it.
         """
-        # lookup / create this backend
+        # lookup / create this backend, both it and the connection are usually already
+        # in our identity cache for repeat senders
         # TODO: is this too flexible?  Perhaps we should do this upon initialization and refuse 
         # any backends not found in our settings.  But I hate dropping messages on the floor.
-        backend, created = Backend.objects.get_or_create(name=backend)
-        contact = HttpRouter.normalize_number(contact)
+        identity_cache = get_identity_cache()
+        backend = identity_cache.get_backend(backend)
+        contact = HttpRouter.normalize_number(contact, backend.name)
 
-        # try to find a connection
-        connection = Connection.objects.filter(backend=backend, identity=contact)
-
-        # if not found, create it
-        if not connection:
-            connection = Connection.objects.create(backend=backend, identity=contact)
-        else:
-            connection = connection[0]
+        # find or create our connection
+        connection = identity_cache.get_connection(backend, contact)
 
         # force to unicode
         text = unicode(text)
@@ -92,10 +91,76 @@ class HttpRouter(object, LoggerMixin):
         """
         Marks a message as delivered by the backend.
         """
-        message = Message.objects.get(pk=message_id)
-        message.status = 'D'
-        message.delivered = datetime.datetime.now()
-        message.save()
+        updated = Message.objects.filter(pk=message_id).update(status='D', delivered=datetime.datetime.now())
+        if not updated:
+            raise Message.DoesNotExist("No message with id %s" % message_id)
+
+    def mark_delivered_batch(self, reports):
+        """
+        Applies the passed in delivery reports, a list of (message id, Kannel DLR type)
+        tuples, where a type of None means delivered.  Messages are updated with a
+        statement per resulting status, and delivered messages are never moved back
+        to sent or failed by a late report, nor reported as delivered twice.  Returns a dict with the number of messages
+        updated and the ids of those we don't know about.
+        """
+        ids = set([message_id for message_id, dlr in reports])
+        known = set(Message.objects.filter(pk__in=ids).values_list('pk', flat=True))
+
+        by_status = {}
+        for message_id, dlr in reports:
+            status = DLR_STATUSES.get(dlr, None) if dlr is not None else 'D'
+            if status and message_id in known:
+                by_status.setdefault(status, set()).add(message_id)
+
+        updated = 0
+        for status, message_ids in by_status.items():
+            messages = Message.objects.filter(pk__in=message_ids).exclude(status='D')
+            if status == 'D':
+                updated += messages.update(status='D', delivered=datetime.datetime.now())
+            else:
+                updated += messages.update(status=status)
+
+        return dict(updated=updated, unknown=sorted(ids - known))
+
+    def add_messages(self, messages, direction, status):
+        """
+        Adds the passed in messages, a list of (backend, contact, text) tuples, to the db.
+        Backends and connections are looked up with one query each and the messages
+        themselves are written with a single insert.  Returns the messages in the same order.
+        """
+        identity_cache = get_identity_cache()
+        backends = {}
+        for backend_name, contact, text in messages:
+            if backend_name not in backends:
+                backends[backend_name] = identity_cache.get_backend(backend_name)
+
+        # normalize all our identities, then find which connections already exist
+        keys = [(backends[backend_name].pk, HttpRouter.normalize_number(contact, backend_name))
+                for backend_name, contact, text in messages]
+
+        connections = {}
+        existing = Connection.objects.filter(backend__in=backends.values(),
+                                             identity__in=set([identity for backend_id, identity in keys]))
+        for connection in existing:
+            connections[(connection.backend_id, connection.identity)] = connection
+
+        # create any we are missing
+        backends_by_id = dict((backend.pk, backend) for backend in backends.values())
+        for backend_id, identity in keys:
+            if (backend_id, identity) not in connections:
+                connections[(backend_id, identity)] = Connection.objects.create(backend=backends_by_id[backend_id],
+                                                                               identity=identity)
+
+        rows = []
+        for key, (backend_name, contact, text) in zip(keys, messages):
+            rows.append(dict(connection_id=connections[key].pk,
+                             text=unicode(text),
+                             direction=direction,
+                             status=status))
+
+        pks = Message.insert_batch(rows)
+        db_messages = Message.objects.select_related('connection__backend').in_bulk(pks)
+        return [db_messages[pk] for pk in pks]
 
     def handle_incoming(self, backend, sender, text):
         """
@@ -103,29 +168,139 @@ class HttpRouter(object, LoggerMixin):
         """
         # create our db message for logging
         db_message = self.add_message(backend, sender, text, 'I', 'R')
+        return self.process_incoming_phases(db_message)
+
+    def handle_incoming_batch(self, messages):
+        """
+        Handles a list of (backend, sender, text) incoming messages.  They are all written
+        to the db at once, then each is passed through our apps.
+        """
+        db_messages = self.add_messages(messages, 'I', 'R')
+        return [self.process_incoming_phases(db_message) for db_message in db_messages]
+
+    def queue_incoming(self, backend, sender, text):
+        """
+        Records an incoming message and hands it off to be handled in the background,
+        according to our ROUTER_INCOMING_MODE setting.  The message is returned still
+        in the 'R' (Received) state.
+        """
+        db_message = self.add_message(backend, sender, text, 'I', 'R')
+        self.dispatch_incoming(db_message.pk)
+        return db_message
+
+    def queue_incoming_batch(self, messages):
+        """
+        Records a list of (backend, sender, text) incoming messages, handing each off to
+        be handled in the background.
+        """
+        db_messages = self.add_messages(messages, 'I', 'R')
+        for db_message in db_messages:
+            self.dispatch_incoming(db_message.pk)
+        return db_messages
+
+    def dispatch_incoming(self, message_id):
+        """
+        Hands the id of a received message off to Celery or to our in-process worker pool.
+        """
+        # our workers need to be able to see the message
+        transaction.commit_unless_managed()
+
+        if get_incoming_mode() == 'celery':
+            from tasks import handle_incoming
+            handle_incoming.delay(message_id)
+        else:
+            get_incoming_pool().submit(self.process_incoming_message, message_id)
+
+    def process_incoming_message(self, message_id):
+        """
+        Handles a message previously recorded by queue_incoming.  The message is moved to
+        'P' (Processing) first, so a message that is handed to us twice is only handled once,
+        with a lease of ROUTER_INCOMING_LEASE seconds, 300 by default, after which it is
+        assumed lost and can be requeued, see ``requeue_stale_incoming``.  Returns the
+        handled message, or None if it was already picked up.
+        """
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=getattr(settings, 'ROUTER_INCOMING_LEASE', 300))
+        claimed = Message.objects.filter(pk=message_id, status='R').update(status='P', lease_expires=expires)
+        if not claimed:
+            self.warning("SMS[%d] already processed, ignoring", message_id)
+            return None
 
+        db_message = Message.objects.select_related('connection__backend').get(pk=message_id)
+        return self.process_incoming_phases(db_message)
+
+    def requeue_stale_incoming(self, age=None, limit=100, dispatch=None):
+        """
+        Hands off again incoming messages which should have been handled by now, those still
+        'R' more than ``age`` seconds after they were received, ROUTER_INCOMING_STALE_AGE by
+        default, and those in 'P' whose lease has expired.  These are left behind when a
+        process dies with messages in its queue or while handling one.  Up to ``limit``
+        messages are passed to ``dispatch``, ``dispatch_incoming`` by default, returning
+        their ids.
+        """
+        if age is None:
+            age = getattr(settings, 'ROUTER_INCOMING_STALE_AGE', 300)
+        if dispatch is None:
+            dispatch = self.dispatch_incoming
+
+        now = datetime.datetime.now()
+        received = Message.objects.filter(direction='I', status='R', date__lt=now - datetime.timedelta(seconds=age))
+        expired = Message.objects.filter(direction='I', status='P', lease_expires__lt=now)
+        stale = list((received | expired).order_by('pk').values_list('pk', flat=True)[:limit])
+        if not stale:
+            return stale
+
+        # expired messages go back to 'R' so they can be claimed again, a message we hand off
+        # twice is still only handled once
+        Message.objects.filter(pk__in=stale, status='P', lease_expires__lt=now).update(status='R', lease_expires=None)
+        for message_id in stale:
+            dispatch(message_id)
+
+        self.warning("Requeued %d stale incoming messages", len(stale))
+        return stale
+
+    def incoming_queue_stats(self):
+        """
+        Returns how many incoming messages are waiting to be handled, along with the stats
+        of our worker pool when running in thread mode.
+        """
+        stats = dict(mode=get_incoming_mode(),
+                     received=Message.objects.filter(direction='I', status='R').count(),
+                     processing=Message.objects.filter(direction='I', status='P').count())
+        if stats['mode'] == 'thread':
+            stats['pool'] = get_incoming_pool().stats()
+        return stats
+
+    def process_incoming_phases(self, db_message):
+        """
+        Passes the passed in db message through the incoming phases for all our configured
+        SMS apps, sending any responses they generate.
+        """
         # and our rapidsms transient message for processing
-        msg = IncomingMessage(db_message.connection, text, db_message.date)
+        msg = IncomingMessage(db_message.connection, db_message.text, db_message.date)
         
         # add an extra property to IncomingMessage, so httprouter-aware
         # apps can make use of it during the handling phase
         msg.db_message = db_message
         
-        self.info("SMS[%d] IN (%s) : %s" % (db_message.id, msg.connection, msg.text))
+        self.info("SMS[%d] IN (%s) : %s", db_message.id, msg.connection, msg.text)
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        dispatch = self.dispatch_table()
         try:
             for phase in self.incoming_phases:
-                self.debug("In %s phase" % phase)
+                if debug:
+                    self.debug("In %s phase", phase)
                 if phase == "default":
                     if msg.handled:
-                        self.debug("Skipping phase")
+                        if debug:
+                            self.debug("Skipping phase")
                         break
 
-                for app in self.apps:
-                    self.debug("In %s app" % app)
+                for app, func in dispatch[phase]:
+                    if debug:
+                        self.debug("In %s app", app)
                     handled = False
 
                     try:
-                        func = getattr(app, phase)
                         handled = func(msg)
 
                     except Exception, err:
@@ -145,7 +320,8 @@ class HttpRouter(object, LoggerMixin):
                     # further apps from receiving the message
                     elif phase == "handle":
                         if handled is True:
-                            self.debug("Short-circuited")
+                            if debug:
+                                self.debug("Short-circuited")
                             # mark the message handled to avoid the 
                             # default phase firing unnecessarily
                             msg.handled = True
@@ -155,14 +331,14 @@ class HttpRouter(object, LoggerMixin):
                         # allow default phase of apps to short circuit
                         # for prioritized contextual responses.   
                         if handled is True:
-                            self.debug("Short-circuited default")
+                            if debug:
+                                self.debug("Short-circuited default")
                             break
                         
         except StopIteration:
             pass
 
-        db_message.status = 'H'
-        db_message.save()
+        db_message.transition(('R', 'P'), 'H', lease_expires=None)
         
         db_responses = []
 
@@ -187,16 +363,13 @@ class HttpRouter(object, LoggerMixin):
                                             direction='O',
                                             status=status,
                                             in_response_to=source)
-        self.info("SMS[%d] OUT (%s) : %s" % (db_message.id, str(connection), text))
+        self.info("SMS[%d] OUT (%s) : %s", db_message.id, connection, text)
 
         # process our outgoing phases
         self.process_outgoing_phases(db_message)
 
-        # if it wasn't cancelled
-        if db_message.status != 'C':
-            # queue it
-            db_message.status = 'Q'
-            db_message.save()
+        # queue it, unless it was cancelled
+        db_message.transition(('P',), 'Q')
 
         # if we have a router URL, send the message off
         if getattr(settings, 'ROUTER_URL', None):
@@ -204,6 +377,25 @@ class HttpRouter(object, LoggerMixin):
 
         return db_message
                 
+    def add_outgoing_batch(self, messages, status='Q'):
+        """
+        Adds the passed in outgoing messages, a list of (connection, text) tuples, with a single
+        insert with the passed in status and passes them through our apps' outgoing phase
+        together, see ``process_outgoing_batch``.  Returns the messages in the same order.
+        """
+        pks = Message.insert_batch([dict(connection_id=connection.pk, text=unicode(text), direction='O', status=status)
+                                    for connection, text in messages])
+        db_messages = Message.objects.select_related('connection__backend').in_bulk(pks)
+        db_messages = [db_messages[pk] for pk in pks]
+
+        cancelled = self.process_outgoing_batch(db_messages)
+        kept = [message.pk for message in db_messages if message.pk not in cancelled]
+
+        if status == 'Q' and getattr(settings, 'ROUTER_URL', None):
+            Message.send_all(kept)
+
+        return db_messages
+
     def handle_outgoing(self, msg, source=None):
         """
         Sends the passed in RapidSMS message off.  Optionally ties the outgoing message to the incoming
@@ -218,44 +410,166 @@ class HttpRouter(object, LoggerMixin):
         Passes the passed in message through the outgoing phase for all our configured SMS apps.
 
         Apps have the opportunity to cancel messages in this phase by returning False when
-        called with the message.  In that case this method will also return False
+        called with the message.  In that case this method will also return False.  This is
+        ``process_outgoing_batch`` with a batch of one, so apps see single messages and bulk
+        sends the same way.
         """
-        # create a RapidSMS outgoing message
-        msg = OutgoingMessage(outgoing.connection, outgoing.text.replace('%','%%'))
-        msg.db_message = outgoing
-        
-        send_msg = True
-        for phase in self.outgoing_phases:
-            self.debug("Out %s phase" % phase)
+        return outgoing.pk not in self.process_outgoing_batch([outgoing])
+
+    def process_outgoing_batch(self, messages):
+        """
+        Passes the passed in list of outgoing messages, Message models, through the outgoing
+        phase of all our apps at once, returning the set of ids of the messages cancelled.
+        Cancelled messages are moved to 'C' with a single UPDATE.
+
+        Apps can handle messages in bulk with an ``outgoing_batch`` method, called with the
+        list of messages not yet cancelled and returning those to cancel, as messages or ids.
+        They can also change the text of messages, which is saved with a single UPDATE.  Apps
+        without one have ``outgoing`` called with each message in turn, cancelling it by
+        returning False.  Messages go through this once, when they are created.
+        """
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        texts = dict((message.pk, message.text) for message in messages)
+        cancelled = set()
+
+        # the RapidSMS messages for apps without a batch hook, created the first time one is needed
+        outgoing = {}
 
-            # call outgoing phases in the opposite order of the incoming
-            # phases, so the first app called with an  incoming message
-            # is the last app called with an outgoing message
-            for app in reversed(self.apps):
-                self.debug("Out %s app" % app)
+        # our outgoing table is already in the opposite order of the incoming phases, so the
+        # first app called with an incoming message is the last app called with an outgoing one
+        for app, func, batched in self.dispatch_table()['outgoing_batch']:
+            remaining = [message for message in messages if message.pk not in cancelled]
+            if not remaining:
+                break
 
+            if debug:
+                self.debug("Out %s app, %d messages", app, len(remaining))
+
+            if batched:
                 try:
-                    func = getattr(app, phase)
-                    keep_sending = func(msg)
+                    cancel = func(remaining)
+                    if cancel:
+                        cancelled.update(getattr(message, 'pk', message) for message in cancel)
+                except Exception, err:
+                    app.exception()
+                continue
+
+            for message in remaining:
+                msg = outgoing.get(message.pk)
+                if msg is None:
+                    msg = outgoing[message.pk] = OutgoingMessage(message.connection, message.text.replace('%', '%%'))
+                    msg.db_message = message
 
-                    # we have to do things this way because by default apps return
-                    # None from outgoing()
-                    if keep_sending is False:
-                        send_msg = False
+                try:
+                    # apps return None from outgoing() by default, only False cancels
+                    if func(msg) is False:
+                        cancelled.add(message.pk)
                 except Exception, err:
                     app.exception()
 
-                # during any outgoing phase, an app can return True to
-                # abort ALL further processing of this message
-                if not send_msg:
-                    outgoing.status = 'C'
-                    outgoing.save()
+        rewritten = [message for message in messages
+                     if message.pk not in cancelled and message.text != texts[message.pk]]
+        if rewritten:
+            self.save_texts(rewritten)
+
+        if cancelled:
+            Message.objects.filter(pk__in=list(cancelled), status__in=['P', 'Q', 'L', 'E']).update(status='C')
+            for message in messages:
+                if message.pk in cancelled:
+                    message.status = 'C'
+            self.warning("%d messages cancelled", len(cancelled))
+
+        return cancelled
 
-                    self.warning("Message cancelled")
-                    send_msg = False
-                    break
+    def save_texts(self, messages):
+        """
+        Saves the texts of the passed in messages with a single UPDATE.
+        """
+        qn = db_connection.ops.quote_name
+
+        cases, params, ids = [], [], []
+        for message in messages:
+            cases.append("WHEN %s THEN %s")
+            params += [message.pk, message.text]
+            ids.append(message.pk)
 
-        return send_msg
+        db_connection.cursor().execute("UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" %
+                                       (qn(Message._meta.db_table), qn('text'), qn('id'), " ".join(cases),
+                                        qn('id'), ", ".join(["%s"] * len(ids))), params + ids)
+        transaction.commit_unless_managed()
+
+    def process_outgoing_batches(self, messages):
+        """
+        Passes the messages in the passed in queryset through our apps' outgoing phase
+        ROUTER_OUTGOING_BATCH_SIZE at a time, 500 by default, see ``process_outgoing_batch``.
+        Returns the set of ids of the messages cancelled.
+        """
+        cancelled = set()
+        if not self.dispatch_table()['outgoing_batch']:
+            return cancelled
+
+        size = getattr(settings, 'ROUTER_OUTGOING_BATCH_SIZE', 500)
+        messages = messages.select_related('connection__backend').order_by('pk')
+        last = 0
+        while True:
+            chunk = list(messages.filter(pk__gt=last)[:size])
+            if not chunk:
+                break
+            cancelled |= self.process_outgoing_batch(chunk)
+            last = chunk[-1].pk
+
+        return cancelled
+
+    @classmethod
+    def overrides(cls, app, phase):
+        """
+        Whether the passed in app does anything in the passed in phase, that is whether it has
+        its own version of the AppBase method.
+        """
+        if phase in getattr(app, '__dict__', {}):
+            return True
+
+        method = getattr(type(app), phase, None)
+        if method is None:
+            return False
+        return getattr(method, 'im_func', method) is not getattr(AppBase, phase).im_func
+
+    def build_dispatch_table(self, apps):
+        """
+        Returns a dict of phase name to the list of (app, method) tuples to call for that phase.
+        Apps are only included for the phases they override, the AppBase versions do nothing.
+        Outgoing phases list apps in reverse order.  'outgoing_batch' lists (app, method,
+        batched) tuples for ``process_outgoing_batch``.
+        """
+        table = {}
+        for phase in self.incoming_phases + self.outgoing_phases:
+            handlers = [(app, getattr(app, phase)) for app in apps if self.overrides(app, phase)]
+
+            if phase in self.outgoing_phases:
+                handlers.reverse()
+            table[phase] = handlers
+
+        # apps can take outgoing messages in bulk, those that don't are given them one at a time
+        batch = []
+        for app in reversed(apps):
+            if callable(getattr(app, 'outgoing_batch', None)):
+                batch.append((app, app.outgoing_batch, True))
+            elif self.overrides(app, 'outgoing'):
+                batch.append((app, app.outgoing, False))
+        table['outgoing_batch'] = batch
+
+        return table
+
+    def dispatch_table(self):
+        """
+        Returns our dispatch table, rebuilding it if our apps have changed since it was built.
+        """
+        apps = tuple(self.apps)
+        built_for, table = self._dispatch
+        if apps != built_for:
+            table = self.build_dispatch_table(apps)
+            self._dispatch = (apps, table)
+        return table
 
     @classmethod
     def definition_from_string(cls, class_name):
@@ -311,6 +625,9 @@ class HttpRouter(object, LoggerMixin):
         for app in self.apps:
             app.start()
 
+        # work out which apps take part in each phase
+        self.dispatch_table()
+
         # the list of messages which need to be sent, we load this from the DB
         # upon first starting up
         self.outgoing = [message for message in Message.objects.filter(status='Q')]
@@ -318,6 +635,29 @@ class HttpRouter(object, LoggerMixin):
         # mark ourselves as started
         self.started = True
         
+def fetch_url(url, params):
+    """
+    Fetches the passed in url using the function named by ROUTER_FETCH_URL if set, or
+    HttpRouter.fetch_url otherwise.  All our send paths go through here.
+    """
+    if hasattr(settings, 'ROUTER_FETCH_URL'):
+        fetch_url = HttpRouter.definition_from_string(getattr(settings, 'ROUTER_FETCH_URL'))
+        return fetch_url(url, params)
+    else:
+        return HttpRouter.fetch_url(url, params)
+
+def get_incoming_mode():
+    """
+    How incoming messages are handled: 'sync' in the HTTP thread, 'celery' by a Celery
+    task or 'thread' by a pool of background threads in this process.
+    """
+    return getattr(settings, 'ROUTER_INCOMING_MODE', 'sync')
+
+def get_incoming_pool():
+    return get_pool('incoming',
+                    workers=getattr(settings, 'ROUTER_INCOMING_WORKERS', 4),
+                    queue_size=getattr(settings, 'ROUTER_INCOMING_QUEUE_SIZE', 0))
+
 # we'll get started when we first get used
 http_router = HttpRouter()
 http_router_lock = Lock()
@@ -0,0 +1,100 @@
+"""
+Search backends for the router console.  Each takes a queryset of messages and the
+terms the user searched for, returning the messages matching all of them.
+
+Set ROUTER_SEARCH_BACKEND to the dotted path of a backend class to choose one, by default
+we use full text search on Postgres and icontains lookups everywhere else.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+
+from .normalizer import get_normalizer
+
+class ContainsSearchBackend(object):
+    """
+    Matches terms anywhere in a message's text, the text it responded to or its sender's
+    identity, numbers in any of the forms we may have stored them in.  This scans the whole
+    table, so is only suited to smaller databases.
+    """
+    def search(self, queryset, terms):
+        for term in terms:
+            match = Q(text__icontains=term) | Q(in_response_to__text__icontains=term) | Q(connection__identity__icontains=term)
+            for number in number_forms(term):
+                match |= Q(connection__identity__icontains=number)
+            queryset = queryset.filter(match)
+        return queryset
+
+class PostgresSearchBackend(object):
+    """
+    Matches words using Postgres full text search on message text, and terms that look like
+    phone numbers against the start of sender identities.  Both are served by indexes, see
+    migration 0006, which must use the same ROUTER_SEARCH_CONFIG.
+    """
+    def __init__(self, config=None):
+        if config is None:
+            config = get_search_config()
+        self.config = config
+
+    def search(self, queryset, terms):
+        qn = connections[queryset.db].ops.quote_name
+        table = qn(queryset.model._meta.db_table)
+
+        # the config is part of the indexed expression, so is written out rather than passed in
+        tsvector = "to_tsvector('%s', %s.%s)" % (self.config, table, qn('text'))
+        text_match = "%s @@ plainto_tsquery('%s', %%s)" % (tsvector, self.config)
+        identity_match = "%s.%s IN (SELECT %s FROM %s WHERE %%s)" % \
+                         (table, qn('connection_id'), qn('id'), qn('rapidsms_connection'))
+
+        words = []
+        for term in terms:
+            numbers = number_forms(term)
+            if numbers:
+                prefixes = " OR ".join(["%s LIKE %%s" % qn('identity')] * len(numbers))
+                queryset = queryset.extra(where=["(%s OR %s)" % (identity_match % prefixes, text_match)],
+                                          params=["%s%%" % number for number in numbers] + [term])
+            else:
+                words.append(term)
+
+        if words:
+            queryset = queryset.extra(where=[text_match], params=[" ".join(words)])
+
+        return queryset
+
+def number_forms(term):
+    """
+    Returns the identities the passed in term may be stored as if it looks like a phone number,
+    such as +256 or (206), that is its digits and those normalized with each of our
+    ROUTER_NUMBER_RULES.  Returns an empty list for other terms.
+    """
+    normalizer = get_normalizer()
+    digits = normalizer.strip(term)
+    if not digits.isdigit():
+        return []
+
+    international = term.lstrip().startswith('+')
+    forms = set([digits])
+    for rules in normalizer.rules.values():
+        forms.add(normalizer.apply_rules(digits, rules, international=international))
+    return sorted(forms)
+
+def get_search_config():
+    config = getattr(settings, 'ROUTER_SEARCH_CONFIG', 'simple')
+    if not re.match(r'^[a-z_]+$', config):
+        raise Exception("Invalid ROUTER_SEARCH_CONFIG '%s', should be the name of a text search configuration" % config)
+    return config
+
+def get_search_backend(db='default'):
+    """
+    Returns the search backend named by ROUTER_SEARCH_BACKEND, or the best one for the
+    passed in database.
+    """
+    if hasattr(settings, 'ROUTER_SEARCH_BACKEND'):
+        from .router import HttpRouter
+        return HttpRouter.definition_from_string(settings.ROUTER_SEARCH_BACKEND)()
+
+    if connections[db].vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return ContainsSearchBackend()
@@ -0,0 +1,107 @@
+"""
+The numbers mass texts aren't sent to, those in the Suppression table, either on every
+backend or on just one.  Each process keeps them in memory for ROUTER_SUPPRESSION_TTL
+seconds, 60 by default, so checking each recipient of a large broadcast doesn't cost a query.
+
+Numbers are held in a sorted array of integers, a fraction of the memory a set of strings
+would take, and looked up with a binary search.  The rare identity that isn't a number, or
+that starts with a zero and so wouldn't survive being made an integer, goes in a set instead.
+"""
+import time
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from .models import Suppression
+
+class SuppressionList(object):
+    """
+    An immutable set of suppressed identities, which should already be normalized.
+    """
+    TYPECODE = 'L'
+    MAX_NUMBER = 2 ** (array(TYPECODE).itemsize * 8) - 1
+
+    def __init__(self, identities=()):
+        numbers = []
+        others = set()
+        for identity in identities:
+            number = self.as_number(identity)
+            if number is None:
+                others.add(identity)
+            else:
+                numbers.append(number)
+
+        numbers.sort()
+        self.numbers = array(self.TYPECODE, numbers)
+        self.others = frozenset(others)
+
+    @classmethod
+    def as_number(cls, identity):
+        if identity.isdigit() and not identity.startswith('0'):
+            number = long(identity)
+            if number <= cls.MAX_NUMBER:
+                return number
+        return None
+
+    def __contains__(self, identity):
+        number = self.as_number(identity)
+        if number is None:
+            return identity in self.others
+
+        index = bisect_left(self.numbers, number)
+        return index < len(self.numbers) and self.numbers[index] == number
+
+    def __len__(self):
+        return len(self.numbers) + len(self.others)
+
+class Suppressions(object):
+    """
+    The SuppressionList of numbers suppressed on every backend, along with one for the
+    numbers suppressed on each backend, by backend id.
+    """
+    def __init__(self, rows=()):
+        identities = {}
+        for backend_id, identity in rows:
+            identities.setdefault(backend_id, []).append(identity)
+
+        self.everywhere = SuppressionList(identities.pop(None, []))
+        self.by_backend = dict((backend_id, SuppressionList(backend_identities))
+                               for backend_id, backend_identities in identities.items())
+
+    def contains(self, identity, backend_id):
+        if identity in self.everywhere:
+            return True
+
+        suppressions = self.by_backend.get(backend_id)
+        return suppressions is not None and identity in suppressions
+
+    def __len__(self):
+        return len(self.everywhere) + sum([len(suppressions) for suppressions in self.by_backend.values()])
+
+
+_suppressions = None
+_suppressions_loaded = 0
+_suppressions_lock = Lock()
+
+def get_suppression_list():
+    """
+    Returns the Suppressions for this process, reloading them from the database if they are
+    more than ROUTER_SUPPRESSION_TTL seconds old.
+    """
+    global _suppressions, _suppressions_loaded
+
+    with _suppressions_lock:
+        if _suppressions is None or time.time() - _suppressions_loaded > getattr(settings, 'ROUTER_SUPPRESSION_TTL', 60):
+            _suppressions = Suppressions(Suppression.objects.values_list('backend', 'identity').iterator())
+            _suppressions_loaded = time.time()
+        return _suppressions
+
+def invalidate_suppressions(sender, **kwargs):
+    global _suppressions
+    _suppressions = None
+
+post_save.connect(invalidate_suppressions, sender=Suppression)
+post_delete.connect(invalidate_suppressions, sender=Suppression)
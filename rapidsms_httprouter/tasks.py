@@ -2,10 +2,12 @@ import StringIO
 from celery.task import task
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.db.models import F
 from .models import Message, DeliveryError
-from .router import HttpRouter
+from .router import HttpRouter, get_router, fetch_url as router_fetch_url
+from .ratelimit import get_rate_limiter
+from .rollups import compact_rollups
 from urllib import quote_plus
-from urllib2 import urlopen
 import traceback
 import time
 import re
@@ -14,12 +16,11 @@ import redis
 import logging
 logger = logging.getLogger(__name__)
 
+# the statuses a message can be in when we try to send it, claimed messages are 'L'
+SENDABLE_STATUSES = ('L', 'Q', 'E')
+
 def fetch_url(url, params):
-    if hasattr(settings, 'ROUTER_FETCH_URL'):
-        fetch_url = HttpRouter.definition_from_string(getattr(settings, 'ROUTER_FETCH_URL'))
-        return fetch_url(url, params)
-    else:
-        return HttpRouter.fetch_url(url, params)
+    return router_fetch_url(url, params)
 
 def build_send_url(params, **kwargs):
     """
@@ -60,7 +61,8 @@ def build_send_url(params, **kwargs):
 
 def send_message(msg, **kwargs):
     """
-    Sends a message using its configured endpoint
+    Sends a message using its configured endpoint.  The message should be loaded with
+    select_related('connection__backend'), a successful send is then a single update.
     """
     msg_log = "Sending message: [%d]\n" % msg.id
 
@@ -79,6 +81,9 @@ def send_message(msg, **kwargs):
         print "[%d] - %s\n" % (msg.id, url)
         msg_log += "%s %s\n" % (msg.connection.backend.name, url)
 
+        # wait our turn if this backend is rate limited
+        get_rate_limiter().acquire(msg.connection.backend.name)
+
         response = fetch_url(url, params)
         status_code = response.getcode()
 
@@ -93,8 +98,7 @@ def send_message(msg, **kwargs):
             print "  [%d] - sent %d" % (msg.id, status_code)
             logger.info("SMS[%d] SENT" % msg.id)
             msg.sent = datetime.now()
-            msg.status = 'S'
-            msg.save()
+            msg.transition(SENDABLE_STATUSES, 'S')
 
             return body
         else:
@@ -103,42 +107,141 @@ def send_message(msg, **kwargs):
         import traceback
         traceback.print_exc(e)
         print "  [%d] - send error - %s" % (msg.id, str(e))
+        record_send_error(msg, msg_log, e)
 
-        # previous errors
-        previous_count = DeliveryError.objects.filter(message=msg).count()
-        msg_log += "Failure #%d\n\n" % (previous_count+1)
-        msg_log += "Error: %s\n\n" % str(e)
-        
-        if previous_count >= 2:
-            msg_log += "Permanent failure, will not retry."
-            msg.status = 'F'
-            msg.save()
-        else:
-            msg_log += "Will retry %d more time(s)." % (2 - previous_count)
-            msg.status = 'E'
-            msg.save()
+    return None
+
+def record_send_error(msg, msg_log, error):
+    """
+    Records a failed attempt at sending the passed in message, erroring it so it is retried
+    later or failing it for good once it has errored three times.
+    """
+    # previous errors are counted on the message itself
+    previous_count = msg.retry_count
+    msg_log += "Failure #%d\n\n" % (previous_count+1)
+    msg_log += "Error: %s\n\n" % str(error)
+
+    if previous_count >= 2:
+        msg_log += "Permanent failure, will not retry."
+        status = 'F'
+    else:
+        msg_log += "Will retry %d more time(s)." % (2 - previous_count)
+        status = 'E'
 
-        DeliveryError.objects.create(message=msg, log=msg_log)
+    if msg.transition(SENDABLE_STATUSES, status, retry_count=F('retry_count') + 1):
+        msg.retry_count += 1
+
+    DeliveryError.objects.create(message=msg, log=msg_log)
+
+def supports_multiple_recipients(backend_name):
+    """
+    Whether the ROUTER_URL for the passed in backend accepts a space separated list of
+    recipients, as Kannel's sendsms does.  Such urls can't include a message %(id)s.
+    """
+    backends = getattr(settings, 'ROUTER_MULTIPLE_RECIPIENT_BACKENDS', [])
+    return backend_name in backends or 'default' in backends
+
+def send_message_chunk(msgs):
+    """
+    Sends the passed in messages, which all share a backend and text, as a single request
+    listing every recipient.
+    """
+    backend_name = msgs[0].connection.backend.name
+    pks = [msg.pk for msg in msgs]
+    msg_log = "Sending messages: %s\n" % pks
+
+    try:
+        params = {
+            'backend': backend_name,
+            'recipient': ' '.join([msg.connection.identity for msg in msgs]),
+            'text': msgs[0].text,
+        }
+
+        url = build_send_url(params)
+        logger.debug("SMS%s - %s", pks, url)
+        msg_log += "%s %s\n" % (backend_name, url)
+
+        # each recipient counts against our backend's rate limit
+        get_rate_limiter().acquire(backend_name, len(msgs))
+
+        response = fetch_url(url, params)
+        status_code = response.getcode()
+
+        body = response.read().decode('ascii', 'ignore').encode('ascii')
+        msg_log += "Status Code: %d\n" % status_code
+        msg_log += "Body: %s\n" % body
+
+        if int(status_code/100) == 2:
+            logger.info("SMS%s SENT %d", pks, status_code)
+            # only messages still ours, a delivery report may already have come in for some
+            sent = datetime.now()
+            Message.objects.filter(pk__in=pks, status__in=SENDABLE_STATUSES).update(status='S')
+            for msg in msgs:
+                msg.sent = sent
+            return body
+        else:
+            raise Exception("Received status code: %d" % status_code)
+    except Exception as e:
+        logger.exception("SMS%s send error", pks)
+        for msg in msgs:
+            record_send_error(msg, msg_log, e)
 
     return None
 
+def send_messages(message_ids):
+    """
+    Claims and sends the passed in messages.  They are loaded in a single query, then
+    messages sharing a backend and text are sent together where the backend takes
+    multiple recipients, the rest one at a time.
+    """
+    claimed = Message.objects.filter(pk__in=message_ids).claim()
+    if not claimed:
+        return
+
+    try:
+        msgs = Message.objects.filter(pk__in=claimed).select_related('connection__backend')\
+                                                     .order_by('connection__backend__name', 'text', 'id')
+
+        chunk = []
+        for msg in msgs:
+            # numbers only, like send_messages, as we join recipients with spaces
+            if not supports_multiple_recipients(msg.connection.backend.name) or re.search('[a-z]', msg.connection.identity, re.I):
+                send_message(msg)
+                continue
+
+            if chunk and (chunk[0].connection.backend.name != msg.connection.backend.name or chunk[0].text != msg.text):
+                send_message_chunk(chunk)
+                chunk = []
+            chunk.append(msg)
+
+        if chunk:
+            send_message_chunk(chunk)
+    finally:
+        # anything we didn't get to goes straight back in the queue rather than waiting on its lease
+        Message.objects.filter(pk__in=claimed, status='L').update(status='Q', lease_expires=None)
+
 @task(track_started=True)
 def send_message_task(message_id):  #pragma: no cover
     # noop if there is no ROUTER_URL
     if not getattr(settings, 'ROUTER_URL', None):
         return
 
-    # we use redis to acquire a global lock based on our settings key
-    r = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+    # claim the message if it still needs to be sent, moving it to 'L' so no other
+    # worker can pick it up until our lease runs out
+    if Message.objects.filter(pk=message_id).claim():
+        msg = Message.objects.select_related('connection__backend').get(pk=message_id)
+        body = send_message(msg)
 
-    # try to acquire a lock, at most it will last 60 seconds
-    with r.lock('send_message_%d' % message_id, timeout=60):
-        # get the message
-        msg = Message.objects.get(pk=message_id)
+@task(track_started=True)
+def send_message_batch_task(message_ids):
+    """
+    Sends the passed in list of messages, see Message.send_all.
+    """
+    # noop if there is no ROUTER_URL
+    if not getattr(settings, 'ROUTER_URL', None):
+        return
 
-        # if it hasn't been sent and it needs to be sent
-        if msg.status == 'Q' or msg.status == 'E':
-            body = send_message(msg)
+    send_messages(message_ids)
 
 @task(track_started=True)
 def resend_errored_messages_task():  #pragma: no cover
@@ -153,129 +256,44 @@ def resend_errored_messages_task():  #pragma: no cover
 
     # try to acquire a lock, at most it will last 5 mins
     with r.lock('resend_messages', timeout=300):
-        # get all errored outgoing messages
-        pending = Message.objects.filter(direction='O', status__in=('E'))
-
-        # send each
-        count = 0
-        for msg in pending:
-            msg.send()
-            count+=1
+        # put back any messages whose sender died while holding them
+        count = Message.objects.reclaim_expired()
+        if count:
+            logger.info("Requeued %d messages with expired leases", count)
 
-            if count >= 100: break
+        # get up to 100 errored outgoing messages
+        errored = list(Message.objects.filter(direction='O', status='E').values_list('pk', flat=True)[:100])
+        Message.send_all(errored)
+        print "-- resent %d errored messages --" % len(errored)
 
-        print "-- resent %d errored messages --" % count
-
-        # and all queued messages that are older than 5 mins
+        # and up to 100 queued messages that are older than 5 mins
         five_minutes_ago = datetime.now() - timedelta(minutes=5)
-        pending = Message.objects.filter(direction='O', status__in=('Q'), updated__lte=five_minutes_ago)
-
-
-        # send each
-        count = 0
-        for msg in pending:
-            msg.send()
-            count+=1
-
-            if count >= 100: break
-
-        print "-- resent %d pending messages -- " % count
-
+        pending = list(Message.objects.filter(direction='O', status='Q', date__lte=five_minutes_ago).values_list('pk', flat=True)[:100])
+        Message.send_all(pending)
+        print "-- resent %d pending messages -- " % len(pending)
 
-# from celery.task import Task, task
-# from .models import Message
-# from rapidsms.models import Backend, Connection
-# from rapidsms.apps.base import AppBase
-# from rapidsms.messages.incoming import IncomingMessage
-# from rapidsms.messages.outgoing import OutgoingMessage
-# from rapidsms.log.mixin import LoggerMixin
-# from threading import Lock, Thread
-# 
-# from urllib import quote_plus
-# from urllib2 import urlopen
-# import time
-# import re
 
-@task
-def handle_incoming(router,backend, sender, text,ignore_result=True,**kwargs):
+@task(ignore_result=True)
+def compact_rollups_task():
     """
-        Handles an incoming message.
-        """
-    # create our db message for logging
-    db_message = router.add_message(backend, sender, text, 'I', 'R')
-
-    # and our rapidsms transient message for processing
-    msg = IncomingMessage(db_message.connection, text, db_message.date)
-
-    # add an extra property to IncomingMessage, so httprouter-aware
-    # apps can make use of it during the handling phase
-    msg.db_message = db_message
+    Recounts recent days of the message rollups behind the summary report, schedule this
+    with celerybeat.
+    """
+    compact_rollups()
 
-    router.info("SMS[%d] IN (%s) : %s" % (db_message.id, msg.connection, msg.text))
-    try:
-        for phase in router.incoming_phases:
-            router.debug("In %s phase" % phase)
-            if phase == "default":
-                if msg.handled:
-                    router.debug("Skipping phase")
-                    break
-
-            for app in router.apps:
-                router.debug("In %s app" % app)
-                handled = False
-
-                try:
-                    func = getattr(app, phase)
-                    handled = func(msg)
-
-                except Exception, err:
-                    import traceback
-                    traceback.print_exc(err)
-                    app.exception()
-
-                # during the _filter_ phase, an app can return True
-                # to abort ALL further processing of this message
-                if phase == "filter":
-                    if handled is True:
-                        router.warning("Message filtered")
-                        raise(StopIteration)
-
-                # during the _handle_ phase, apps can return True
-                # to "short-circuit" this phase, preventing any
-                # further apps from receiving the message
-                elif phase == "handle":
-                    if handled is True:
-                        router.debug("Short-circuited")
-                        # mark the message handled to avoid the
-                        # default phase firing unnecessarily
-                        msg.handled = True
-                        db_message.application = app
-                        db_message.save()
-                        break
-
-                elif phase == "default":
-                    # allow default phase of apps to short circuit
-                    # for prioritized contextual responses.
-                    if handled is True:
-                        router.debug("Short-circuited default")
-                        break
-
-    except StopIteration:
-        pass
-
-    db_message.status = 'H'
-    db_message.save()
-
-    db_responses = []
-
-    # now send the message responses
-    while msg.responses:
-        response = msg.responses.pop(0)
-        router.handle_outgoing(response, db_message, db_message.application)
-
-    # we are no longer interested in this message... but some crazy
-    # synchronous backends might be, so mark it as processed.
-    msg.processed = True
-
-    return db_message
+@task(ignore_result=True)
+def requeue_stale_incoming_task():
+    """
+    Hands off again incoming messages that were never handled, schedule this with
+    celerybeat when ROUTER_INCOMING_MODE is 'celery'.  In 'thread' mode use the
+    router_requeue_incoming command instead, which doesn't need Celery.
+    """
+    get_router().requeue_stale_incoming()
 
+@task(ignore_result=True)
+def handle_incoming(message_id):
+    """
+    Runs a received message through the incoming phases of our SMS apps.  Only the id is
+    passed in, the router is that of the worker process.
+    """
+    get_router().process_incoming_message(message_id)
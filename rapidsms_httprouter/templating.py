@@ -0,0 +1,29 @@
+"""
+Personalises the texts of bulk messages.  Templates name their variables in double braces::
+
+    TextTemplate("Hi {{ name }}, your code is {{ code }}").render(dict(name="Eric", code="1234"))
+
+Each template is compiled once to a Python format string, so rendering it for each of a
+broadcast's recipients is a single string formatting operation.
+"""
+import re
+
+class TextTemplate(object):
+    """
+    A message text with ``{{ variable }}`` placeholders.  Rendering raises a KeyError if a
+    variable is missing from the values passed in.
+    """
+    PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+    def __init__(self, text):
+        self.text = text
+        self.variables = frozenset(self.PLACEHOLDER.findall(text))
+
+        # any % in the text itself has to survive formatting
+        self.format = self.PLACEHOLDER.sub(lambda match: u'%%(%s)s' % match.group(1), text.replace('%', '%%'))
+
+    def render(self, variables):
+        return self.format % variables
+
+    def __unicode__(self):
+        return self.text
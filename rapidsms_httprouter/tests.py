@@ -10,14 +10,19 @@ import time
 from django.test import TestCase, TransactionTestCase
 from .router import get_router, HttpRouter
 from .models import Message
+from .cache import get_identity_cache
+from .workers import WorkerPool
+from .transport import HttpTransport
+from .benchmarks import start_stub_server
+from .ratelimit import RateLimiter
 
-from rapidsms.models import Backend, Connection
+from rapidsms.models import Backend, Connection, Contact
 from rapidsms.apps.base import AppBase
 from rapidsms.messages.outgoing import OutgoingMessage
 from django.conf import settings
 from django.core.management import call_command
 from qos_messages import gen_qos_msg, get_alarms, get_backends_by_type, gen_qos_msg
-from datetime import datetime
+from datetime import datetime, timedelta
 
 class TestResponse(object):
     def getcode(self):
@@ -126,6 +131,56 @@ class BackendTest(TransactionTestCase):
         # check whether our url was set right again
         self.assertEquals("http://mykannel2.com/cgi-bin/sendsms?from=1234&text=test2&to=2067799291&smsc=test_backend2&id=%d" % msg2.id, test_fetch_url.url)
 
+    def testSendMessageBatchTask(self):
+        from .tasks import send_message_batch_task
+
+        settings.ROUTER_URL = {
+            "default": "http://mykannel.com/cgi-bin/sendsms?from=1234&text=%(text)s&to=%(recipient)s&smsc=%(backend)s&id=%(id)s",
+            "test_backend": "http://mykannel.com/cgi-bin/sendsms?from=1234&text=%(text)s&to=%(recipient)s&smsc=%(backend)s",
+        }
+        settings.ROUTER_MULTIPLE_RECIPIENT_BACKENDS = ['test_backend']
+
+        def test_fetch_url(cls, url, params):
+            test_fetch_url.urls.append(url)
+            return TestResponse()
+        test_fetch_url.urls = []
+
+        original_fetch_url = HttpRouter.fetch_url
+        HttpRouter.fetch_url = classmethod(test_fetch_url)
+        try:
+            (connection3, created) = Connection.objects.get_or_create(backend=self.backend, identity='2067799292')
+            msgs = [Message.objects.create(connection=connection, text='test', direction='O', status='Q')
+                    for connection in (self.connection, connection3, self.connection2)]
+            sent = Message.objects.create(connection=self.connection, text='test', direction='O', status='S')
+
+            send_message_batch_task([msg.pk for msg in msgs] + [sent.pk])
+        finally:
+            HttpRouter.fetch_url = original_fetch_url
+            del settings.ROUTER_MULTIPLE_RECIPIENT_BACKENDS
+
+        # one request for both recipients on our first backend, one for the other backend
+        self.assertEquals(sorted(["http://mykannel.com/cgi-bin/sendsms?from=1234&text=test&to=2067799294+2067799292&smsc=test_backend",
+                                  "http://mykannel.com/cgi-bin/sendsms?from=1234&text=test&to=2067799291&smsc=test_backend2&id=%d" % msgs[2].pk]),
+                          sorted(test_fetch_url.urls))
+        self.assertEquals(3, Message.objects.filter(pk__in=[msg.pk for msg in msgs], status='S').count())
+
+        # a delivery report that comes in while we send isn't overwritten
+        from .tasks import send_message_chunk
+        msgs = [Message.objects.create(connection=connection, text='chunk', direction='O', status='L')
+                for connection in (self.connection, connection3)]
+
+        def delivered_fetch_url(cls, url, params):
+            Message.objects.filter(pk=msgs[0].pk).update(status='D')
+            return TestResponse()
+
+        HttpRouter.fetch_url = classmethod(delivered_fetch_url)
+        try:
+            send_message_chunk(list(Message.objects.filter(pk__in=[msg.pk for msg in msgs]).select_related('connection__backend').order_by('pk')))
+        finally:
+            HttpRouter.fetch_url = original_fetch_url
+
+        self.assertEquals(['D', 'S'], [Message.objects.get(pk=msg.pk).status for msg in msgs])
+
 
 class RouterTest(TestCase):
 
@@ -142,6 +197,9 @@ class RouterTest(TestCase):
         settings.CELERY_ALWAYS_EAGER = True
         settings.BROKER_BACKEND = 'memory'
 
+        # our test transactions get rolled back, so don't trust cached rows
+        get_identity_cache().clear()
+
     def testAddMessage(self):
         router = get_router()
 
@@ -165,6 +223,46 @@ class RouterTest(TestCase):
         msg4 = router.add_message('test', 'asdfASDF', 'test', 'I', 'P')
         self.assertEquals('asdfasdf', msg4.connection.identity)
 
+    def testIdentityCache(self):
+        router = get_router()
+        identity_cache = get_identity_cache()
+
+        # the first message creates our connection, the second finds and caches it
+        msg1 = router.add_message('test', '+250788383383', 'test', 'I', 'P')
+        router.add_message('test', '+250788383383', 'test', 'I', 'P')
+
+        hits = identity_cache.connections.hits
+        with self.assertNumQueries(1):
+            msg3 = router.add_message('test', '250788383383', 'test', 'I', 'P')
+        self.assertEquals(hits + 1, identity_cache.connections.hits)
+        self.assertEquals(msg1.connection.pk, msg3.connection.pk)
+        self.assertEquals('test', msg3.connection.backend.name)
+
+        # changing the connection evicts it
+        connection = Connection.objects.get(pk=msg1.connection.pk)
+        connection.identity = '250788383384'
+        connection.save()
+
+        msg4 = router.add_message('test', '250788383383', 'test', 'I', 'P')
+        self.assertNotEquals(msg1.connection.pk, msg4.connection.pk)
+
+        msg5 = router.add_message('test', '250788383384', 'test', 'I', 'P')
+        self.assertEquals(msg1.connection.pk, msg5.connection.pk)
+
+        # other processes drop their entries once they see the change
+        from .cache import IdentityCache
+        other = IdentityCache()
+        other.generation_interval = 0
+        self.assertEquals(None, other.get_connection(msg5.connection.backend, '250788383384').contact_id)
+        self.assertEquals(None, other.get_connection(msg5.connection.backend, '250788383384').contact_id)
+        self.assertEquals(1, other.connections.hits)
+
+        contact = Contact.objects.create(name='Jenny')
+        connection = Connection.objects.get(pk=msg1.connection.pk)
+        connection.contact = contact
+        connection.save()
+        self.assertEquals(contact.pk, other.get_connection(msg5.connection.backend, '250788383384').contact_id)
+
     def testAddBulk(self):
         connection2 = Connection.objects.create(backend=self.backend, identity='8675309')
         connection3 = Connection.objects.create(backend=self.backend, identity='8675310')
@@ -187,6 +285,431 @@ class RouterTest(TestCase):
         msgs = Message.mass_text('Turbo King is the greatest!', [self.connection, self.connection])
         self.assertEquals(msgs.count(), 1)
 
+    def testMassTextBatch(self):
+        from .models import MessageBatch
+        from .pgcopy import CopyFile, copy_escape
+
+        conns = [Connection.objects.create(backend=self.backend, identity='86753%02d' % i) for i in range(5)]
+
+        # querysets, connections, ids and repeats are all fine, in whatever size chunks
+        batch, msgs = Message.mass_text_batch('hello', Connection.objects.filter(identity__startswith='86753'), chunk_size=2)
+        self.assertEquals(set([c.pk for c in conns]), set(msgs.values_list('connection', flat=True)))
+        self.assertEquals(set([batch.pk]), set(msgs.values_list('batch', flat=True)))
+
+        self.assertEquals(5, batch.message_count)
+
+        batch, msgs = Message.mass_text_batch('hello', [conns[0].pk, conns[1], conns[0].pk], chunk_size=1)
+        self.assertEquals(2, msgs.count())
+        self.assertEquals(2, batch.message_count)
+        self.assertEquals(1, batch.duplicate_count)
+        self.assertEquals('P', msgs[0].status)
+
+        # sliced querysets are read as they are
+        batch = MessageBatch(duplicate_count=0, suppressed_count=0)
+        sliced = Connection.objects.filter(identity__startswith='86753').order_by('-identity')[:2]
+        self.assertEquals([conns[4].pk, conns[3].pk], list(Message.recipient_ids(sliced, batch, 1)))
+
+        # a queryset of connections is inserted by the database in one statement, joins and all
+        from .models import mass_text_sent
+        from .suppression import get_suppression_list
+        get_suppression_list()
+        get_router()
+        def record(sender, messages, **kwargs):
+            record.messages = messages
+        mass_text_sent.connect(record)
+        try:
+            # creating the batch, the insert, counting what we left out and recording our counts
+            with self.assertNumQueries(4):
+                batch, msgs = Message.mass_text_batch('hi', Connection.objects.filter(messages__text='hello'))
+        finally:
+            mass_text_sent.disconnect(record)
+
+        self.assertEquals(5, batch.message_count)
+        self.assertEquals(2, batch.duplicate_count)
+        self.assertEquals(5, Message.objects.get(pk=msgs[0].pk).batch.message_count)
+        self.assertEquals(set([c.pk for c in conns]), set(record.messages.values_list('connection', flat=True)))
+
+        # messages are inserted with their final status, with no apps to hold any back there's no update
+        with self.assertNumQueries(4):
+            batch, msgs = Message.mass_text_batch('hi', Connection.objects.filter(messages__text='hello'), status='L')
+        self.assertEquals(set(['L']), set(msgs.values_list('status', flat=True)))
+
+        # as are sliced querysets by mass_text
+        batch, msgs = Message.mass_text_batch('hi', sliced)
+        self.assertEquals(set([conns[4].pk, conns[3].pk]), set(msgs.values_list('connection', flat=True)))
+
+        # rows for COPY are escaped and streamed
+        self.assertEquals(u'a\\tb\\\\n\\n', copy_escape(u'a\tb\\n\n'))
+        copy_file = CopyFile("row %d\n" % i for i in range(3))
+        self.assertEquals("row 0\nro", copy_file.read(8))
+        self.assertEquals("w 1\nrow 2\n", copy_file.read(100))
+        self.assertEquals("", copy_file.read(100))
+
+    def testSuppression(self):
+        from .models import Suppression
+        from .suppression import SuppressionList, invalidate_suppressions
+
+        # our rolled back suppressions shouldn't outlive this test
+        self.addCleanup(invalidate_suppressions, None)
+
+        suppressions = SuppressionList(['256772000001', '0772000002', 'abc', '9' * 30])
+        for identity in ('256772000001', '0772000002', 'abc', '9' * 30):
+            self.assertTrue(identity in suppressions)
+        for identity in ('256772000002', '772000002', 'ab', '9' * 29):
+            self.assertFalse(identity in suppressions)
+        self.assertEquals(4, len(suppressions))
+
+        conns = [Connection.objects.create(backend=self.backend, identity='86753%02d' % i) for i in range(3)]
+        Connection.objects.create(backend=self.backend, identity='86-75301')
+        Suppression.objects.create(identity='+86 75300')
+
+        # numbers are only sent once, however they were written, and never if suppressed
+        batch, msgs = Message.mass_text_batch('hello', [conns[0], conns[1], conns[2], conns[2]] + list(Connection.objects.filter(identity='86-75301')))
+        self.assertEquals(set([conns[1].pk, conns[2].pk]), set(msgs.values_list('connection', flat=True)))
+        self.assertEquals((2, 2, 1), (batch.message_count, batch.duplicate_count, batch.suppressed_count))
+
+        # the database does the same for querysets, going by their identities as stored
+        batch, msgs = Message.mass_text_batch('hi', Connection.objects.filter(messages__text='hello'))
+        self.assertEquals(set([conns[1].pk, conns[2].pk]), set(msgs.values_list('connection', flat=True)))
+        self.assertEquals((2, 0, 0), (batch.message_count, batch.duplicate_count, batch.suppressed_count))
+
+        Connection.objects.create(backend=self.backend, identity='8675302')
+        batch, msgs = Message.mass_text_batch('hello', Connection.objects.filter(identity__startswith='8675'))
+        self.assertEquals((2, 1, 1), (batch.message_count, batch.duplicate_count, batch.suppressed_count))
+
+        # suppressions on one backend are normalized with its rules and only apply there
+        from .normalizer import get_normalizer
+        normalizer = get_normalizer()
+        self.addCleanup(normalizer.clear)
+        self.addCleanup(setattr, normalizer, 'rules', normalizer.rules)
+        normalizer.rules = {'safaricom': {'country_code': '254'}}
+        normalizer.clear()
+
+        safaricom = Backend.objects.create(name='safaricom')
+        Suppression.objects.create(identity='0722000001', backend=safaricom)
+        self.assertEquals(['254722000001'], list(Suppression.objects.filter(backend=safaricom).values_list('identity', flat=True)))
+
+        kenyan = Connection.objects.create(backend=safaricom, identity='254722000001')
+        other = Connection.objects.create(backend=self.backend, identity='254722000001')
+        batch, msgs = Message.mass_text_batch('hello', [kenyan, other])
+        self.assertEquals([other.pk], list(msgs.values_list('connection', flat=True)))
+
+        batch, msgs = Message.mass_text_batch('hello', Connection.objects.filter(identity='254722000001'))
+        self.assertEquals([other.pk], list(msgs.values_list('connection', flat=True)))
+        self.assertEquals((1, 0, 1), (batch.message_count, batch.duplicate_count, batch.suppressed_count))
+
+    def testMassTextTemplate(self):
+        from .templating import TextTemplate
+
+        template = TextTemplate("Hi {{ name }}, {{code}} is 100%")
+        self.assertEquals(frozenset(['name', 'code']), template.variables)
+        self.assertEquals("Hi Eric, 12 is 100%", template.render(dict(name="Eric", code=12)))
+        self.assertRaises(KeyError, template.render, dict(name="Eric"))
+
+        conns = [Connection.objects.create(backend=self.backend, identity='86753%02d' % i) for i in range(4)]
+
+        class CancelApp(AppBase):
+            def outgoing_batch(self, messages):
+                return [msg for msg in messages if msg.text.endswith('cancel')]
+
+        class VetoApp(AppBase):
+            def outgoing(self, msg):
+                return msg.text != 'Hi veto'
+
+        router = get_router()
+        apps = router.apps
+        router.apps = [CancelApp(router), VetoApp(router)]
+        self.addCleanup(setattr, router, 'apps', apps)
+
+        # pairs of connections or ids and their variables, repeats only sent once
+        recipients = [(conns[0], dict(name='Eric')), (conns[1].pk, dict(name='veto')),
+                      (conns[2], dict(name='cancel')), (conns[0].pk, dict(name='again')),
+                      (conns[3].pk, dict(name='Nic'))]
+        batch, msgs = Message.mass_text_template("Hi {{ name }}", recipients, status='Q', chunk_size=2)
+        self.assertEquals((4, 1), (batch.message_count, batch.duplicate_count))
+        self.assertEquals(set([('Hi Eric', 'Q'), ('Hi veto', 'C'), ('Hi cancel', 'C'), ('Hi Nic', 'Q')]),
+                          set(msgs.values_list('text', 'status')))
+
+        # or values querysets, of connections or anything with a connection
+        batch, msgs = Message.mass_text_template("{{ identity }}", Connection.objects.filter(pk__in=[c.pk for c in conns]).values('id', 'identity'))
+        self.assertEquals(set([(c.pk, c.identity) for c in conns]), set(msgs.values_list('connection', 'text')))
+
+        batch, msgs = Message.mass_text_template("was {{ text }}", msgs.filter(connection=conns[0]).values('connection', 'text'))
+        self.assertEquals([(conns[0].pk, 'was 8675300')], list(msgs.values_list('connection', 'text')))
+
+    def testSendMessageQueries(self):
+        from .tasks import send_message
+
+        def test_fetch_url(cls, url, params):
+            if test_fetch_url.fail:
+                raise Exception("Connection refused")
+            return TestResponse()
+
+        settings.ROUTER_URL = "http://mykannel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s&id=%(id)s"
+        original_fetch_url = HttpRouter.fetch_url
+        HttpRouter.fetch_url = classmethod(test_fetch_url)
+        try:
+            for i in range(3):
+                Message.objects.create(connection=self.connection, text='test %d' % i, direction='O', status='Q')
+
+            # sending is a single update per message, its connection and backend come along with it
+            test_fetch_url.fail = False
+            for msg in Message.objects.filter(direction='O').select_related('connection__backend'):
+                with self.assertNumQueries(1):
+                    send_message(msg)
+            self.assertEquals(3, Message.objects.filter(direction='O', status='S').count())
+
+            # failures are counted on the message, then logged
+            test_fetch_url.fail = True
+            Message.objects.create(connection=self.connection, text='failing', direction='O', status='Q')
+            for i in range(3):
+                msg = Message.objects.select_related('connection__backend').get(text='failing')
+                with self.assertNumQueries(2):
+                    send_message(msg)
+
+            msg = Message.objects.get(text='failing')
+            self.assertEquals(3, msg.retry_count)
+            self.assertEquals('F', msg.status)
+            self.assertEquals(3, msg.errors.count())
+        finally:
+            HttpRouter.fetch_url = original_fetch_url
+            settings.ROUTER_URL = None
+
+    def testTransition(self):
+        msg = Message.objects.create(connection=self.connection, text='test', direction='O', status='Q')
+
+        # only the status column is written
+        with self.assertNumQueries(1):
+            self.assertTrue(msg.transition(('Q', 'E'), 'S'))
+        self.assertEquals('S', msg.status)
+        self.assertEquals('S', Message.objects.get(pk=msg.pk).status)
+
+        # once sent, it can't be cancelled
+        self.assertFalse(msg.transition(('Q', 'E'), 'C'))
+        self.assertEquals('S', msg.status)
+
+        # other fields come along with the status
+        self.assertTrue(msg.transition('S', 'D', delivered=datetime(2012, 1, 1)))
+        self.assertEquals(datetime(2012, 1, 1), Message.objects.get(pk=msg.pk).delivered)
+
+    def testSearch(self):
+        from .search import ContainsSearchBackend, PostgresSearchBackend, get_search_backend, number_forms
+        from .normalizer import get_normalizer
+        from .pagination import EstimatedCountPaginator
+
+        (other, created) = Connection.objects.get_or_create(backend=self.backend, identity='256772123456')
+        question = Message.objects.create(connection=self.connection, text='Report your stock levels', direction='O', status='S')
+        answer = Message.objects.create(connection=other, text='STOCK 20', direction='I', status='H', in_response_to=question)
+        Message.objects.create(connection=other, text='hello', direction='I', status='H')
+
+        self.assertTrue(isinstance(get_search_backend(), ContainsSearchBackend))
+        backend = ContainsSearchBackend()
+        self.assertEquals(set([question.pk, answer.pk]), set(backend.search(Message.objects.all(), ['stock']).values_list('pk', flat=True)))
+        self.assertEquals([answer.pk], list(backend.search(Message.objects.all(), ['stock', '25677']).values_list('pk', flat=True)))
+
+        self.assertEquals(['256772'], number_forms('+256(772)'))
+        self.assertEquals([], number_forms('stock'))
+
+        # numbers are also searched for as our number rules would have stored them
+        normalizer = get_normalizer()
+        self.addCleanup(normalizer.clear)
+        self.addCleanup(setattr, normalizer, 'rules', normalizer.rules)
+        normalizer.rules = {'default': {'country_code': '256', 'national_length': 9}}
+        normalizer.clear()
+
+        self.assertEquals(['0772123456', '256772123456'], number_forms('0772 123456'))
+        self.assertEquals([answer.pk], list(backend.search(Message.objects.all(), ['stock', '0772123456']).values_list('pk', flat=True)))
+
+        # postgres searches words with its full text index, numbers against identities
+        sql = str(PostgresSearchBackend(config='english').search(Message.objects.all(), ['stock', '+256']).query)
+        self.assertTrue("plainto_tsquery('english', stock)" in sql)
+        self.assertTrue("LIKE 256%" in sql)
+
+        sql = str(PostgresSearchBackend(config='english').search(Message.objects.all(), ['0772123456']).query)
+        self.assertTrue("LIKE 0772123456%" in sql and "LIKE 256772123456%" in sql)
+
+        # we don't estimate counts on sqlite, so they are exact
+        paginator = EstimatedCountPaginator(Message.objects.all(), 2)
+        self.assertEquals(3, paginator.count)
+        self.assertEquals(2, paginator.num_pages)
+
+        # counts stop at our limit, in the database rather than after counting everything
+        from django.db import connection
+        from .pagination import count_up_to
+        with self.assertNumQueries(1):
+            self.assertEquals(2, count_up_to(Message.objects.all(), 1))
+            self.assertTrue('LIMIT 2' in connection.queries[-1]['sql'])
+        self.assertEquals(3, count_up_to(Message.objects.all(), 5))
+
+    def testKeysetPagination(self):
+        from django.contrib import admin
+        from django.test.client import RequestFactory
+        from .admin import MessageAdmin
+        from .pagination import KeysetPaginator
+
+        msgs = [Message.objects.create(connection=self.connection, text='test %d' % i, direction='I', status='H')
+                for i in range(5)]
+
+        paginator = KeysetPaginator(Message.objects.all(), 2)
+        page = paginator.page()
+        self.assertEquals([msgs[4], msgs[3]], page.object_list)
+        self.assertTrue(page.has_next)
+        self.assertFalse(page.has_previous)
+
+        page = paginator.page(before=page.next_before)
+        self.assertEquals([msgs[2], msgs[1]], page.object_list)
+        self.assertTrue(page.has_previous)
+
+        last = paginator.page(before=page.next_before)
+        self.assertEquals([msgs[0]], last.object_list)
+        self.assertFalse(last.has_next)
+
+        # and back again
+        self.assertEquals([msgs[2], msgs[1]], paginator.page(after=last.previous_after).object_list)
+        self.assertEquals(5, paginator.count)
+
+        # the admin pages the same way, with its filters still applied
+        model_admin = MessageAdmin(Message, admin.site)
+        model_admin.list_per_page = 2
+
+        def get_changelist(params):
+            request = RequestFactory().get('/', params)
+            return model_admin.get_changelist(request)(request, Message, model_admin.list_display, model_admin.list_display_links,
+                                                       model_admin.list_filter, model_admin.date_hierarchy, model_admin.search_fields,
+                                                       model_admin.list_select_related, model_admin.list_per_page,
+                                                       model_admin.list_editable, model_admin)
+
+        changelist = get_changelist(dict(before=msgs[3].pk, status='H'))
+        self.assertEquals([msgs[2], msgs[1]], list(changelist.result_list))
+        self.assertEquals(5, changelist.result_count)
+        self.assertEquals('?status=H&before=%d' % msgs[1].pk, changelist.older_url)
+
+        # none of their counts go past our exact count limit
+        from django.db import connection
+        debug_cursor, connection.use_debug_cursor = connection.use_debug_cursor, True
+        start = len(connection.queries)
+        try:
+            self.assertEquals(5, get_changelist(dict(status='H')).full_result_count)
+            self.assertEquals(5, KeysetPaginator(Message.objects.filter(status='H'), 2).count)
+        finally:
+            connection.use_debug_cursor = debug_cursor
+
+        counts = [query['sql'] for query in connection.queries[start:] if 'COUNT(' in query['sql']]
+        self.assertEquals(3, len(counts))
+        for sql in counts:
+            self.assertTrue('LIMIT 1001' in sql, sql)
+
+    def testRollups(self):
+        from datetime import date
+        from .models import MessageRollup
+        from .rollups import first_id_on_or_after, rollup_day, compact_rollups, summarize
+
+        # messages over a few days, in order of id like they would be
+        dates = [datetime(2012, 1, 30, 10), datetime(2012, 1, 31, 9), datetime(2012, 1, 31, 23, 59),
+                 datetime(2012, 2, 1), datetime(2012, 2, 6, 12)]
+        msgs = []
+        for i, when in enumerate(dates):
+            msg = Message.objects.create(connection=self.connection, text='test', direction='IO'[i % 2], status='H')
+            Message.objects.filter(pk=msg.pk).update(date=when)
+            msgs.append(msg)
+
+        self.assertEquals(msgs[1].pk, first_id_on_or_after(datetime(2012, 1, 31)))
+        self.assertEquals(msgs[3].pk, first_id_on_or_after(datetime(2012, 2, 1)))
+        self.assertEquals(None, first_id_on_or_after(datetime(2012, 3, 1)))
+
+        self.assertEquals(2, rollup_day(date(2012, 1, 31)))
+        self.assertEquals(set([('O', 1), ('I', 1)]), set(MessageRollup.objects.filter(day=date(2012, 1, 31)).values_list('direction', 'count')))
+
+        # recounting a day replaces what we had
+        Message.objects.filter(pk=msgs[1].pk).update(status='S')
+        self.assertEquals(2, rollup_day(date(2012, 1, 31)))
+        self.assertEquals(2, MessageRollup.objects.filter(day=date(2012, 1, 31)).count())
+
+        # without any rollups, compacting counts everything
+        MessageRollup.objects.all().delete()
+        compact_rollups()
+        self.assertEquals(5, sum(MessageRollup.objects.values_list('count', flat=True)))
+
+        self.assertEquals([(date(2012, 1, 1), 'test_backend', 'I', 2), (date(2012, 1, 1), 'test_backend', 'O', 1),
+                           (date(2012, 2, 1), 'test_backend', 'I', 1), (date(2012, 2, 1), 'test_backend', 'O', 1)], summarize('month'))
+        self.assertEquals([(date(2012, 1, 30), 'test_backend', 'I', 2), (date(2012, 1, 30), 'test_backend', 'O', 2)],
+                          summarize('week', end=date(2012, 2, 5)))
+
+    def testNormalizer(self):
+        import re
+        from . import normalizer
+        from .normalizer import NumberNormalizer
+
+        # without rules we only strip, as we always have
+        plain = NumberNormalizer()
+        for number in ('+256 (772) 000-001', u'+256 (772) 000-001', 'ABC def', u'\u0661\u0662 \u212a', ''):
+            self.assertEquals(re.sub('[^0-9a-z]', '', number.lower()), plain.normalize(number))
+
+        rules = NumberNormalizer(rules={'default': {'country_code': '256', 'national_length': 9},
+                                        'safaricom': {'country_code': '254'}})
+        for number in ('0772000001', '256772000001', '+256 772 000001', '00256772000001', '772000001'):
+            self.assertEquals('256772000001', rules.normalize(number))
+        self.assertEquals('254722000001', rules.normalize('0722 000001', 'safaricom'))
+        self.assertEquals('8500', rules.normalize('8500'))
+        self.assertEquals('abc', rules.normalize('ABC'))
+
+        # the router stores every form of a number against the same connection
+        original = normalizer._normalizer
+        normalizer._normalizer = rules
+        try:
+            router = get_router()
+            first = router.add_message('test_backend', '0772000001', 'test', 'I', 'P')
+            second = router.add_message('test_backend', '+256772000001', 'test', 'I', 'P')
+        finally:
+            normalizer._normalizer = original
+
+        self.assertEquals('256772000001', first.connection.identity)
+        self.assertEquals(first.connection.pk, second.connection.pk)
+
+    def testNormalizeConnections(self):
+        identities = ['+256 772 000001', '(206) 779-9294', '256772000002', 'ABC', '256-772-000002', '256772000003']
+        conns = [Connection.objects.create(backend=self.backend, identity=identity) for identity in identities]
+
+        # a dry run changes nothing
+        call_command('normalizeconnections', dry_run=True, verbosity=0)
+        self.assertEquals(identities, [Connection.objects.get(pk=c.pk).identity for c in conns])
+
+        # resuming after our fourth connection only looks at those that follow it
+        call_command('normalizeconnections', after=conns[3].pk, chunk_size=2, verbosity=0)
+        self.assertEquals(identities, [Connection.objects.get(pk=c.pk).identity for c in conns])
+
+        # numbers that normalize to one we already have are left alone
+        call_command('normalizeconnections', chunk_size=2, verbosity=0)
+        self.assertEquals(['256772000001', '(206) 779-9294', '256772000002', 'abc', '256-772-000002', '256772000003'],
+                          [Connection.objects.get(pk=c.pk).identity for c in conns])
+
+        # merging moves the messages of those over to the connection with their identity
+        msgs = [Message.objects.create(connection=conn, text='test', direction='I', status='H') for conn in (conns[1], conns[4])]
+        call_command('normalizeconnections', merge=True, verbosity=0)
+
+        self.assertEquals(0, Connection.objects.filter(pk__in=[conns[1].pk, conns[4].pk]).count())
+        self.assertEquals(self.connection, Message.objects.get(pk=msgs[0].pk).connection)
+        self.assertEquals(conns[2], Message.objects.get(pk=msgs[1].pk).connection)
+
+    def testClaim(self):
+        messages = [Message.objects.create(connection=self.connection, text='test', direction='O', status=status)
+                    for status in ('Q', 'E', 'S', 'Q')]
+
+        # only queued and errored messages are claimed, and only up to our limit
+        claimed = Message.objects.filter(direction='O').order_by('id').claim(limit=2)
+        self.assertEquals([messages[0].pk, messages[1].pk], sorted(claimed))
+
+        claimed = Message.objects.filter(direction='O').claim()
+        self.assertEquals([messages[3].pk], claimed)
+        self.assertEquals([], Message.objects.filter(direction='O').claim())
+        self.assertEquals(3, Message.objects.filter(status='L').exclude(lease_expires=None).count())
+
+        # expired leases are put back in the queue
+        self.assertEquals(0, Message.objects.reclaim_expired())
+        Message.objects.filter(pk=messages[0].pk).update(lease_expires=datetime(2000, 1, 1))
+        self.assertEquals(1, Message.objects.reclaim_expired())
+        self.assertEquals('Q', Message.objects.get(pk=messages[0].pk).status)
+
     def testRouter(self):
         router = get_router()
 
@@ -294,6 +817,245 @@ class RouterTest(TestCase):
         finally:
             router.apps = []
 
+    def testDispatchTable(self):
+        router = HttpRouter()
+
+        class HandleApp(AppBase):
+            def handle(self, msg):
+                pass
+
+        class OutgoingApp(HandleApp):
+            def outgoing(self, msg):
+                pass
+
+        first, second = HandleApp(router), OutgoingApp(router)
+        router.apps = [first, second]
+
+        # apps are only called for the phases they override, outgoing in reverse
+        table = router.dispatch_table()
+        self.assertEquals([first, second], [app for app, func in table['handle']])
+        self.assertEquals([second], [app for app, func in table['outgoing']])
+        self.assertEquals([], table['filter'])
+        self.assertTrue(table is router.dispatch_table())
+
+        # changing our apps rebuilds the table
+        third = OutgoingApp(router)
+        router.apps.append(third)
+        self.assertEquals([third, second], [app for app, func in router.dispatch_table()['outgoing']])
+
+    def testNoApps(self):
+        # a router without any apps still has a phase table to go through
+        router = HttpRouter()
+        self.assertEquals([], router.dispatch_table()['filter'])
+
+        db_msg = router.handle_incoming(self.backend.name, self.connection.identity, 'test')
+        self.assertEquals('H', Message.objects.get(pk=db_msg.pk).status)
+
+        db_msg = router.add_outgoing(self.connection, 'test', status='P')
+        self.assertEquals('Q', Message.objects.get(pk=db_msg.pk).status)
+
+    def testOutgoingBatch(self):
+        from .tasks import send_messages
+
+        conns = [Connection.objects.create(backend=self.backend, identity='86753%02d' % i) for i in range(3)]
+
+        class BatchApp(AppBase):
+            def outgoing_batch(self, messages):
+                for msg in messages:
+                    msg.text += ' -stop'
+                return [msg.pk for msg in messages if msg.connection == conns[0]]
+
+        class VetoApp(AppBase):
+            def outgoing(self, msg):
+                return msg.text != 'veto'
+
+        router = get_router()
+        apps = router.apps
+        router.apps = [BatchApp(router), VetoApp(router)]
+        self.addCleanup(setattr, router, 'apps', apps)
+
+        # bulk adds are cancelled, vetoed or rewritten together
+        msgs = router.add_outgoing_batch([(conns[0], 'hi'), (conns[1], 'veto'), (conns[2], 'bye')])
+        self.assertEquals(['C', 'C', 'Q'], [msg.status for msg in msgs])
+        self.assertEquals([('C', 'hi'), ('C', 'veto'), ('Q', 'bye -stop')],
+                          [(msg.status, msg.text) for msg in Message.objects.filter(pk__in=[m.pk for m in msgs]).order_by('pk')])
+
+        # as are mass texts
+        msgs = Message.mass_text('hello', conns, status='Q')
+        self.assertEquals(set([(conns[0].pk, 'C', 'hello'), (conns[1].pk, 'Q', 'hello -stop'), (conns[2].pk, 'Q', 'hello -stop')]),
+                          set(msgs.values_list('connection', 'status', 'text')))
+
+        # and single messages go through the same hook
+        self.assertEquals('Q', Message.objects.get(pk=router.add_outgoing(conns[1], 'hey').pk).status)
+        self.assertEquals('C', Message.objects.get(pk=router.add_outgoing(conns[0], 'hey').pk).status)
+
+        # messages aren't rewritten again when they are sent
+        def test_fetch_url(cls, url, params):
+            test_fetch_url.texts.append(params['text'])
+            return TestResponse()
+        test_fetch_url.texts = []
+
+        settings.ROUTER_URL = "http://mykannel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s&id=%(id)s"
+        original_fetch_url = HttpRouter.fetch_url
+        HttpRouter.fetch_url = classmethod(test_fetch_url)
+        try:
+            send_messages(list(msgs.filter(status='Q').values_list('pk', flat=True)))
+        finally:
+            HttpRouter.fetch_url = original_fetch_url
+            del settings.ROUTER_URL
+
+        self.assertEquals(['hello+-stop', 'hello+-stop'], test_fetch_url.texts)
+
+    def testProcessIncomingMessage(self):
+        router = get_router()
+
+        # messages recorded for background handling are left as received
+        db_msg = router.add_message(self.backend.name, self.connection.identity, 'test', 'I', 'R')
+        self.assertEquals('R', Message.objects.get(pk=db_msg.pk).status)
+
+        db_msg = router.process_incoming_message(db_msg.pk)
+        self.assertEquals('H', db_msg.status)
+        self.assertEquals('H', Message.objects.get(pk=db_msg.pk).status)
+
+        # handing it off a second time is a noop
+        self.assertEquals(None, router.process_incoming_message(db_msg.pk))
+
+    def testRequeueStaleIncoming(self):
+        router = HttpRouter()
+        dispatched = []
+        router.dispatch_incoming = dispatched.append
+
+        old = datetime.now().replace(year=2000)
+        received = router.add_message(self.backend.name, self.connection.identity, 'received', 'I', 'R')
+        lost = router.add_message(self.backend.name, self.connection.identity, 'lost', 'I', 'R')
+        slow = router.add_message(self.backend.name, self.connection.identity, 'slow', 'I', 'R')
+        fresh = router.add_message(self.backend.name, self.connection.identity, 'fresh', 'I', 'R')
+        handled = router.add_message(self.backend.name, self.connection.identity, 'handled', 'I', 'H')
+        Message.objects.filter(pk__in=[received.pk, lost.pk, slow.pk, handled.pk]).update(date=old)
+
+        # claiming a message gives it a lease, one still being handled is left alone however
+        # long ago it was received, one whose lease expired is requeued
+        Message.objects.filter(pk__in=[lost.pk, slow.pk]).update(status='P', lease_expires=datetime.now() + timedelta(minutes=5))
+        Message.objects.filter(pk=lost.pk).update(lease_expires=old)
+
+        self.assertEquals([received.pk, lost.pk], router.requeue_stale_incoming())
+        self.assertEquals([received.pk, lost.pk], dispatched)
+        self.assertEquals(('R', None), Message.objects.filter(pk=lost.pk).values_list('status', 'lease_expires')[0])
+        self.assertEquals('P', Message.objects.get(pk=slow.pk).status)
+
+        # handling a message sets its lease and clears it once done
+        self.assertEquals('H', router.process_incoming_message(lost.pk).status)
+        self.assertEquals(None, Message.objects.get(pk=lost.pk).lease_expires)
+
+        # messages can also be handled right away, as by router_requeue_incoming
+        self.assertEquals([received.pk], router.requeue_stale_incoming(dispatch=router.process_incoming_message))
+        self.assertEquals('H', Message.objects.get(pk=received.pk).status)
+        self.assertEquals([], router.requeue_stale_incoming())
+
+    def testWorkerPool(self):
+        pool = WorkerPool('test', workers=2)
+        results = []
+
+        def work(value):
+            if value < 0:
+                raise Exception("negative")
+            results.append(value)
+
+        for value in (1, 2, 3, -1):
+            pool.submit(work, value)
+        pool.join()
+
+        self.assertEquals([1, 2, 3], sorted(results))
+        stats = pool.stats()
+        self.assertEquals(3, stats['processed'])
+        self.assertEquals(1, stats['errors'])
+        self.assertEquals(0, stats['queued'])
+
+    def testHttpTransport(self):
+        server = start_stub_server()
+        try:
+            url = "http://127.0.0.1:%d/cgi-bin/sendsms?to=%%s" % server.server_address[1]
+            transport = HttpTransport(pool_size=2)
+
+            for recipient in ('2067799294', '2067799291', '2067799292'):
+                response = transport.request(url % recipient)
+                self.assertEquals(202, response.getcode())
+                self.assertEquals("0: Accepted for delivery", response.read())
+
+            response = transport.request(url % '2067799294', " ")
+            self.assertEquals(202, response.getcode())
+
+            # all our requests went over a single connection
+            stats = transport.stats().values()[0]
+            self.assertEquals(dict(created=1, reused=3, requests=4, errors=0, idle=1), stats)
+            transport.close()
+        finally:
+            server.shutdown()
+
+    def testHttpTransportRetries(self):
+        import socket
+        import httplib
+        from threading import Thread
+
+        # answers the first request on each connection, then closes it or hangs up on the next
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        requests = []
+
+        def serve():
+            while True:
+                try:
+                    sock, address = listener.accept()
+                except socket.error:
+                    return
+                sock.recv(4096)
+                requests.append(address)
+                sock.sendall("HTTP/1.1 202 Accepted\r\nContent-Length: 2\r\n\r\nok")
+                if len(requests) == 1:
+                    sock.close()
+                    continue
+
+                sock.recv(4096)
+                requests.append(address)
+                sock.close()
+
+        thread = Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            url = "http://127.0.0.1:%d/cgi-bin/sendsms" % listener.getsockname()[1]
+            transport = HttpTransport(pool_size=2)
+            self.assertEquals(202, transport.request(url).getcode())
+            time.sleep(0.1)
+
+            # an idle connection the server closed isn't reused
+            self.assertEquals(202, transport.request(url).getcode())
+            self.assertEquals(2, transport.stats().values()[0]['created'])
+
+            # once our request is sent a failure is never retried, the server would see it twice
+            self.assertRaises(httplib.BadStatusLine, transport.request, url)
+            self.assertEquals(3, len(requests))
+            self.assertEquals(2, transport.stats().values()[0]['created'])
+        finally:
+            listener.close()
+
+    def testRateLimiter(self):
+        limiter = RateLimiter(limits={'test_backend': (10, 0.5)})
+
+        # unlimited backends are never held up
+        self.assertEquals(0, limiter.acquire('other_backend', 1000))
+
+        # we start with a full bucket
+        self.assertEquals(0, limiter.acquire('test_backend', 10))
+
+        # but then have to wait for it to refill, even when asking for more than it holds
+        start = time.time()
+        limiter.acquire('test_backend', 15)
+        self.assertTrue(time.time() - start >= 0.7)
+        self.assertTrue(limiter.waited >= 0.7)
+
 # add an echo app
 class EchoApp(AppBase):
     def handle(self, msg):
@@ -306,10 +1068,98 @@ class ViewTest(TestCase):
         (self.backend, created) = Backend.objects.get_or_create(name="test_backend")
         (self.connection, created) = Connection.objects.get_or_create(backend=self.backend, identity='2067799294')
         settings.SMS_APPS = ['rapidsms_httprouter.tests.EchoApp']
+        get_identity_cache().clear()
 
     def tearDown(self):
         get_router().apps = []
 
+    def testConsoleRecipient(self):
+        from .normalizer import get_normalizer
+        from .views import find_connection
+
+        normalizer = get_normalizer()
+        self.addCleanup(normalizer.clear)
+        self.addCleanup(setattr, normalizer, 'rules', normalizer.rules)
+        normalizer.rules = {'safaricom': {'country_code': '254'}}
+        normalizer.clear()
+
+        # numbers typed in the console are normalized with the rules of the backend they're on
+        safaricom = Backend.objects.create(name='safaricom')
+        kenyan = get_router().add_message('safaricom', '0722000001', 'test', 'I', 'H').connection
+        self.assertEquals(kenyan, find_connection('0722 000001', safaricom))
+        self.assertEquals(kenyan, find_connection('0722000001'))
+        self.assertEquals(None, find_connection('0722000001', self.backend))
+        self.assertEquals(self.connection, find_connection('206-779-9294'))
+
+    def testOutboxQueries(self):
+        import json
+
+        for i in range(5):
+            Message.objects.create(connection=self.connection, text='test %d' % i, direction='O', status='Q')
+
+        # the outbox takes the same number of queries however many messages are in it
+        with self.assertNumQueries(1):
+            response = self.client.get("/router/outbox")
+            self.assertEquals(5, len(json.loads(response.content)['outbox']))
+
+    def testDeliveredBatch(self):
+        import json
+
+        msgs = [Message.objects.create(connection=self.connection, text='test %d' % i, direction='O', status='S')
+                for i in range(4)]
+
+        reports = [msgs[0].pk, dict(id=msgs[1].pk, status=1), dict(id=msgs[2].pk, status=16),
+                   dict(id=msgs[3].pk, status=4), 12345]
+        with self.assertNumQueries(3):
+            response = self.client.post("/router/delivered_batch", json.dumps(reports), content_type='application/json')
+        self.assertEquals(200, response.status_code)
+
+        result = json.loads(response.content)
+        self.assertEquals(3, result['updated'])
+        self.assertEquals([12345], result['unknown'])
+
+        self.assertEquals(['D', 'D', 'F', 'S'], [Message.objects.get(pk=msg.pk).status for msg in msgs])
+        self.assertTrue(Message.objects.get(pk=msgs[0].pk).delivered)
+
+        # a late smsc report doesn't undo a delivery
+        response = self.client.post("/router/delivered_batch", json.dumps([dict(id=msgs[0].pk, status=8)]),
+                                    content_type='application/json')
+        self.assertEquals(0, json.loads(response.content)['updated'])
+        self.assertEquals('D', Message.objects.get(pk=msgs[0].pk).status)
+
+        response = self.client.post("/router/delivered_batch", json.dumps([dict(id='foo')]), content_type='application/json')
+        self.assertEquals(400, response.status_code)
+
+    def testOutboxPaging(self):
+        import json
+
+        msgs = [Message.objects.create(connection=self.connection, text='test %d' % i, direction='O', status='Q')
+                for i in range(5)]
+
+        # page through two at a time
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            outbox = json.loads(self.client.get("/router/outbox?limit=2&cursor=%s" % cursor).content)
+            pages.append([message['id'] for message in outbox['outbox']])
+            cursor = outbox['next']
+
+        self.assertEquals([[msgs[0].pk, msgs[1].pk], [msgs[2].pk, msgs[3].pk], [msgs[4].pk]], pages)
+        self.assertEquals(400, self.client.get("/router/outbox?cursor=bogus").status_code)
+
+        # claimed messages are only handed out once
+        outbox = json.loads(self.client.get("/router/outbox?limit=3&claim=true").content)
+        self.assertEquals([msgs[0].pk, msgs[1].pk, msgs[2].pk], [message['id'] for message in outbox['outbox']])
+        outbox = json.loads(self.client.get("/router/outbox?limit=3&claim=true").content)
+        self.assertEquals([msgs[3].pk, msgs[4].pk], [message['id'] for message in outbox['outbox']])
+        self.assertEquals(None, outbox['next'])
+        self.assertEquals(5, Message.objects.filter(status='L').count())
+
+        # until their lease runs out
+        Message.objects.filter(pk=msgs[0].pk).update(lease_expires=datetime(2000, 1, 1))
+        outbox = json.loads(self.client.get("/router/outbox?claim=true").content)
+        self.assertEquals([msgs[0].pk], [message['id'] for message in outbox['outbox']])
+
     def testEmptyMessage(self):
         import json
 
@@ -325,6 +1175,35 @@ class ViewTest(TestCase):
         self.assertEquals("2067799294", message['contact'])
         self.assertEquals("", message['text'])
 
+    def testReceiveBatch(self):
+        import json
+
+        messages = [dict(backend='test_backend', sender='2067799294', message='one'),
+                    dict(backend='test_backend', sender='+1 (206) 779-9295', message='two'),
+                    dict(backend='other_backend', sender='2067799294', message='three')]
+
+        response = self.client.post("/router/receive_batch", json.dumps(messages), content_type='application/json')
+        self.assertEquals(200, response.status_code)
+        handled = json.loads(response.content)['messages']
+
+        # messages come back in order, each handled
+        self.assertEquals(['one', 'two', 'three'], [message['text'] for message in handled])
+        self.assertEquals(['H', 'H', 'H'], [message['status'] for message in handled])
+        self.assertEquals(['12067799295', 'other_backend'], [handled[1]['contact'], handled[2]['backend']])
+
+        # existing connections are reused
+        self.assertEquals(self.connection, Message.objects.get(pk=handled[0]['id']).connection)
+
+        # a single bad message fails the whole batch
+        messages.append(dict(backend='test_backend', message='no sender'))
+        response = self.client.post("/router/receive_batch", json.dumps(messages), content_type='application/json')
+        self.assertEquals(400, response.status_code)
+        self.assertEquals(3, Message.objects.filter(direction='I').count())
+
+        # nothing is left waiting to be handled
+        stats = json.loads(self.client.get("/router/stats").content)
+        self.assertEquals(0, stats['incoming']['received'])
+
     def testViews(self):
         import json
 
@@ -435,6 +1314,77 @@ class ViewTest(TestCase):
         finally:
             settings.ROUTER_PASSWORD = None
 
+class SendMessagesTest(TestCase):
+
+    def setUp(self):
+        (self.backend, created) = Backend.objects.get_or_create(name="test_backend")
+        (self.backend2, created) = Backend.objects.get_or_create(name="test_backend2")
+        self.router_url = "http://mykannel.com/cgi-bin/sendsms?text=%(text)s&to=%(recipient)s&smsc=%(backend)s"
+
+    def testSendAll(self):
+        from .management.commands.send_messages import Command
+
+        # our sqlite test db can't be shared with worker threads, send in our thread
+        settings.ROUTER_SEND_DB_WORKERS = 0
+        try:
+            command = Command()
+            command.start_dispatcher(['default'])
+            command.db = 'default'
+        finally:
+            del settings.ROUTER_SEND_DB_WORKERS
+
+        urls = []
+        def fetch_url(url):
+            urls.append(url)
+            return 202
+        command.fetch_url = fetch_url
+
+        for backend, identity in ((self.backend, '2067799294'), (self.backend, '2067799291'),
+                                  (self.backend2, '2067799292'), (self.backend2, 'shortcode')):
+            connection = Connection.objects.create(backend=backend, identity=identity)
+            Message.objects.create(connection=connection, text='hello', direction='O', status='Q')
+
+        command.send_all(self.router_url, command.queued(Message.objects.filter(status='Q')))
+
+        # one url per backend, identities with letters are left queued
+        self.assertEquals(["http://mykannel.com/cgi-bin/sendsms?text=hello&to=2067799294+2067799291&smsc=test_backend",
+                           "http://mykannel.com/cgi-bin/sendsms?text=hello&to=2067799292&smsc=test_backend2"], urls)
+        self.assertEquals(3, Message.objects.filter(status='S').count())
+        self.assertEquals('shortcode', Message.objects.get(status='Q').connection.identity)
+        self.assertEquals(0, command.inflight_backends['test_backend'])
+
+    def testSendSlots(self):
+        from .management.commands.send_messages import Command
+
+        settings.ROUTER_SEND_WORKERS = 3
+        settings.ROUTER_SEND_DB_WORKERS = 2
+        settings.ROUTER_SEND_BACKEND_CONCURRENCY = dict(default=1)
+        try:
+            command = Command()
+            command.start_dispatcher(['default', 'other'])
+            command.db = 'default'
+
+            # every chunk takes a slot, whatever was in flight when the pass started
+            self.assertTrue(command.acquire_slot('default', 'test_backend'))
+            self.assertFalse(command.acquire_slot('default', 'test_backend'))
+            self.assertTrue(command.acquire_slot('default', 'test_backend2'))
+            self.assertFalse(command.acquire_slot('default', 'test_backend3'))
+            self.assertTrue(command.acquire_slot('other', 'test_backend3'))
+            self.assertFalse(command.acquire_slot('other', 'test_backend4'))
+
+            # a chunk without a slot is left queued rather than claimed
+            connection = Connection.objects.create(backend=self.backend, identity='2067799294')
+            msg = Message.objects.create(connection=connection, text='hello', direction='O', status='Q')
+            command.dispatch_chunk(self.router_url, [msg.pk], 'test_backend')
+            self.assertEquals('Q', Message.objects.get(pk=msg.pk).status)
+
+            command.release_slot('default', 'test_backend')
+            self.assertTrue(command.acquire_slot('other', 'test_backend'))
+        finally:
+            del settings.ROUTER_SEND_WORKERS
+            del settings.ROUTER_SEND_DB_WORKERS
+            del settings.ROUTER_SEND_BACKEND_CONCURRENCY
+
 class QOSTest(TestCase):
     def setUp(self):
         dct = dict(getattr(settings, 'MODEM_BACKENDS', {}).items() + getattr(settings, 'SHORTCODE_BACKENDS', {}).items())
@@ -0,0 +1,245 @@
+"""
+HTTP transport used to hand messages off to Kannel or an aggregator.  Rather than opening
+a new connection for every message like urlopen does, we keep a pool of persistent
+connections per host.
+"""
+import errno
+import httplib
+import os
+import select
+import socket
+from threading import Lock
+from urllib2 import urlopen
+from urlparse import urlsplit
+
+from django.conf import settings
+
+class Response(object):
+    """
+    A fully read response, offers the bits of the urlopen response interface our
+    senders use.
+    """
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+
+class HttpTransport(object):
+    """
+    Keeps up to ``pool_size`` idle keep-alive connections for each (scheme, host, port).
+    Connections are checked out for the duration of a request, so the transport can
+    be shared between threads.
+    """
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        if pool_size is None:
+            pool_size = getattr(settings, 'ROUTER_HTTP_POOL_SIZE', 10)
+        if connect_timeout is None:
+            connect_timeout = getattr(settings, 'ROUTER_HTTP_CONNECT_TIMEOUT', 5)
+        if read_timeout is None:
+            read_timeout = getattr(settings, 'ROUTER_HTTP_READ_TIMEOUT', 15)
+
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._idle = {}
+        self._stats = {}
+        self._lock = Lock()
+
+    def request(self, url, data=None, headers=None):
+        """
+        Requests the passed in url, as a POST if data is given.  Returns a Response.
+        """
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        key = (scheme, netloc)
+        path = path or '/'
+        if query:
+            path = "%s?%s" % (path, query)
+
+        method = 'GET' if data is None else 'POST'
+        headers = dict(headers or {})
+        if data is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        connection, reused = self._checkout(key)
+        try:
+            try:
+                connection.request(method, path, data, headers)
+            except (httplib.CannotSendRequest, socket.error), e:
+                # a reused connection the server closed before we could write our request to
+                # it is tried once more with a fresh one.  Nothing is ever retried once our
+                # request may have gone out, as the message would be sent twice.
+                connection.close()
+                if not reused or not self._is_stale_error(e):
+                    raise
+                connection = self._connect(key)
+                connection.request(method, path, data, headers)
+
+            response = connection.getresponse()
+            body = response.read()
+        except:
+            connection.close()
+            self._count(key, 'errors')
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+
+        self._count(key, 'requests')
+        return Response(url, response.status, response.msg, body)
+
+    def stats(self):
+        """
+        Returns our counters for each host, along with how many connections are idle.
+        """
+        with self._lock:
+            stats = {}
+            for (scheme, netloc), counters in self._stats.items():
+                host_stats = dict(counters)
+                host_stats['idle'] = len(self._idle.get((scheme, netloc), []))
+                stats["%s://%s" % (scheme, netloc)] = host_stats
+            return stats
+
+    def close(self):
+        """
+        Closes all our idle connections.
+        """
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+
+    @classmethod
+    def _is_stale_error(cls, error):
+        """
+        Whether the passed in error from writing a request means the connection was closed
+        by the other end, rather than a timeout.
+        """
+        if isinstance(error, httplib.CannotSendRequest):
+            return True
+        if isinstance(error, socket.timeout):
+            return False
+        return bool(error.args) and error.args[0] in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+    @classmethod
+    def _is_closed(cls, connection):
+        """
+        Whether the passed in idle connection has been closed by the server.  An idle
+        connection has nothing to read, so one that is readable is at its end.
+        """
+        if connection.sock is None:
+            return True
+        try:
+            return bool(select.select([connection.sock], [], [], 0)[0])
+        except (select.error, socket.error):
+            return True
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection = idle.pop()
+                if self._is_closed(connection):
+                    connection.close()
+                    continue
+
+                self._count(key, 'reused', locked=True)
+                return connection, True
+
+        return self._connect(key), False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def _connect(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(netloc, timeout=self.connect_timeout)
+
+        # connect using our connect timeout, then switch to our read timeout
+        try:
+            connection.connect()
+            connection.sock.settimeout(self.read_timeout)
+
+            # our requests are small, don't let them sit waiting on an ack
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except:
+            self._count(key, 'errors')
+            raise
+
+        self._count(key, 'created')
+        return connection
+
+    def _count(self, key, counter, locked=False):
+        if not locked:
+            self._lock.acquire()
+        try:
+            counters = self._stats.setdefault(key, dict(created=0, reused=0, requests=0, errors=0))
+            counters[counter] += 1
+        finally:
+            if not locked:
+                self._lock.release()
+
+
+_transport = None
+_transport_pid = None
+_transport_lock = Lock()
+
+def get_transport():
+    """
+    Returns the transport for this process.  We check the pid as connections must not be
+    shared with processes forked after they were opened, Celery workers for example.
+    """
+    global _transport, _transport_pid
+
+    with _transport_lock:
+        if _transport is None or _transport_pid != os.getpid():
+            _transport = HttpTransport()
+            _transport_pid = os.getpid()
+        return _transport
+
+def fetch_url(url, params):
+    """
+    Fetches the passed in url using our pooled transport.  This matches the signature
+    expected of ROUTER_FETCH_URL.
+    """
+    if getattr(settings, 'ROUTER_HTTP_METHOD', 'GET') == 'GET':
+        return get_transport().request(url)
+    else:
+        return get_transport().request(url, " ")
+
+def urlopen_fetch_url(url, params):
+    """
+    Fetches the passed in url with a new connection each time, the way we used to.
+    Set ROUTER_FETCH_URL to 'rapidsms_httprouter.transport.urlopen_fetch_url' to use it.
+    """
+    timeout = getattr(settings, 'ROUTER_HTTP_READ_TIMEOUT', 15)
+    if getattr(settings, 'ROUTER_HTTP_METHOD', 'GET') == 'GET':
+        return urlopen(url, timeout=timeout)
+    else:
+        return urlopen(url, " ", timeout=timeout)
@@ -1,4 +1,5 @@
 import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from django import forms
 from django.http import HttpResponse
@@ -12,15 +13,20 @@ from django.core.paginator import *
 from django.views.decorators.csrf import csrf_exempt
 
 from rapidsms.messages.outgoing import OutgoingMessage
-from rapidsms.models import Connection
+from rapidsms.models import Backend, Connection
 from djtables import Table, Column
 from djtables.column import DateColumn
 
 from django.core.mail import send_mail
 
 from .models import Message
-from .router import get_router
-from .tasks import handle_incoming
+from .cache import get_identity_cache
+from .transport import get_transport
+from .ratelimit import get_rate_limiter
+from .router import get_router, get_incoming_mode, HttpRouter
+from .search import get_search_backend
+from .pagination import KeysetPaginator, get_int
+from .rollups import summarize
 
 
 class SecureForm(forms.Form):
@@ -46,8 +52,45 @@ class MessageForm(SecureForm):
     message = forms.CharField(max_length=160, required=False)
     echo = forms.BooleanField(required=False)
 
+class BatchMessageForm(forms.Form):
+    backend = forms.CharField(max_length=32)
+    sender = forms.CharField(max_length=20)
+    message = forms.CharField(max_length=160, required=False)
+
+class BatchForm(SecureForm):
+    echo = forms.BooleanField(required=False)
+
+class StatsForm(SecureForm):
+    pass
+
 class OutboxForm(SecureForm):
     backend = forms.CharField(max_length=32, required=False)
+    limit = forms.IntegerField(min_value=1, required=False)
+    cursor = forms.CharField(required=False)
+    claim = forms.BooleanField(required=False)
+    lease = forms.IntegerField(min_value=1, required=False)
+
+    def clean_cursor(self):
+        cursor = self.cleaned_data['cursor']
+        if not cursor:
+            return None
+
+        try:
+            return decode_cursor(cursor)
+        except (TypeError, ValueError):
+            raise forms.ValidationError("Invalid cursor.")
+
+def encode_cursor(message_id):
+    """
+    Our outbox cursors are opaque to clients, currently they carry the last id returned.
+    """
+    return urlsafe_b64encode("m%d" % message_id)
+
+def decode_cursor(cursor):
+    value = urlsafe_b64decode(str(cursor))
+    if not value.startswith("m"):
+        raise ValueError("Invalid cursor")
+    return int(value[1:])
 
 def receive(request):
     """
@@ -63,12 +106,19 @@ def receive(request):
     # otherwise, create the message
     data = form.cleaned_data
     router = get_router()
-    message = router.handle_incoming(data['backend'], data['sender'], data['message'])
-
     response = {}
-    response['message'] = message.as_json()
-    response['responses'] = [m.as_json() for m in message.responses.all()]
-    response['status'] = "Message handled."
+
+    # in async mode we only record the message, it is handled in the background
+    if get_incoming_mode() != 'sync':
+        message = router.queue_incoming(data['backend'], data['sender'], data['message'])
+        response['message'] = message.as_json()
+        response['responses'] = []
+        response['status'] = "Message queued."
+    else:
+        message = router.handle_incoming(data['backend'], data['sender'], data['message'])
+        response['message'] = message.as_json()
+        response['responses'] = [m.as_json() for m in message.responses.select_related('connection__backend')]
+        response['status'] = "Message handled."
     
     # do we default to having silent responses?  200 means success in this case
     if getattr(settings, "ROUTER_SILENT", False) and (not 'echo' in data or not data['echo']):
@@ -76,21 +126,54 @@ def receive(request):
     else:
         return HttpResponse(json.dumps(response))
 
-    # if getattr(settings,'CELERY_MESSAGE_PROCESSING',None):
-    #         handle_incoming.delay(get_router(),data['backend'], data['sender'], data['message'])
-    #         return HttpResponse("celery handler")
-    #     else:
-    #         message = get_router().handle_incoming(data['backend'], data['sender'], data['message'])
-    #         response = {}
-    #         response['message'] = message.as_json()
-    #         response['responses'] = [m.as_json() for m in message.responses.all()]
-    #         response['status'] = "Message handled."
-    # 
-    #         # do we default to having silent responses?  200 means success in this case
-    #         if getattr(settings, "ROUTER_SILENT", False) and (not 'echo' in data or not data['echo']):
-    #             return HttpResponse()
-    #         else:
-    #             return HttpResponse(json.dumps(response))
+
+@csrf_exempt
+def receive_batch(request):
+    """
+    Takes a POST whose body is a JSON list of messages, each a dict with backend, sender
+    and message keys.  All the messages are recorded at once, then each is passed through
+    the rapidsms applications for processing.
+    """
+    form = BatchForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    if request.method != 'POST':
+        return HttpResponse("Must be POST of a JSON list of messages", status=400)
+
+    try:
+        items = json.loads(request.raw_post_data)
+    except ValueError:
+        return HttpResponse("Body must be a JSON list of messages", status=400)
+
+    if not isinstance(items, list):
+        return HttpResponse("Body must be a JSON list of messages", status=400)
+
+    # validate every message before we record any of them
+    messages = []
+    for index, item in enumerate(items):
+        message_form = BatchMessageForm(item if isinstance(item, dict) else {})
+        if not message_form.is_valid():
+            return HttpResponse("Message %d: %s" % (index, str(message_form.errors)), status=400)
+
+        data = message_form.cleaned_data
+        messages.append((data['backend'], data['sender'], data['message']))
+
+    response = {}
+    if get_incoming_mode() != 'sync':
+        db_messages = get_router().queue_incoming_batch(messages)
+        response['status'] = "%d messages queued." % len(db_messages)
+    else:
+        db_messages = get_router().handle_incoming_batch(messages)
+        response['status'] = "%d messages handled." % len(db_messages)
+
+    response['messages'] = [message.as_json() for message in db_messages]
+
+    # do we default to having silent responses?  200 means success in this case
+    if getattr(settings, "ROUTER_SILENT", False) and not form.cleaned_data['echo']:
+        return HttpResponse()
+    else:
+        return HttpResponse(json.dumps(response))
 
 
 @csrf_exempt
@@ -136,24 +219,79 @@ def alert(request):
 def outbox(request):
     """
     Returns any messages which have been queued to be sent but have no yet been marked
-    as being delivered.
+    as being delivered, oldest first.
+
+    Pass a ``limit`` to page through them, each page includes a ``next`` cursor to pass in
+    as ``cursor`` for the following one.  With ``claim`` the returned messages are moved
+    to 'L' (Locked) for ``lease`` seconds, so other clients polling the outbox don't send
+    them too.  Messages not marked delivered before their lease runs out are queued again.
     """
     form = OutboxForm(request.GET)
     if not form.is_valid():
         return HttpResponse(str(form.errors), status=400)
 
     data = form.cleaned_data
-    pending_messages = Message.objects.filter(status='Q')
+    messages = Message.objects.all()
     if 'backend' in data and data['backend']:
-        pending_messages = pending_messages.filter(connection__backend__name__iexact=data['backend'])
+        messages = messages.filter(connection__backend__name__iexact=data['backend'])
 
-    response = {}
-    messages = []
-    for message in pending_messages:
-        messages.append(message.as_json())
+    pending_messages = messages.filter(status='Q')
+    if data['cursor'] is not None:
+        pending_messages = pending_messages.filter(pk__gt=data['cursor'])
+    pending_messages = pending_messages.order_by('pk')
+
+    if data['claim']:
+        # give up on the claims of clients that never came back
+        messages.reclaim_expired()
+
+        ids = pending_messages.claim(limit=data['limit'], lease=data['lease'], from_statuses=('Q',))
+        pending_messages = Message.objects.filter(pk__in=ids).order_by('pk')
+    elif data['limit']:
+        pending_messages = pending_messages[:data['limit']]
+
+    # as_json needs each message's connection and backend, fetch them in the same query
+    pending_messages = pending_messages.select_related('connection__backend')
+
+    return HttpResponse(stream_outbox(pending_messages.iterator(), data['limit']), content_type='application/json')
+
+def stream_outbox(messages, limit):
+    """
+    Writes out the outbox JSON a message at a time, so we never hold it all in memory.
+    """
+    yield '{"outbox": ['
 
-    response['outbox'] = messages
-    response['status'] = "Outbox follows."
+    count = 0
+    last = None
+    for message in messages:
+        if count:
+            yield ', '
+        yield json.dumps(message.as_json())
+        count += 1
+        last = message.pk
+
+    # a full page means there may be more to come
+    next_cursor = None
+    if limit and count == limit:
+        next_cursor = encode_cursor(last)
+
+    yield '], "next": %s, "status": "Outbox follows."}' % json.dumps(next_cursor)
+
+
+def stats(request):
+    """
+    Returns counters useful for monitoring the router, such as the depth of the incoming
+    queue and the hit rate of our identity cache.
+    """
+    form = StatsForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    response = {}
+    response['incoming'] = get_router().incoming_queue_stats()
+    response['identity_cache'] = get_identity_cache().stats()
+    response['transport'] = get_transport().stats()
+    response['rate_limit_waited'] = get_rate_limiter().waited
+    response['status'] = "Stats follow."
 
     return HttpResponse(json.dumps(response))
 
@@ -161,6 +299,9 @@ def outbox(request):
 class DeliveredForm(SecureForm):
     message_id = forms.IntegerField()
 
+class DeliveredBatchForm(SecureForm):
+    pass
+
 
 def delivered(request):
     """
@@ -176,6 +317,47 @@ def delivered(request):
     return HttpResponse(json.dumps(dict(status="Message marked as sent.")))
 
 
+@csrf_exempt
+def delivered_batch(request):
+    """
+    Takes a POST whose body is a JSON list of delivery reports, each either a message id or
+    a dict with ``id`` and an optional Kannel DLR ``status`` (1 delivered, 2 failed, 4
+    buffered, 8 accepted by the smsc, 16 rejected by the smsc).  Reports without a status
+    mark their message as delivered.  Returns how many messages were updated and the ids
+    we didn't recognize.
+    """
+    form = DeliveredBatchForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    if request.method != 'POST':
+        return HttpResponse("Must be POST of a JSON list of delivery reports", status=400)
+
+    try:
+        items = json.loads(request.raw_post_data)
+    except ValueError:
+        return HttpResponse("Body must be a JSON list of delivery reports", status=400)
+
+    if not isinstance(items, list):
+        return HttpResponse("Body must be a JSON list of delivery reports", status=400)
+
+    reports = []
+    for index, item in enumerate(items):
+        if isinstance(item, dict):
+            message_id, dlr = item.get('id'), item.get('status')
+        else:
+            message_id, dlr = item, None
+
+        try:
+            reports.append((int(message_id), int(dlr) if dlr is not None else None))
+        except (TypeError, ValueError):
+            return HttpResponse("Report %d: invalid message id or status" % index, status=400)
+
+    response = get_router().mark_delivered_batch(reports)
+    response['status'] = "%d messages updated." % response['updated']
+    return HttpResponse(json.dumps(response))
+
+
 def can_send(request, message_id):
     message = get_object_or_404(Message, pk=message_id)
     send_msg = get_router().process_outgoing_phases(message)
@@ -188,14 +370,15 @@ def can_send(request, message_id):
 
 class MessageTable(Table):
     # this is temporary, until i fix ModelTable!
-    text = Column()
-    direction = Column()
-    connection = Column(link=lambda cell: "javascript:reply('%s')" % cell.row.connection.identity)
-    status = Column()
-    date = DateColumn(format="m/d/Y H:i:s")
+    text = Column(sortable=False)
+    direction = Column(sortable=False)
+    connection = Column(link=lambda cell: "javascript:reply('%s', %d)" % (cell.row.connection.identity, cell.row.connection.backend_id), sortable=False)
+    status = Column(sortable=False)
+    date = DateColumn(format="m/d/Y H:i:s", sortable=False)
 
     class Meta:
-        order_by = '-date'
+        # the console hands us a single page, already in order, see KeysetPaginator
+        template = "router/message_table.html"
 
 
 class SendForm(forms.Form):
@@ -205,8 +388,23 @@ class SendForm(forms.Form):
 
 class ReplyForm(forms.Form):
     recipient = forms.CharField(max_length=20)
+    backend = forms.ModelChoiceField(queryset=Backend.objects.all(), required=False, empty_label="Any")
     message = forms.CharField(max_length=160, widget=forms.TextInput(attrs={'size': '60'}))
 
+def find_connection(number, backend=None):
+    """
+    Returns the connection for the passed in number as typed into the console, or None.  The
+    number is normalized the same way incoming numbers are stored, using the rules of the
+    passed in backend, or of each backend in turn if none is given.
+    """
+    backends = [backend] if backend else Backend.objects.all()
+    lookups = [Q(backend=backend, identity=HttpRouter.normalize_number(number, backend.name)) for backend in backends]
+    if not lookups:
+        return None
+
+    conns = list(Connection.objects.filter(reduce(lambda a, b: a | b, lookups)).order_by('pk')[:1])
+    return conns[0] if conns else None
+
 
 class SearchForm(forms.Form):
     search = forms.CharField(label="Keywords", max_length=100, widget=forms.TextInput(attrs={'size': '60'}), required=False)
@@ -220,7 +418,7 @@ def console(request):
     form = SendForm()
     reply_form = ReplyForm()
     search_form = SearchForm()
-    queryset = Message.objects.all()
+    queryset = Message.objects.select_related('connection__backend')
 
     if request.method == 'POST' and 'this_is_the_login_form' not in request.POST:
         if request.POST['action'] == 'test':
@@ -235,9 +433,9 @@ def console(request):
         elif request.POST['action'] == 'reply':
             reply_form = ReplyForm(request.POST)
             if reply_form.is_valid():
-                if Connection.objects.filter(identity=reply_form.cleaned_data['recipient']).count():
+                conn = find_connection(reply_form.cleaned_data['recipient'], reply_form.cleaned_data['backend'])
+                if conn:
                     text = reply_form.cleaned_data['message']
-                    conn = Connection.objects.filter(identity=reply_form.cleaned_data['recipient'])[0]
                     outgoing = OutgoingMessage(conn, text)
                     get_router().handle_outgoing(outgoing)
                 else:
@@ -249,45 +447,68 @@ def console(request):
         search_form = SearchForm(request.REQUEST)
         if search_form.is_valid():
             terms = search_form.cleaned_data['search'].split()
-
             if terms:
-                term = terms[0]
-                query = (Q(text__icontains=term) | Q(in_response_to__text__icontains=term) | Q(connection__identity__icontains=term))
-                for term in terms[1:]:
-                    query &= (Q(text__icontains=term) | Q(in_response_to__text__icontains=term) | Q(connection__identity__icontains=term))
-
-                queryset = queryset.filter(query)
+                queryset = get_search_backend(queryset.db).search(queryset, terms)
 
-
-    paginator = Paginator(queryset.order_by('-id'), 20)
-    page = request.REQUEST.get('page')
-    try:
-        messages = paginator.page(page)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        messages = paginator.page(paginator.num_pages)
-    except:
-        # None or not an integer, default to first page
-        messages = paginator.page(1)
+    paginator = KeysetPaginator(queryset, 20)
+    messages = paginator.page(before=get_int(request.REQUEST, 'before'), after=get_int(request.REQUEST, 'after'))
 
     return render_to_response(
         "router/index.html", {
-            "messages_table": MessageTable(queryset, request=request),
+            "messages_table": MessageTable(messages.object_list, request=request),
             "form": form,
             "reply_form": reply_form,
             "search_form": search_form,
-            "sms_messages": messages
+            "sms_messages": messages,
+            "paginator": paginator,
+            "older_url": messages.has_next and page_url(request, before=messages.next_before),
+            "newer_url": messages.has_previous and page_url(request, after=messages.previous_after),
         }, context_instance=RequestContext(request)
     )
 
+def page_url(request, **kwargs):
+    """
+    Builds the url of another page of the console, keeping any search.
+    """
+    params = request.GET.copy()
+    for key in ('before', 'after', 'page'):
+        if key in params:
+            del params[key]
+    for key, value in kwargs.items():
+        params[key] = value
+    return "?%s" % params.urlencode()
+
+class SummaryForm(forms.Form):
+    granularity = forms.ChoiceField(choices=(('day', "Day"), ('week', "Week"), ('month', "Month")), required=False)
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+
 @login_required
 def summary(request):
-    messages = Message.objects.extra(
-                   {'year':'extract(year from date)',
-                    'month':'extract (month from date)'})\
-               .values('year', 'month', 'connection__backend__name', 'direction')\
-               .annotate(total=Count('id'))\
-               .extra(order_by=['year', 'month', 'connection__backend__name', 'direction'])
+    """
+    Totals of incoming and outgoing messages by backend for each day, week or month, read
+    from our rollups rather than the messages themselves, see rollups.py.
+    """
+    form = SummaryForm(request.GET)
+    if form.is_valid():
+        granularity = form.cleaned_data['granularity'] or 'month'
+        totals = summarize(granularity, form.cleaned_data['start'], form.cleaned_data['end'])
+    else:
+        granularity = 'month'
+        totals = summarize(granularity)
+
+    backends = sorted(set([backend for period, backend, direction, total in totals]))
+    by_period = {}
+    for period, backend, direction, total in totals:
+        by_period.setdefault(period, {})[(backend, direction)] = total
+
+    rows = []
+    for period in sorted(by_period.keys()):
+        counts = by_period[period]
+        rows.append(dict(period=period, backends=[(counts.get((backend, 'I'), 0), counts.get((backend, 'O'), 0))
+                                                  for backend in backends]))
+
     return render_to_response(
         "router/summary.html",
-        { 'messages': messages}, context_instance=RequestContext(request))
+        { 'form': form, 'granularity': granularity, 'backends': backends, 'rows': rows },
+        context_instance=RequestContext(request))
@@ -0,0 +1,107 @@
+"""
+A small in-process worker pool, used when we want to hand work off to background
+threads without needing Celery and a broker.
+"""
+import Queue
+import traceback
+from threading import Lock, Thread
+
+from django.db import transaction, close_connection
+from rapidsms.log.mixin import LoggerMixin
+
+class WorkerPool(object, LoggerMixin):
+    """
+    A fixed number of daemon threads pulling jobs off a shared queue.  A ``queue_size``
+    greater than zero bounds the queue, in which case submit() blocks once it is full.
+    With no workers at all, jobs are run right away in the submitting thread.
+    """
+    def __init__(self, name, workers=4, queue_size=0):
+        self.name = name
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+
+        self.active = 0
+        self.processed = 0
+        self.errors = 0
+        self._lock = Lock()
+        self._threads = []
+
+    def _logger_name(self):
+        return "workers/%s" % self.name
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+
+            for i in range(self.workers):
+                thread = Thread(target=self._work, name="%s-%d" % (self.name, i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func to be called with the passed in arguments on one of our threads.
+        """
+        if not self.workers:
+            self._run(func, args, kwargs)
+            return
+
+        self.start()
+        self.queue.put((func, args, kwargs))
+
+    def join(self):
+        """
+        Blocks until every job submitted so far has been run.
+        """
+        self.queue.join()
+
+    def stats(self):
+        return dict(workers=self.workers, queued=self.queue.qsize(), active=self.active,
+                    processed=self.processed, errors=self.errors)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                self._run(func, args, kwargs)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, func, args, kwargs):
+        with self._lock:
+            self.active += 1
+
+        try:
+            func(*args, **kwargs)
+            transaction.commit_unless_managed()
+            with self._lock:
+                self.processed += 1
+        except Exception as e:
+            transaction.rollback_unless_managed()
+            traceback.print_exc(e)
+            self.error("Job failed: %s" % str(e))
+            with self._lock:
+                self.errors += 1
+
+            # our db connection may be in a bad state, start fresh next time
+            if self.workers:
+                close_connection()
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+_pools = {}
+_pools_lock = Lock()
+
+def get_pool(name, workers=4, queue_size=0):
+    """
+    Returns the pool with the passed in name, creating it if this is the first time it
+    has been asked for.
+    """
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = WorkerPool(name, workers=workers, queue_size=queue_size)
+        return _pools[name]